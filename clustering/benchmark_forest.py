@@ -0,0 +1,113 @@
+"""
+    Benchmark of the scoring of a Random Forest: sklearn's predict_proba against the engine of
+    the forest exported as arrays (see forest_arrays), for several batch sizes.
+"""
+
+import time
+import pickle
+import logging
+import argparse
+import tempfile
+import numpy as np
+from scipy.sparse import random as sparse_random, vstack
+
+import utility
+import forest_arrays
+import feature_store
+
+
+def batches_of(attributes, batch_size):
+    """ Rows of attributes split into batch_size rows, cycling over them if needed. """
+
+    if attributes.shape[0] < batch_size:
+        attributes = vstack([attributes] * (batch_size // attributes.shape[0] + 1),
+                            format='csr')
+    return [attributes[start:start + batch_size]
+            for start in range(0, attributes.shape[0] - batch_size + 1, batch_size)]
+
+
+def time_per_batch(predict_proba, batches, repeat):
+    """ Median time, in ms, taken by predict_proba to score a batch. """
+
+    times = []
+    for i in range(repeat):
+        batch = batches[i % len(batches)]
+        start = time.perf_counter()
+        predict_proba(batch)
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+def benchmark(model, attributes, batch_sizes=(1, 64, 10000), repeat=20):
+    """
+        Scores attributes by batches with model.predict_proba and with the forest exported.
+
+        -------
+        Parameters:
+        - model: RandomForestClassifier
+            Forest to be benchmarked.
+        - attributes: csr_matrix
+            Samples to be scored.
+        - batch_sizes: list of int
+            Number of samples per call to predict_proba. Default: 1, 64 and 10000.
+        - repeat: int
+            Number of batches scored per batch size. Default: 20.
+
+        -------
+        Returns:
+        - list of tuples
+            (batch size, ms per batch with sklearn, ms per batch with the forest exported,
+            maximum difference between their probabilities).
+    """
+
+    results = []
+    with tempfile.TemporaryDirectory() as model_dir:
+        forest_arrays.export_forest(model, model_dir)
+        forest = forest_arrays.load_forest(model_dir)
+        for batch_size in batch_sizes:
+            batches = batches_of(attributes, batch_size)
+            difference = float(np.abs(model.predict_proba(batches[0])
+                                      - forest.predict_proba(batches[0])).max())
+            results.append((batch_size, time_per_batch(model.predict_proba, batches, repeat),
+                            time_per_batch(forest.predict_proba, batches, repeat), difference))
+            logging.info('Batch size %d: sklearn %.3f ms, arrays %.3f ms, max difference %g',
+                         *results[-1])
+    return results
+
+
+def main():
+    """ Runs benchmark on a pickled model, with samples of a feature store or random ones. """
+
+    parser = argparse.ArgumentParser(description='Compares the time taken to score batches of '
+                                                 + 'samples by sklearn and by the forest '
+                                                 + 'exported as arrays.')
+    parser.add_argument('--m', metavar='MODEL', type=str, nargs=1, required=True,
+                        help='path of the pickled model')
+    parser.add_argument('--s', metavar='STORE', type=str, nargs=1, default=[None],
+                        help='feature store (see features/feature_store.py) containing the '
+                             + 'samples to be scored, random samples being used otherwise')
+    parser.add_argument('--bs', metavar='BATCH_SIZE', type=int, nargs='+',
+                        default=[1, 64, 10000], help='batch sizes to be benchmarked')
+    parser.add_argument('--r', metavar='REPEAT', type=int, nargs=1, default=[20],
+                        help='number of batches scored per batch size')
+    parser.add_argument('--v', metavar='VERBOSITY', type=int, nargs=1, choices=[0, 1, 2, 3, 4, 5],
+                        default=[2], help='controls the verbosity of the output, from 0 (verbose) '
+                                          + 'to 5 (less verbose)')
+    args = vars(parser.parse_args())
+    utility.control_logger(args['v'][0])
+
+    model = pickle.load(open(args['m'][0], 'rb'))
+    if args['s'][0] is not None:
+        attributes = feature_store.load_store(args['s'][0])[1]
+    else:
+        attributes = sparse_random(max(args['bs']), model.n_features_in_, density=0.01,
+                                   format='csr', random_state=0)
+
+    print('batch size, sklearn (ms/batch), arrays (ms/batch), max difference')
+    for batch_size, sklearn_time, arrays_time, difference in benchmark(model, attributes,
+                                                                       args['bs'], args['r'][0]):
+        print('%d, %.3f, %.3f, %g' % (batch_size, sklearn_time, arrays_time, difference))
+
+
+if __name__ == "__main__":  # Executed only if run as a script
+    main()
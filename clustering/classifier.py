@@ -10,10 +10,11 @@ import logging
 
 import utility
 import static_analysis
+import feature_store
 
 
 def test_model(names, labels, attributes, model, print_res=True, print_res_verbose=False,
-               print_score=True, threshold=0.29):
+               print_score=True, threshold=0.29, output_format='text', output=None, header=True):
     """
         Use an existing model to classify new JS inputs.
 
@@ -39,6 +40,12 @@ def test_model(names, labels, attributes, model, print_res=True, print_res_verbo
         - threshold: float
             Probability of a sample being malicious over which the sample will be classified
             as malicious.
+        - output_format: str
+            Format of the predictions printed: 'text', 'csv' or 'jsonl'. Default: 'text'.
+        - output: file object
+            Where to print the predictions. Default: None, i.e. stdout.
+        - header: bool
+            Whether to print the CSV header. Default: True.
 
         -------
         Returns:
@@ -46,8 +53,7 @@ def test_model(names, labels, attributes, model, print_res=True, print_res_verbo
             List of labels predicted.
     """
 
-    if isinstance(model, str):
-        model = pickle.load(open(model, 'rb'))
+    model = utility.load_model(model)
 
     labels_predicted_proba_test = model.predict_proba(attributes)
     # Probability of the samples for each class in the model.
@@ -61,12 +67,14 @@ def test_model(names, labels, attributes, model, print_res=True, print_res_verbo
     # to predict the target values
 
     if print_res:
-        utility.get_classification_results(names, labels_predicted_test)
+        utility.get_classification_results(names, labels_predicted_test, output_format, output,
+                                           header)
 
     if print_res_verbose:
         utility.get_classification_results_verbose(names, labels, labels_predicted_test,
                                                    labels_predicted_proba_test, model,
-                                                   attributes, threshold)
+                                                   attributes, threshold, output_format, output,
+                                                   header)
 
     if print_score:
         utility.get_score(labels, labels_predicted_test)
@@ -74,11 +82,16 @@ def test_model(names, labels, attributes, model, print_res=True, print_res_verbo
     return labels_predicted_test
 
 
-def parsing_commands():
+def parsing_commands(args=None):
     """
         Creation of an ArgumentParser object, holding all the information necessary to parse
         the command line into Python data types.
 
+        -------
+        Parameter:
+        - args: list
+            Arguments to parse. Default: None, i.e. the command line.
+
         -------
         Returns:
         - ArgumentParser such as:
@@ -88,6 +101,8 @@ def parsing_commands():
           * labels_f=arg_obj['lf'],
           * model=arg_obj['m'],
           * threshold=arg_obj['th'],
+          * output_format=arg_obj['format'][0],
+          * output=arg_obj['o'][0],
           * tolerance=arg_obj['t'][0],
           * n=arg_obj['n'][0].
           A more thorough description can be obtained:
@@ -112,19 +127,20 @@ def parsing_commands():
                              + 'to build a model)')
     parser.add_argument('--th', metavar='THRESHOLD', type=float, nargs=1, default=[0.29],
                         help='threshold over which all samples are considered malicious')
+    parser.add_argument('--format', metavar='FORMAT', type=str, nargs=1, default=['text'],
+                        choices=['text', 'csv', 'jsonl'],
+                        help='format of the predictions: text, csv or jsonl')
+    parser.add_argument('--o', metavar='OUTPUT', type=str, nargs=1, default=[None],
+                        help='file to store the predictions in (default: stdout)')
     utility.parsing_commands(parser)
 
-    return vars(parser.parse_args())
-
+    return vars(parser.parse_args(args))
 
-arg_obj = parsing_commands()
-utility.control_logger(arg_obj['v'][0])
 
-
-def main_classification(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=arg_obj['lf'],
-                        labels_d=arg_obj['l'], model=arg_obj['m'], threshold=arg_obj['th'],
-                        n=arg_obj['n'][0], tolerance=arg_obj['t'][0],
-                        dict_not_hash=arg_obj['dnh'][0]):
+def main_classification(js_dirs=None, js_files=None, labels_f=None, labels_d=None, model=None,
+                        threshold=(0.29,), n=4, tolerance='false', dict_not_hash=True, jobs=1,
+                        cache=None, cache_size=1024, timeout=60, max_size=None, max_memory=None,
+                        output_format='text', output=None):
     """
         Main function, performs a static analysis (syntactic) of JavaScript files given as input
         before predicting if the executables are benign or malicious.
@@ -152,7 +168,23 @@ def main_classification(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=ar
             files to be analysed.
         - dict_not_hash: Boolean
             True if a dictionary is used to map n-grams to int, False if hashes are used.
-        Default values are the ones given in the command lines or in the
+        - jobs: int
+            Number of processes used to analyse the files.
+        - cache: str
+            Path of the SQLite file caching the syntactic units of the files analysed.
+        - cache_size: int
+            Maximum size of the previous cache, in MB.
+        - timeout: float
+            Number of seconds after which the parsing of a file is stopped.
+        - max_size: float
+            Size in MB over which a file is not parsed.
+        - max_memory: int
+            Memory in MB over which the parsing of a file is stopped.
+        - output_format: str
+            Format of the predictions: 'text', 'csv' or 'jsonl'.
+        - output: str
+            Path of the file to store the predictions in, None for stdout.
+        When run as a script, the values are the ones given in the command lines or in the
         ArgumentParser object (function parsingCommands()).
 
         -------
@@ -182,7 +214,9 @@ def main_classification(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=ar
     else:
         names, attributes, labels = static_analysis.main_analysis \
             (js_dirs=js_dirs, labels_dirs=labels_d, js_files=js_files, labels_files=labels_f,
-             tolerance=tolerance, n=n, dict_not_hash=dict_not_hash)
+             tolerance=tolerance, n=n, dict_not_hash=dict_not_hash, jobs=jobs,
+             cache_path=cache, cache_size=cache_size, timeout=timeout, max_size=max_size,
+             max_memory=max_memory)
 
         if names:
             # Uncomment to save the analysis results in pickle objects.
@@ -192,7 +226,9 @@ def main_classification(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=ar
                                           names, attributes, labels)
             """
 
-            test_model(names, labels, attributes, model=model[0], threshold=threshold[0])
+            with utility.results_output(output) as results_file:
+                test_model(names, labels, attributes, model=model[0], threshold=threshold[0],
+                           output_format=output_format, output=results_file)
 
         else:
             logging.warning('No file found for the analysis.\n'
@@ -201,11 +237,7 @@ def main_classification(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=ar
                             + 'Otherwise they may not contain enough n-grams)')
 
 
-if __name__ == "__main__":  # Executed only if run as a script
-    main_classification()
-
-
-def classify_analysis_results(save_dir, model, threshold):
+def classify_analysis_results(save_dir, model, threshold, output_format='text', output=None):
     """
         Uses the results of a static analysis (syntactic) of JavaScript files to predict if the
         executables are benign or malicious.
@@ -219,6 +251,10 @@ def classify_analysis_results(save_dir, model, threshold):
             path to the model used to classify the new files
         - threshold: int
             threshold over which all samples are considered malicious
+        - output_format: str
+            Format of the predictions: 'text', 'csv' or 'jsonl'. Default: 'text'.
+        - output: str
+            Path of the file to store the predictions in. Default: None, i.e. stdout.
 
         -------
         Returns:
@@ -226,8 +262,40 @@ def classify_analysis_results(save_dir, model, threshold):
         either benign or malicious
     """
 
-    names = pickle.load(open(os.path.join(save_dir, 'Names'), 'rb'))
-    attributes = pickle.load(open(os.path.join(save_dir, 'Attributes'), 'rb'))
-    labels = pickle.load(open(os.path.join(save_dir, 'Labels'), 'rb'))
+    if not feature_store.is_store(save_dir):  # Results stored with the former format
+        names = pickle.load(open(os.path.join(save_dir, 'Names'), 'rb'))
+        attributes = pickle.load(open(os.path.join(save_dir, 'Attributes'), 'rb'))
+        labels = pickle.load(open(os.path.join(save_dir, 'Labels'), 'rb'))
 
-    test_model(names, labels, attributes, model=model, threshold=threshold)
+        with utility.results_output(output) as results_file:
+            test_model(names, labels, attributes, model=model, threshold=threshold,
+                       output_format=output_format, output=results_file)
+        return
+
+    model = utility.load_model(model)
+
+    # The chunks are classified one after the other, the score is computed on all of them
+    all_labels, all_labels_predicted = [], []
+    with utility.results_output(output) as results_file:
+        for chunk_nb, (names, attributes, labels) in enumerate(
+                feature_store.iter_chunks(save_dir)):
+            all_labels_predicted.extend(test_model(names, labels, attributes, model=model,
+                                                   print_score=False, threshold=threshold,
+                                                   output_format=output_format,
+                                                   output=results_file, header=chunk_nb == 0))
+            all_labels.extend(labels)
+
+    utility.get_score(all_labels, all_labels_predicted)
+
+
+if __name__ == "__main__":  # Executed only if run as a script
+    arg_obj = parsing_commands()
+    utility.control_logger(arg_obj['v'][0])
+    main_classification(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=arg_obj['lf'],
+                        labels_d=arg_obj['l'], model=arg_obj['m'], threshold=arg_obj['th'],
+                        n=arg_obj['n'][0], tolerance=arg_obj['t'][0],
+                        dict_not_hash=arg_obj['dnh'][0], jobs=arg_obj['jobs'][0],
+                        cache=arg_obj['cache'][0], cache_size=arg_obj['cache_size'][0],
+                        timeout=arg_obj['timeout'][0], max_size=arg_obj['max_size'][0],
+                        max_memory=arg_obj['max_memory'][0],
+                        output_format=arg_obj['format'][0], output=arg_obj['o'][0])
@@ -1,4 +1,3 @@
-
 """
     Main module to classify HTML pages (based on an analysis of their JS snippets)
     using a given model.
@@ -6,25 +5,238 @@
 
 import os
 import logging
+from collections import Counter
+
+import numpy as np
 
 import utility
-import classifier
 import static_analysis
+import ngrams_handling
+import tokens
+import parser_pool
+
+AGGREGATIONS = ['any', 'max', 'topk', 'size']  # See page_score
+PRIORS = ['size', 'none']  # See page_snippets
+
+
+def file_size(path):
+    """ Size of a file in bytes, 0 if it cannot be read. """
+
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def page_snippets(page, prior='size'):
+    """
+        JS snippets of a page, in the order in which they are evaluated.
+
+        -------
+        Parameters:
+        - page: str
+            Directory containing the JS snippets of the page.
+        - prior: str or callable
+            Cheap estimate of the snippets most likely to be malicious, evaluated first:
+            'size' for the largest snippets first, 'none' for the order of the directory, or a
+            function mapping the path of a snippet to a sort key (e.g. from crawl metadata
+            telling inline and external scripts apart). Default: 'size'.
+
+        -------
+        Returns:
+        - list of str
+    """
+
+    snippets = list(static_analysis.walk_files(page))
+    if prior == 'size':
+        snippets.sort(key=file_size, reverse=True)
+    elif callable(prior):
+        snippets.sort(key=prior)
+    return snippets
+
+
+def pages_inputs(pages, prior='size'):
+    """
+        Inputs of static_analysis.iter_inputs_analysis: the JS snippets of each page (see
+        page_snippets), in the order of the pages, labelled with the index of their page.
+    """
+
+    for index, page in enumerate(pages):
+        for cfile in page_snippets(page, prior):
+            yield cfile, cfile, index
+
+
+def group_by_page(page_indices):
+    """
+        Groups consecutive rows of the same page.
+
+        -------
+        Parameters:
+        - page_indices: list of int
+            Index of the page of each row, the rows of a page being consecutive.
 
+        -------
+        Returns:
+        - tuple (np.array, np.array)
+            Index of each page found and offset of its first row.
+    """
+
+    page_indices = np.asarray(page_indices)
+    starts = np.flatnonzero(np.r_[True, page_indices[1:] != page_indices[:-1]])
+    return page_indices[starts], starts
 
-def classify_websites(js_dir, model, dict_not_hash=True, tolerance='false', n=4, threshold=0.29):
+
+def score_pages(chunks, model):
+    """
+        Classifies the JS snippets of each chunk in one call to the model and groups their
+        probabilities by page. A page may be spread over two chunks.
+
+        -------
+        Parameters:
+        - chunks: iterable of lists
+            [names, attributes, page indices] as yielded by
+            static_analysis.iter_inputs_analysis on pages_inputs.
+        - model
+            Model used to classify the snippets.
+
+        -------
+        Returns:
+        - generator
+            Yields tuples (index of the page, names of its valid snippets, np.array of their
+            probability of being malicious), in the order of the pages. Pages without valid
+            snippets are left out.
+    """
+
+    pending = None  # Page of the last rows of a chunk, which may go on in the next one
+    for names, attributes, page_indices in chunks:
+        malicious_proba = model.predict_proba(attributes)[:, 1]
+        pages, starts = group_by_page(page_indices)
+        stops = np.r_[starts[1:], len(page_indices)]
+
+        scores = [(page, names[start:stop], malicious_proba[start:stop])
+                  for page, start, stop in zip(pages.tolist(), starts, stops)]
+        if pending is not None:
+            if pending[0] == scores[0][0]:
+                scores[0] = (pending[0], pending[1] + scores[0][1],
+                             np.concatenate((pending[2], scores[0][2])))
+            else:
+                yield pending
+        for score in scores[:-1]:
+            yield score
+        pending = scores[-1]
+
+    if pending is not None:
+        yield pending
+
+
+def early_exit_pages(pages, analyse, model, threshold, prior='size', chunk_size=10000):
+    """
+        Version of score_pages stopping the evaluation of a page as soon as one of its snippets
+        is malicious. The snippets of a window of pages are evaluated by rounds, the next
+        snippets (see page_snippets) of the pages not flagged yet being analysed and classified
+        at once in each round: 1 snippet per page, then 2, 4, 8...
+
+        -------
+        Parameters:
+        - pages: list of str
+            Directories of the pages.
+        - analyse: callable
+            Function mapping inputs of static_analysis.iter_inputs_analysis to its chunks.
+        - model, threshold, prior
+            See classify_websites.
+        - chunk_size: int
+            Number of snippets of the pages of a window (at least one page per window).
+            Default: 10000.
+
+        -------
+        Returns:
+        - generator
+            See score_pages, only the snippets evaluated being given.
+    """
+
+    next_page = 0
+    while next_page < len(pages):
+        remaining = {}  # Page index -> snippets not evaluated yet
+        nb_snippets = 0
+        while next_page < len(pages) and (nb_snippets < chunk_size or not remaining):
+            remaining[next_page] = page_snippets(pages[next_page], prior)
+            nb_snippets += len(remaining[next_page])
+            next_page += 1
+
+        evaluated = {}  # Page index -> (names, probabilities)
+        round_size = 1
+        while remaining:
+            inputs = [(cfile, cfile, page) for page, snippets in remaining.items()
+                      for cfile in snippets[:round_size]]
+            remaining = {page: snippets[round_size:] for page, snippets in remaining.items()
+                         if len(snippets) > round_size}
+            for page, names, malicious_proba in score_pages(analyse(inputs), model):
+                if page in evaluated:
+                    names = evaluated[page][0] + names
+                    malicious_proba = np.concatenate((evaluated[page][1], malicious_proba))
+                evaluated[page] = (names, malicious_proba)
+                if malicious_proba.max() >= threshold:
+                    remaining.pop(page, None)  # Early exit
+            round_size *= 2
+
+        for page in sorted(evaluated):
+            yield (page,) + evaluated[page]
+
+
+def page_score(names, malicious_proba, aggregation='any', top_k=3):
+    """
+        Probability of a page being malicious, given its snippets.
+
+        -------
+        Parameters:
+        - names: list of str
+            Path of the valid snippets of the page.
+        - malicious_proba: np.array
+            Probability of each snippet being malicious.
+        - aggregation: str
+            * 'any' and 'max': highest probability of the snippets, i.e. the page is malicious
+            if one of its snippets is ('any' stopping the evaluation of the page at the first
+            malicious snippet, see early_exit_pages);
+            * 'topk': mean of the top_k highest probabilities;
+            * 'size': mean of the probabilities weighted by the size of the snippets.
+            Default: 'any'.
+        - top_k: int
+            Number of snippets of 'topk'. Default: 3.
+
+        -------
+        Returns:
+        - float
+    """
+
+    if aggregation in ('any', 'max'):
+        return float(malicious_proba.max())
+    if aggregation == 'topk':
+        return float(np.sort(malicious_proba)[-top_k:].mean())
+    if aggregation == 'size':
+        sizes = np.array([file_size(name) for name in names], dtype=np.float64)
+        return float(np.average(malicious_proba, weights=sizes + 1))  # +1 for empty snippets
+    raise ValueError('Unknown aggregation: ' + str(aggregation))
+
+
+def classify_websites(js_dir, model, dict_not_hash=True, tolerance='false', n=4, threshold=0.29,
+                      parser_workers=1, jobs=1, chunk_size=10000, timeout=60, max_size=None,
+                      max_memory=None, output_format='text', output=None, aggregation='any',
+                      top_k=3, prior='size'):
     """
         Test of a classification model to detect malicious web pages.
-        A web page is defined as malicious if at least one of its JS snippet is malicious.
-        Otherwise it is labeled as benign.
+        By default, a web page is defined as malicious if at least one of its JS snippet is
+        malicious. Otherwise it is labeled as benign.
+        The snippets of all the pages are analysed in one pass and classified by chunks, the
+        vocabulary, the model and the Node.js workers being loaded only once (even for the
+        rounds of 'any').
 
         -------
         Parameters:
         - js_dirs: str
             Directory containing directories representing the web pages to be analysed
             (the JS snippets of the page considered are stored in the corresponding subdirectory).
-        - model: str
-            Path to the model used to classify the new files.
+        - model: str or classifier
+            Model (or path of the model, see utility.load_model) used to classify the new files.
          dict_not_hash: Boolean
             True if a dictionary is used to map n-grams to int, False if hashes are used.
             Default: True.
@@ -37,47 +249,98 @@ def classify_websites(js_dir, model, dict_not_hash=True, tolerance='false', n=4,
             files to be analysed. Default: 4.
         - threshold: int
             Threshold over which all samples are considered malicious. Default: 0.29.
+            A page is malicious if its score (see aggregation) is over it.
+        - parser_workers, jobs, timeout, max_size, max_memory
+            See static_analysis.main_analysis.
+        - chunk_size: int
+            Number of snippets classified at once. Default: 10000.
+        - output_format, output
+            See utility.write_classification_results. The pages are printed as they are
+            classified.
+        - aggregation, top_k
+            Score of a page given its snippets, see page_score. Default: 'any', the
+            evaluation of a page stopping at its first malicious snippet (see
+            early_exit_pages), so that only the snippets evaluated are counted (the printed
+            total size then being that of the scripts evaluated).
+        - prior: str or callable
+            Order in which the snippets of a page are evaluated, see page_snippets.
+            Default: 'size'.
     """
 
+    if aggregation not in AGGREGATIONS:
+        raise ValueError('Unknown aggregation: ' + str(aggregation))
+    model = utility.load_model(model)
+    pages = sorted(os.path.join(js_dir, html) for html in os.listdir(js_dir)
+                   if os.path.isdir(os.path.join(js_dir, html)))
+
+    max_size_bytes = None if max_size is None else int(max_size * 1024 * 1024)
+    vocabulary = ngrams_handling.open_vocabulary(n) if dict_not_hash else None
+    executor = None
+    stats = Counter()  # Of all the analyses, e.g. the rounds of 'any'
+
+    def analyse(inputs, analysis_chunk_size=None):
+        return static_analysis.iter_inputs_analysis(
+            inputs, n, tolerance, dict_not_hash, tokens.file_status_and_numbers,
+            parser_workers, jobs, chunk_size=analysis_chunk_size, timeout=timeout,
+            max_size=max_size, max_memory=max_memory, vocabulary=vocabulary,
+            executor=executor, stats=stats)
+
     len_malicious = 0
     len_benign = 0
-
+    nb_malicious_pages = 0
+    nb_benign_pages = 0
+    next_page = 0  # Pages before it are classified or have no valid JS snippet
+    header = True
     res_names = []
     res_predict = []
 
-    for html in os.listdir(js_dir):
-        html = os.path.join(js_dir, html)
-
-        names, attributes, labels = static_analysis.main_analysis \
-            (js_dirs=[html], labels_dirs=None, js_files=None, labels_files=None,
-             tolerance=tolerance, n=n, dict_not_hash=dict_not_hash)
+    # The Node.js workers (or processes) are shared by all the analyses
+    if jobs == 1:
+        parser_pool.start_pool(parser_workers, timeout, max_size_bytes, max_memory)
+    else:
+        executor = static_analysis.open_executor(jobs, timeout=timeout, max_size=max_size_bytes,
+                                                 max_memory=max_memory)
+    try:
+        if aggregation == 'any':
+            scores = early_exit_pages(pages, analyse, model, threshold, prior, chunk_size)
+        else:
+            scores = score_pages(analyse(pages_inputs(pages, prior), chunk_size), model)
 
-        # Uncomment to save the analysis results in pickle objects.
-        """
-        utility.save_analysis_results(os.path.join(html, "Analysis-n" + str(n) + "-dict"
-                                                   + str(dict_not_hash)), names, attributes, labels)
-        """
+        for page, names, malicious_proba in scores:
+            for html in pages[next_page:page]:
+                logging.error('No valid JS files could be found in ' + html)
+            next_page = page + 1
 
-        try:
-            labels_predicted_test = classifier.test_model(names, labels, attributes, model,
-                                                          print_res=False, print_score=False,
-                                                          threshold=threshold)
-            if 'malicious' in labels_predicted_test:
+            res_names.append(pages[page])
+            if page_score(names, malicious_proba, aggregation, top_k) >= threshold:
                 len_malicious += len(names)
-                res_names.append(html)
+                nb_malicious_pages += 1
                 res_predict.append('malicious')
             else:
                 len_benign += len(names)
-                res_names.append(html)
+                nb_benign_pages += 1
                 res_predict.append('benign')
 
-        except ValueError:
-            logging.exception('No valid JS files could be found in ' + html)
-            # shutil.rmtree(html)
+            if len(res_names) >= utility.RESULTS_BLOCK:
+                utility.get_classification_results(res_names, res_predict, output_format,
+                                                   output, header)
+                res_names, res_predict, header = [], [], False
+    finally:
+        if jobs == 1:
+            parser_pool.stop_pool()
+        else:
+            executor.shutdown()
+        if vocabulary is not None:
+            vocabulary.close()
+        static_analysis.log_parsing_stats(stats)
+    for html in pages[next_page:]:
+        logging.error('No valid JS files could be found in ' + html)
 
-    utility.get_classification_results(res_names, res_predict)
+    utility.get_classification_results(res_names, res_predict, output_format, output, header)
 
-    print('Recognised as malicious: ' + str(len([i for i in res_predict if i == 'malicious']))
-          + ' Total size: ' + str(len_malicious) + ' scripts')
-    print('Recognised as benign: ' + str(len([i for i in res_predict if i == 'benign']))
-          + ' Total size: ' + str(len_benign) + ' scripts')
+    # With 'any', the snippets of a malicious page after its first malicious one are not counted
+    scripts = ' scripts evaluated' if aggregation == 'any' else ' scripts'
+    print('Recognised as malicious: ' + str(nb_malicious_pages)
+          + ' Total size: ' + str(len_malicious) + scripts)
+    print('Recognised as benign: ' + str(nb_benign_pages)
+          + ' Total size: ' + str(len_benign) + scripts)
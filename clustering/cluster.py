@@ -9,6 +9,7 @@ import logging
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
+from scipy.sparse import issparse
 
 from sklearn.decomposition import PCA
 from sklearn.cluster import KMeans
@@ -29,7 +30,7 @@ def nb_clusters(attributes, fig_dir=os.path.join(src_path, 'Clustering'),
 
         -------
         Parameters:
-        - attributes: np.array
+        - attributes: csr_matrix
             Features of the data to cluster.
         - fig_dir: str
             Path to store the figure displaying the evolution of the error rate as the
@@ -91,7 +92,7 @@ def clustering(names, attributes, nb_cluster, fig_dir=os.path.join(src_path, 'Cl
         Parameters:
         - names: list
             Name of the data files to cluster.
-        - attributes: np.array
+        - attributes: csr_matrix
             Features of the data to cluster.
         - nb_cluster: int
             Number of clusters wished.
@@ -137,6 +138,8 @@ def clustering(names, attributes, nb_cluster, fig_dir=os.path.join(src_path, 'Cl
 
         # PCA does not support sparse input. See TruncatedSVD for a possible alternative.
         if display_fig:
+            if issparse(attributes):
+                attributes = attributes.toarray()
             pca = PCA(n_components=2)  # 2-dimensional PCA
             attributes = pd.DataFrame(pca.fit_transform(attributes))
             attributes = np.asarray(attributes)
@@ -259,7 +262,11 @@ utility.control_logger(arg_obj['v'][0])
 
 def main_clustering(js_dirs=arg_obj['d'], js_files=arg_obj['f'], tolerance=arg_obj['t'][0],
                     nb_cluster=arg_obj['c'], n=arg_obj['n'][0], display_fig=arg_obj['g'][0],
-                    dict_not_hash=arg_obj['dnh'][0], labels_d=arg_obj['l'], labels_f=arg_obj['lf']):
+                    dict_not_hash=arg_obj['dnh'][0], labels_d=arg_obj['l'], labels_f=arg_obj['lf'],
+                    jobs=arg_obj['jobs'][0], cache=arg_obj['cache'][0],
+                    cache_size=arg_obj['cache_size'][0],
+                    timeout=arg_obj['timeout'][0], max_size=arg_obj['max_size'][0],
+                    max_memory=arg_obj['max_memory'][0]):
     """
         Main function, uses a static analysis (lexical or syntactical)
         of JavaScript files given in input to cluster them into k (configurable) families.
@@ -287,6 +294,18 @@ def main_clustering(js_dirs=arg_obj['d'], js_files=arg_obj['f'], tolerance=arg_o
             Indicates the label's name of the files considered.
         - labels_d: list of strings
             Indicates the label's name of the directories considered.
+        - jobs: int
+            Number of processes used to analyse the files.
+        - cache: str
+            Path of the SQLite file caching the syntactic units of the files analysed.
+        - cache_size: int
+            Maximum size of the previous cache, in MB.
+        - timeout: float
+            Number of seconds after which the parsing of a file is stopped.
+        - max_size: float
+            Size in MB over which a file is not parsed.
+        - max_memory: int
+            Memory in MB over which the parsing of a file is stopped.
         Default values are the ones given in the command lines or in the
         ArgumentParser object (function parsing_commands()).
     """
@@ -308,7 +327,9 @@ def main_clustering(js_dirs=arg_obj['d'], js_files=arg_obj['f'], tolerance=arg_o
     else:
         names, attributes, labels = static_analysis.main_analysis \
             (js_dirs=js_dirs, labels_dirs=labels_d, js_files=js_files, labels_files=labels_f,
-             tolerance=tolerance, n=n, dict_not_hash=dict_not_hash)
+             tolerance=tolerance, n=n, dict_not_hash=dict_not_hash, jobs=jobs,
+             cache_path=cache, cache_size=cache_size, timeout=timeout, max_size=max_size,
+             max_memory=max_memory)
 
         if names:
             # Uncomment to save the analysis results in pickle objects.
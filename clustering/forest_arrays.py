@@ -0,0 +1,347 @@
+"""
+    Export of a Random Forest into flattened arrays, from which it is loaded almost instantly
+    and whose pages are shared between the processes using it, the arrays being memory-mapped.
+
+    An exported forest is a directory containing forest.json (format, classes, number of
+    features, generation and files of the arrays) and one .npy file per attribute of the
+    nodes, the nodes of all the trees being concatenated:
+    - roots (int64): index of the root of each tree;
+    - feature (int32): feature tested by each node (-2 for the leaves);
+    - threshold (float64): a sample goes to the left child if its feature <= threshold;
+    - left, right (int32): index of the children of each node (-1 for the leaves);
+    - value (float64): probability of each class at each node, as given by the tree's
+    predict_proba.
+    The files of the arrays are named after their generation (e.g. feature.3.npy), a forest
+    exported again in the same directory getting new files: forest.json, replaced last, only
+    ever lists arrays of the same export.
+"""
+
+import os
+import json
+import pickle
+import logging
+import argparse
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+from sklearn.tree._tree import Tree, NODE_DTYPE
+
+FOREST_FILE = 'forest.json'
+FORMAT_VERSION = 1
+NODE_ARRAYS = ['roots', 'feature', 'threshold', 'left', 'right', 'value']
+ENGINE_BLOCK = 1 << 22  # Maximum number of (sample, tree) traversed at once
+DENSE_BLOCK = 1 << 24  # Maximum number of features of a block of samples densified
+LEVEL_ROWS = 4  # Maximum number of samples for which the level-by-level engine is faster
+
+
+def is_forest(model_dir):
+    """ Indicates whether model_dir contains an exported forest. """
+
+    return os.path.isfile(os.path.join(model_dir, FOREST_FILE))
+
+
+def export_forest(model, model_dir):
+    """
+        Stores the trees of a forest as flattened arrays (see the module's docstring).
+
+        -------
+        Parameters:
+        - model: RandomForestClassifier
+            Forest to be exported, with one output.
+        - model_dir: str
+            Directory to store the arrays in, created if needed.
+    """
+
+    if getattr(model, 'n_outputs_', 1) != 1:
+        raise ValueError('Only forests with one output can be exported')
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+
+    roots, features, thresholds, lefts, rights, values = [], [], [], [], [], []
+    offset = 0
+    for each_tree in model.estimators_:
+        tree = each_tree.tree_
+        roots.append(offset)
+        features.append(tree.feature.astype(np.int32))
+        thresholds.append(tree.threshold)
+        # Indices of the children in the concatenated arrays, the leaves keeping -1
+        lefts.append(np.where(tree.children_left >= 0, tree.children_left + offset, -1))
+        rights.append(np.where(tree.children_right >= 0, tree.children_right + offset, -1))
+        value = tree.value[:, 0, :]
+        normalizer = value.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        values.append(value / normalizer)  # As DecisionTreeClassifier.predict_proba
+        offset += tree.node_count
+
+    arrays = {'roots': np.array(roots, dtype=np.int64),
+              'feature': np.concatenate(features),
+              'threshold': np.concatenate(thresholds).astype(np.float64),
+              'left': np.concatenate(lefts).astype(np.int32),
+              'right': np.concatenate(rights).astype(np.int32),
+              'value': np.concatenate(values).astype(np.float64)}
+    # New files, the processes which loaded a former export keeping its arrays
+    former = load_description(model_dir) if is_forest(model_dir) else None
+    generation = 0 if former is None else former.get('generation', 0) + 1
+    files = {name: '%s.%d.npy' % (name, generation) for name in NODE_ARRAYS}
+    for name in NODE_ARRAYS:
+        np.save(os.path.join(model_dir, files[name]), arrays[name])
+
+    description = {'format': FORMAT_VERSION, 'classes': [str(c) for c in model.classes_],
+                   'n_features': int(model.n_features_in_), 'n_trees': len(roots),
+                   'n_nodes': offset, 'generation': generation, 'arrays': files}
+    path = os.path.join(model_dir, FOREST_FILE)
+    with open(path + '.tmp', 'w') as forest_file:
+        json.dump(description, forest_file, indent=1)
+    os.replace(path + '.tmp', path)  # Last, for the forest to be complete
+
+    # The arrays of the former export are kept, for a process which has just read its
+    # forest.json to find them; older ones are deleted
+    kept = set(files.values()) | set(array_files(former).values() if former else [])
+    for file_name in os.listdir(model_dir):
+        if file_name.endswith('.npy') and file_name.split('.')[0] in NODE_ARRAYS \
+                and file_name not in kept:
+            os.remove(os.path.join(model_dir, file_name))
+    logging.info('The forest has been exported in ' + model_dir)
+
+
+def load_description(model_dir):
+    """ Content of the forest.json of an exported forest. """
+
+    with open(os.path.join(model_dir, FOREST_FILE)) as forest_file:
+        description = json.load(forest_file)
+    if description['format'] != FORMAT_VERSION:
+        raise ValueError('Unknown format of exported forest: ' + str(description['format']))
+    return description
+
+
+def array_files(description):
+    """ Name of the file of each array of an exported forest, given its forest.json. """
+
+    # Forests exported before the generations store the arrays as <name>.npy
+    return description.get('arrays', {name: name + '.npy' for name in NODE_ARRAYS})
+
+
+def load_forest(model_dir, mmap=True):
+    """
+        Loads a forest exported by export_forest.
+
+        -------
+        Parameters:
+        - model_dir: str
+            Directory of the exported forest.
+        - mmap: bool
+            Whether the arrays are memory-mapped (read-only) instead of being read.
+            Default: True.
+
+        -------
+        Returns:
+        - ArrayForest
+    """
+
+    description = load_description(model_dir)
+    files = array_files(description)
+    arrays = {name: np.load(os.path.join(model_dir, files[name]),
+                            mmap_mode='r' if mmap else None) for name in NODE_ARRAYS}
+    return ArrayForest(description, arrays)
+
+
+class ArrayForest:
+    """
+        Forest loaded from flattened arrays, scoring like the RandomForestClassifier exported.
+        Like it, it has the attributes classes_, n_features_in_ and estimators_ (ArrayTree).
+
+        A few samples (at most LEVEL_ROWS, e.g. a request of the scoring server) are scored by
+        a vectorized engine: all the trees are traversed at once, one level at a time, the
+        features of the samples being densified so that each node reads the feature it tests
+        with a single gather. Larger batches are scored tree after tree by sklearn's compiled
+        traversal, on trees rebuilt from the arrays the first time it is needed.
+    """
+
+    def __init__(self, description, arrays):
+        self.classes_ = np.array(description['classes'])
+        self.n_features_in_ = description['n_features']
+        self.n_jobs = None
+        self.roots = arrays['roots']
+        self.feature = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.left = arrays['left']
+        self.right = arrays['right']
+        self.value = arrays['value']
+        self.estimators_ = [ArrayTree(self, i) for i in range(len(self.roots))]
+        self.trees = None  # sklearn Tree of each tree, see compiled_trees
+
+    def apply(self, attributes, trees=None):
+        """
+            Leaf reached by each sample in each tree.
+
+            -------
+            Parameters:
+            - attributes: csr_matrix or np.array
+                Features of the samples.
+            - trees: list
+                Indices of the trees to be traversed. Default: None, i.e. all of them.
+
+            -------
+            Returns:
+            - generator
+                Yields tuples (np.array of shape (number of samples of the block, number of
+                trees) of the indices of the leaves, index of the first sample of the block,
+                index after its last sample), for blocks of at most ENGINE_BLOCK (sample, tree) and
+                DENSE_BLOCK features.
+        """
+
+        attributes = engine_input(attributes, self.n_features_in_)
+        trees = np.arange(len(self.roots)) if trees is None else np.asarray(trees)
+        block_size = max(1, ENGINE_BLOCK // max(1, len(trees)))
+        if attributes.shape[0] <= LEVEL_ROWS:
+            engine = self.block_apply
+            block_size = min(block_size, max(1, DENSE_BLOCK // max(1, attributes.shape[1])))
+        else:
+            engine = self.compiled_apply
+        for start in range(0, attributes.shape[0], block_size):
+            stop = min(start + block_size, attributes.shape[0])
+            yield engine(attributes[start:stop], trees), start, stop
+
+    def block_apply(self, attributes, trees):
+        """
+            See apply, for one block of samples (csr_matrix given by engine_input), with the
+            level-by-level engine.
+        """
+
+        roots = self.roots[trees]
+        n_samples, n_trees = attributes.shape[0], len(roots)
+        dense = attributes.toarray().ravel()  # Features of the samples, one row after the other
+
+        # Leaf reached by each (sample, tree), in the order of the samples then of the trees
+        leaves = np.tile(np.asarray(roots, dtype=np.int64), n_samples)
+        active = np.flatnonzero(self.left[leaves] >= 0)  # Not in a leaf yet
+        current = leaves[active]
+        offsets = (active // n_trees) * attributes.shape[1]  # Position of the sample's row
+        while len(current):  # One level of all the trees at a time
+            go_left = dense[offsets + self.feature[current]] <= self.threshold[current]
+            current = np.where(go_left, self.left[current], self.right[current])
+            in_leaf = self.left[current] < 0
+            leaves[active[in_leaf]] = current[in_leaf]
+            # Only the pairs still in an internal node are carried to the next level
+            still = ~in_leaf
+            active, current, offsets = active[still], current[still], offsets[still]
+        return leaves.reshape(n_samples, n_trees)
+
+    def compiled_apply(self, attributes, trees):
+        """
+            See apply, for one block of samples (csr_matrix given by engine_input), with
+            sklearn's compiled traversal.
+        """
+
+        compiled = self.compiled_trees()
+        # Filled tree after tree, so that the leaves of a tree are contiguous
+        leaves = np.empty((len(trees), attributes.shape[0]), dtype=np.int64)
+        for i, tree in enumerate(trees.tolist()):
+            leaves[i] = compiled[tree].apply(attributes) + self.roots[tree]
+        return leaves.T
+
+    def compiled_trees(self):
+        """
+            sklearn Tree of each tree, with the nodes of the arrays (their values are not
+            copied, the probabilities being read from the arrays).
+        """
+
+        if self.trees is None:
+            ends = np.append(self.roots[1:], len(self.feature))
+            trees = []
+            for root, end in zip(self.roots.tolist(), ends.tolist()):
+                nodes = np.zeros(end - root, dtype=NODE_DTYPE)
+                left, right = self.left[root:end], self.right[root:end]
+                nodes['left_child'] = np.where(left >= 0, left - root, -1)
+                nodes['right_child'] = np.where(right >= 0, right - root, -1)
+                nodes['feature'] = self.feature[root:end]
+                nodes['threshold'] = self.threshold[root:end]
+                tree = Tree(self.n_features_in_, np.array([len(self.classes_)], dtype=np.intp),
+                            1)
+                tree.__setstate__({'max_depth': 0, 'node_count': end - root, 'nodes': nodes,
+                                   'values': np.zeros((end - root, 1, len(self.classes_)))})
+                trees.append(tree)
+            self.trees = trees  # Built once, possibly by several threads at the same time
+        return self.trees
+
+    def predict_proba(self, attributes, trees=None):
+        """
+            Probability of the samples for each class, see
+            RandomForestClassifier.predict_proba.
+
+            -------
+            Parameters:
+            - attributes: csr_matrix or np.array
+                Features of the samples.
+            - trees: list
+                Indices of the trees to be used. Default: None, i.e. all of them.
+
+            -------
+            Returns:
+            - np.array
+                Of shape (number of samples, number of classes).
+        """
+
+        all_proba = np.zeros((attributes.shape[0], len(self.classes_)))
+        nb_trees = len(self.roots) if trees is None else len(trees)
+        for leaves, start, stop in self.apply(attributes, trees):
+            block_proba = all_proba[start:stop]
+            for i in range(nb_trees):  # Summed in the trees' order, as RandomForestClassifier
+                block_proba += self.value[leaves[:, i]]
+        all_proba /= nb_trees
+        return all_proba
+
+    def predict(self, attributes):
+        """ Class of the samples, see RandomForestClassifier.predict. """
+
+        return self.classes_[np.argmax(self.predict_proba(attributes), axis=1)]
+
+
+class ArrayTree:
+    """
+        Tree of an ArrayForest, scoring like the DecisionTreeClassifier exported.
+    """
+
+    def __init__(self, forest, index):
+        self.forest = forest
+        self.index = index
+
+    def predict_proba(self, attributes, check_input=True):
+        """
+            Probability of the samples for each class, see
+            DecisionTreeClassifier.predict_proba (check_input is only accepted for
+            compatibility).
+        """
+
+        return self.forest.predict_proba(attributes, [self.index])
+
+
+def engine_input(attributes, n_features):
+    """
+        Converts samples into a CSR matrix of float32 (the type with which sklearn compares
+        the features with the thresholds), as expected by ArrayForest.block_apply.
+    """
+
+    if attributes.shape[1] != n_features:
+        raise ValueError('The samples have ' + str(attributes.shape[1])
+                         + ' features, the forest expects ' + str(n_features))
+    if not issparse(attributes):
+        attributes = np.asarray(attributes)
+    return csr_matrix(attributes, dtype=np.float32)
+
+
+def main():
+    """ Exports a pickled forest given as command line argument. """
+
+    parser = argparse.ArgumentParser(description='Exports a pickled Random Forest into '
+                                                 + 'memory-mappable arrays.')
+    parser.add_argument('--m', metavar='MODEL', type=str, nargs=1, required=True,
+                        help='path of the pickled model')
+    parser.add_argument('--o', metavar='DIR', type=str, nargs=1, required=True,
+                        help='directory to store the exported forest in')
+    args = vars(parser.parse_args())
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    export_forest(pickle.load(open(args['m'][0], 'rb')), args['o'][0])
+
+
+if __name__ == "__main__":  # Executed only if run as a script
+    main()
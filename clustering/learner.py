@@ -4,19 +4,21 @@
 """
 
 import os
-import pickle
 import argparse
 import logging
 
+import numpy as np
+
 import utility
 import static_analysis
+import feature_store
 
 
 src_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
 
 def classify(names, labels, attributes, model_dir, model_name, estimators,
-             print_score=False, print_res=False):
+             print_score=False, print_res=False, model_format='pickle'):
     """
         Training a classifier.
 
@@ -26,7 +28,7 @@ def classify(names, labels, attributes, model_dir, model_name, estimators,
             Name of the data files used to build a model from.
         - labels: list
             Labels (i.e. 'benign', 'malicious') of the data used to build a model from.
-        - attributes: np.array
+        - attributes: csr_matrix
             Features of the data used to build a model from.
         - model_dir: str
             Path to store the model that will be produced.
@@ -38,6 +40,8 @@ def classify(names, labels, attributes, model_dir, model_name, estimators,
             Indicates whether to print or not the classifier's performance. Default: False.
         - print_res: bool
             Indicates whether to print or not the classifier's predictions. Default: False.
+        - model_format: str
+            Format of the model stored, see utility.save_model. Default: 'pickle'.
 
         -------
         Returns:
@@ -69,7 +73,105 @@ def classify(names, labels, attributes, model_dir, model_name, estimators,
         utility.get_classification_results(names, labels_predicted)
 
     model_path = os.path.join(model_dir, model_name)
-    pickle.dump(trained, open(model_path, 'wb'))
+    utility.save_model(trained, model_path, model_format)
+    logging.info('The model has been successfully stored in ' + model_path)
+
+    return trained
+
+
+def store_subsets(labels, chunk_rows, max_subsets=None):
+    """
+        Splits the files of a feature store into subsets of at most about chunk_rows files,
+        each subset containing the same proportion of each label.
+
+        -------
+        Parameters:
+        - labels: np.array
+            Label of each file of the store, see feature_store.load_labels.
+        - chunk_rows: int
+            Number of files per subset.
+        - max_subsets: int
+            Maximum number of subsets, which then contain more than chunk_rows files.
+            Default: None, i.e. no limit.
+
+        -------
+        Returns:
+        - list of np.array
+            Sorted indices of the files of each subset. The files of a label less frequent
+            than there are subsets are in every subset, for each of them to contain every
+            label.
+    """
+
+    nb_subsets = max(1, -(-len(labels) // chunk_rows))
+    if max_subsets is not None:
+        nb_subsets = max(1, min(nb_subsets, max_subsets))
+    random_state = np.random.RandomState(0)
+    subsets = [[] for _ in range(nb_subsets)]
+    for label in np.unique(labels):
+        rows = random_state.permutation(np.flatnonzero(labels == label))
+        if len(rows) < nb_subsets:
+            parts = [rows] * nb_subsets
+        else:
+            parts = np.array_split(rows, nb_subsets)
+        for subset, part in zip(subsets, parts):
+            subset.append(part)
+    return [np.sort(np.concatenate(subset)) for subset in subsets]
+
+
+def classify_store(store_dir, model_dir, model_name, estimators, chunk_rows=100000,
+                   print_score=False, print_res=False, model_format='pickle'):
+    """
+        Training a classifier on a feature store (see feature_store) which may not fit in
+        memory: the store is split into subsets of chunk_rows files (see store_subsets), a
+        forest is trained on each subset, one after the other, and their trees are merged into
+        one forest (see utility.merge_forests). Only one subset is loaded at a time.
+
+        -------
+        Parameters:
+        - store_dir: str
+            Path of the feature store containing the files to build a model from.
+        - model_dir, model_name, estimators, print_score, print_res, model_format
+            See classify. The estimators trees are shared between the forests.
+        - chunk_rows: int
+            Maximum number of files (about) a forest is trained on. Default: 100000.
+            The store is split into estimators subsets at most, for each forest to have at
+            least one tree: with fewer trees than chunk_rows subsets, each forest is trained
+            on more than chunk_rows files.
+
+        -------
+        Returns:
+        - The model constructed, compatible with classifier.test_model.
+    """
+
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+
+    labels = feature_store.load_labels(store_dir)
+    subsets = store_subsets(labels, chunk_rows, estimators)  # At least one tree per subset
+    forests = []
+    for i, (rows, trees) in enumerate(zip(subsets, np.array_split(np.arange(estimators),
+                                                                  len(subsets)))):
+        _, attributes, subset_labels = feature_store.load_selected_rows(store_dir, rows)
+        clf = utility.classifier_choice(estimators=len(trees))
+        clf.set_params(random_state=i)  # Different trees for each subset
+        forests.append(clf.fit(attributes, subset_labels))
+        logging.info('Forest %d/%d trained on %d files', i + 1, len(subsets), len(rows))
+        del attributes
+    trained = utility.merge_forests(forests)
+
+    if print_score or print_res:
+        labels_predicted = []
+        for names, attributes, _ in feature_store.iter_chunks(store_dir):
+            chunk_predicted = trained.predict(attributes)
+            if print_res:
+                utility.get_classification_results(names, chunk_predicted,
+                                                   header=not labels_predicted)
+            labels_predicted.extend(chunk_predicted)
+        if print_score:
+            utility.get_score(labels.tolist(), labels_predicted)
+
+    model_path = os.path.join(model_dir, model_name)
+    utility.save_model(trained, model_path, model_format)
     logging.info('The model has been successfully stored in ' + model_path)
 
     return trained
@@ -92,6 +194,9 @@ def parsing_commands():
           * print_score=arg_obj['ps'][0],
           * print_res=arg_obj['pr'][0],
           * estimators=arg_obj['nt'][0],
+          * model_format=arg_obj['mf'][0],
+          * store=arg_obj['s'][0],
+          * chunk_rows=arg_obj['cr'][0],
           * tolerance=arg_obj['t'][0],
           * n=arg_obj['n'][0].
           A more thorough description can be obtained:
@@ -124,6 +229,18 @@ def parsing_commands():
                         help='indicates whether to print or not the classifier\'s predictions')
     parser.add_argument('--nt', metavar='NB_TREES', type=int, nargs=1,
                         default=[500], help='number of trees in the forest')
+    parser.add_argument('--mf', metavar='MODEL-FORMAT', type=str, nargs=1, default=['pickle'],
+                        choices=['pickle', 'arrays', 'shards'],
+                        help='format of the model: pickle, arrays for a directory of '
+                             + 'memory-mappable arrays loading faster (but not updatable), or '
+                             + 'shards for a directory to be updated by shards of trees')
+    parser.add_argument('--s', metavar='STORE', type=str, nargs=1, default=[None],
+                        help='feature store (see features/feature_store.py) to build the model '
+                             + 'from without loading it in memory, the JS inputs given being '
+                             + 'analysed into it first')
+    parser.add_argument('--cr', metavar='NB_FILES', type=int, nargs=1, default=[100000],
+                        help='with --s, maximum number of files each part of the forest is '
+                             + 'trained on')
     utility.parsing_commands(parser)
 
     return vars(parser.parse_args())
@@ -136,7 +253,12 @@ utility.control_logger(arg_obj['v'][0])
 def main_learn(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=arg_obj['lf'],
                labels_d=arg_obj['l'], model_dir=arg_obj['md'], model_name=arg_obj['mn'],
                print_score=arg_obj['ps'], print_res=arg_obj['pr'], dict_not_hash=arg_obj['dnh'][0],
-               n=arg_obj['n'][0], tolerance=arg_obj['t'][0], estimators=arg_obj['nt']):
+               n=arg_obj['n'][0], tolerance=arg_obj['t'][0], estimators=arg_obj['nt'],
+               jobs=arg_obj['jobs'][0], cache=arg_obj['cache'][0],
+               cache_size=arg_obj['cache_size'][0],
+               timeout=arg_obj['timeout'][0], max_size=arg_obj['max_size'][0],
+               max_memory=arg_obj['max_memory'][0], model_format=arg_obj['mf'][0],
+               store=arg_obj['s'][0], chunk_rows=arg_obj['cr'][0]):
     """
         Main function, performs a static analysis (syntactic) of JavaScript files given as input
         to build a model to classify future JavaScript files.
@@ -172,11 +294,39 @@ def main_learn(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=arg_obj['lf
             files to be analysed.
         - estimators: int
             Number of trees in the forest.
+        - jobs: int
+            Number of processes used to analyse the files.
+        - cache: str
+            Path of the SQLite file caching the syntactic units of the files analysed.
+        - cache_size: int
+            Maximum size of the previous cache, in MB.
+        - timeout: float
+            Number of seconds after which the parsing of a file is stopped.
+        - max_size: float
+            Size in MB over which a file is not parsed.
+        - max_memory: int
+            Memory in MB over which the parsing of a file is stopped.
+        - model_format: str
+            Format of the model: 'pickle', 'arrays' or 'shards' (see utility.save_model).
+        - store: str
+            Path of a feature store to build the model from, out of core (see classify_store).
+            The JS inputs given, if any, are analysed and appended to it first.
+        - chunk_rows: int
+            Maximum number of files each forest is trained on, with store.
         Default values are the ones given in the command lines or in the
         ArgumentParser object (function parsingCommands()).
     """
 
-    if js_dirs is None and js_files is None:
+    if store is not None and js_dirs is None and js_files is None:
+        if feature_store.is_store(store):
+            classify_store(store, model_dir=model_dir[0], model_name=model_name[0],
+                           estimators=estimators[0], chunk_rows=chunk_rows,
+                           print_score=print_score[0], print_res=print_res[0],
+                           model_format=model_format)
+        else:
+            logging.error('No feature store found in ' + store)
+
+    elif js_dirs is None and js_files is None:
         logging.error('Please, indicate a directory or a JS file to be used to build a model from')
 
     elif labels_d is None and labels_f is None:
@@ -191,10 +341,26 @@ def main_learn(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=arg_obj['lf
         logging.error('Please, indicate as many file labels as the number '
                       + str(len(js_files)) + ' of files to analyze')
 
+    elif store is not None:
+        if static_analysis.stream_analysis(store, js_dirs=js_dirs, js_files=js_files,
+                                           labels_files=labels_f, labels_dirs=labels_d, n=n,
+                                           tolerance=tolerance, dict_not_hash=dict_not_hash,
+                                           jobs=jobs, cache_path=cache, cache_size=cache_size,
+                                           timeout=timeout, max_size=max_size,
+                                           max_memory=max_memory):
+            classify_store(store, model_dir=model_dir[0], model_name=model_name[0],
+                           estimators=estimators[0], chunk_rows=chunk_rows,
+                           print_score=print_score[0], print_res=print_res[0],
+                           model_format=model_format)
+        else:
+            logging.warning('No file found for the analysis.')
+
     else:
         names, attributes, labels = static_analysis.main_analysis\
             (js_dirs=js_dirs, labels_dirs=labels_d, js_files=js_files, labels_files=labels_f,
-             tolerance=tolerance, n=n, dict_not_hash=dict_not_hash)
+             tolerance=tolerance, n=n, dict_not_hash=dict_not_hash, jobs=jobs,
+             cache_path=cache, cache_size=cache_size, timeout=timeout, max_size=max_size,
+             max_memory=max_memory)
 
         if names:
             # Uncomment to save the analysis results in pickle objects.
@@ -205,7 +371,8 @@ def main_learn(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=arg_obj['lf
             """
 
             classify(names, labels, attributes, model_dir=model_dir[0], model_name=model_name[0],
-                     print_score=print_score[0], print_res=print_res[0], estimators=estimators[0])
+                     print_score=print_score[0], print_res=print_res[0], estimators=estimators[0],
+                     model_format=model_format)
 
         else:
             logging.warning('No file found for the analysis.\n'
@@ -0,0 +1,202 @@
+"""
+    Model used by a long-lived process (e.g. clustering/scoring_server.py) together with what
+    is needed to analyse the JS inputs it classifies: n-gram vocabulary, n and tolerance.
+    A ModelBundle is never modified: a model retrained (e.g. by updater.py) is loaded into a new
+    bundle, in the background, which then replaces the former one at once in a BundleHolder.
+    The requests being answered keep the bundle they started with.
+"""
+
+import os
+import logging
+import threading
+from contextlib import contextmanager
+
+import utility
+import static_analysis
+import ngrams_handling
+import forest_arrays
+import sharded_model
+
+
+def model_version(model_path):
+    """
+        Identifies a version of a stored model, which is replaced and not modified by
+        utility.save_model. None if it cannot be read.
+    """
+
+    if forest_arrays.is_forest(model_path):
+        model_path = os.path.join(model_path, forest_arrays.FOREST_FILE)  # Written last
+    elif sharded_model.is_sharded(model_path):
+        model_path = os.path.join(model_path, sharded_model.SHARDS_FILE)  # Written last
+    try:
+        stat = os.stat(model_path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class ModelBundle:
+    """
+        Model, n-gram vocabulary, n and tolerance used to classify JS inputs.
+    """
+
+    def __init__(self, model, n=4, tolerance='false', dict_not_hash=True):
+        """
+            -------
+            Parameters:
+            - model: str or classifier
+                Model (or path of the model, see utility.load_model).
+            - n, tolerance, dict_not_hash
+                See static_analysis.main_analysis.
+        """
+
+        self.model_path = model if isinstance(model, str) else None
+        # Before the model is read, for a model stored meanwhile to be seen as new
+        self.version = None if self.model_path is None else model_version(self.model_path)
+        self.model = utility.load_model(model)
+        self.n = n
+        self.tolerance = tolerance
+        self.dict_not_hash = dict_not_hash
+        self.n_features = ngrams_handling.nb_features(n)
+        self.vocabulary = ngrams_handling.open_vocabulary(n) if dict_not_hash else None
+        self.users = 0  # Number of requests using the bundle, see BundleHolder.use
+        self.retired = False  # Whether another bundle replaced it
+
+    def features(self, numbers_list):
+        """
+            Non-zero elements of the feature vector of a JS input (see
+            static_analysis.numbers_features), or None.
+        """
+
+        res = static_analysis.numbers_features(numbers_list, self.n, self.dict_not_hash,
+                                               self.n_features)
+        if self.dict_not_hash and res is not None:
+            res = ngrams_handling.dict_proba_of_codes(res[0], res[1], res[2], self.n,
+                                                      self.vocabulary)
+        return res
+
+    def predict_proba(self, attributes):
+        """ Probability of the samples for each class, see the model's predict_proba. """
+
+        return self.model.predict_proba(attributes)
+
+    def close(self):
+        """ Stores the n-grams added to the vocabulary, if any. """
+
+        if self.vocabulary is not None:
+            self.vocabulary.close()
+            self.vocabulary = None
+
+
+class BundleHolder:
+    """
+        Current ModelBundle of a process, replaced atomically. A bundle replaced is closed once
+        the last request using it is answered.
+    """
+
+    def __init__(self, bundle):
+        self.bundle = bundle
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()  # One reload at a time
+        self.watcher = None
+        self.stop_watching = threading.Event()
+
+    @contextmanager
+    def use(self):
+        """
+            Context manager giving the current bundle, which is not closed before the end of
+            the context even if it is replaced meanwhile.
+        """
+
+        with self.lock:
+            bundle = self.bundle
+            bundle.users += 1
+        try:
+            yield bundle
+        finally:
+            with self.lock:
+                bundle.users -= 1
+                unused = bundle.retired and bundle.users == 0
+            if unused:
+                bundle.close()
+
+    def swap(self, bundle):
+        """ Replaces the current bundle by bundle. """
+
+        with self.lock:
+            former = self.bundle
+            self.bundle = bundle
+            former.retired = True
+            unused = former.users == 0
+        if unused:
+            former.close()
+
+    def reload(self, model=None, n=None, tolerance=None, dict_not_hash=None):
+        """
+            Loads a new bundle and swaps it with the current one. The current bundle is kept if
+            the new one cannot be loaded.
+
+            -------
+            Parameters:
+            - model, n, tolerance, dict_not_hash
+                See ModelBundle. Default: None, i.e. those of the current bundle.
+
+            -------
+            Returns:
+            - bool
+                Whether the bundle was replaced.
+        """
+
+        with self.reload_lock:
+            current = self.bundle
+            try:
+                bundle = ModelBundle(current.model_path if model is None else model,
+                                     current.n if n is None else n,
+                                     current.tolerance if tolerance is None else tolerance,
+                                     current.dict_not_hash if dict_not_hash is None
+                                     else dict_not_hash)
+            except Exception:  # e.g. a model being written by another tool
+                logging.exception('The model could not be reloaded, the former one is kept')
+                return False
+            self.swap(bundle)
+        logging.info('Model reloaded from ' + str(bundle.model_path))
+        return True
+
+    def reload_in_background(self, **kwargs):
+        """ Runs reload (with the same parameters) in a thread, which is returned. """
+
+        thread = threading.Thread(target=self.reload, kwargs=kwargs, daemon=True)
+        thread.start()
+        return thread
+
+    def watch(self, interval=10):
+        """
+            Reloads the bundle whenever its model is stored again, e.g. by updater.py, checking
+            every interval seconds from a background thread.
+        """
+
+        def run():
+            while not self.stop_watching.wait(interval):
+                bundle = self.bundle
+                if bundle.model_path is None:
+                    continue
+                version = model_version(bundle.model_path)
+                if version is not None and version != bundle.version:
+                    self.reload()
+
+        self.stop_watching.clear()
+        self.watcher = threading.Thread(target=run, daemon=True)
+        self.watcher.start()
+
+    def close(self):
+        """ Stops watching the model and closes the current bundle once it is unused. """
+
+        if self.watcher is not None:
+            self.stop_watching.set()
+            self.watcher.join()
+            self.watcher = None
+        with self.lock:
+            self.bundle.retired = True
+            unused = self.bundle.users == 0
+        if unused:
+            self.bundle.close()
@@ -0,0 +1,330 @@
+"""
+    Resident scoring service: the model, the n-gram vocabulary and the Node.js parsers are loaded
+    once, then JS sources or files sent over a Unix socket are classified as benign or malicious.
+
+    Protocol: one JSON object per line, in both directions. A request contains either a 'source'
+    (JS source) or a 'path' (path of a JS file), and optionally an 'id' echoed in the response.
+    A response contains the 'id', the 'status' of the parsing (see is_js.OUTPUT_TEXTS), the
+    'label' predicted and the probability 'proba' of the input being malicious (both None if
+    the input could not be analysed), or an 'error'.
+    A client may send several requests without waiting, the responses being sent in order.
+
+    The model is reloaded without stopping the service on SIGHUP, or when it is stored again
+    (e.g. by updater.py) with --watch, see model_bundle.
+"""
+
+import os
+import json
+import time
+import queue
+import signal
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+from concurrent.futures import Future
+
+import utility
+import ngrams_handling
+import model_bundle
+import tokens
+import parser_pool
+import is_js
+
+DEFAULT_SOCKET = os.path.join('/tmp', 'jast-scoring.sock')
+
+
+class MicroBatcher:
+    """
+        Gathers the feature vectors submitted by concurrent requests, so that the model classifies
+        them in one call: a batch is classified once it contains batch_size vectors or batch_wait
+        seconds after its first vector was submitted. The vectors of a batch computed with
+        different model bundles (see model_bundle) are classified by their own bundle.
+    """
+
+    def __init__(self, threshold, batch_size=64, batch_wait=0.002):
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, bundle, dimensions, proba):
+        """
+            Submits the non-zero elements of a feature vector (see
+            static_analysis.numbers_features), computed with bundle.
+
+            -------
+            Returns:
+            - Future
+                Whose result is the tuple (label predicted, probability of being malicious).
+        """
+
+        future = Future()
+        self.requests.put((bundle, dimensions, proba, future))
+        return future
+
+    def run(self):
+        """ Classifies the batches of vectors, one after the other. """
+
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.requests.get(timeout=max(remaining, 0)))
+                except queue.Empty:
+                    break
+
+            bundles = {}  # Bundle -> its requests, usually only one
+            for request in batch:
+                bundles.setdefault(request[0], []).append(request)
+            for bundle, requests in bundles.items():
+                self.classify(bundle, requests)
+
+    def classify(self, bundle, requests):
+        """ Classifies the vectors of requests computed with bundle in one call. """
+
+        try:
+            attributes = ngrams_handling.CsrBuilder(bundle.n_features, len(requests))
+            for _, dimensions, proba, _ in requests:
+                attributes.add_row(dimensions, proba)
+            labels_predicted_proba = bundle.predict_proba(attributes.to_csr())
+            labels_predicted = utility.predict_labels_using_threshold(
+                len(requests), labels_predicted_proba, self.threshold)
+            for i, (_, _, _, future) in enumerate(requests):
+                future.set_result((labels_predicted[i], float(labels_predicted_proba[i, 1])))
+        except Exception as err:  # The requests of the batch fail, not the service
+            logging.exception('The classification of a batch failed')
+            for _, _, _, future in requests:
+                if not future.done():
+                    future.set_exception(err)
+
+
+class Scorer:
+    """
+        Analyses JS inputs and classifies them with a MicroBatcher, using the current model
+        bundle of bundles (see model_bundle.BundleHolder).
+    """
+
+    def __init__(self, model, n=4, tolerance='false', dict_not_hash=True, threshold=0.29,
+                 batch_size=64, batch_wait=0.002):
+        """
+            -------
+            Parameters:
+            - model: str or classifier
+                Model (or path of the model, see utility.load_model) used to classify the JS
+                inputs.
+            - n, tolerance, dict_not_hash
+                See static_analysis.main_analysis.
+            - threshold: float
+                Probability of a sample being malicious over which the sample will be
+                classified as malicious. Default: 0.29.
+            - batch_size, batch_wait
+                See MicroBatcher.
+        """
+
+        self.bundles = model_bundle.BundleHolder(model_bundle.ModelBundle(model, n, tolerance,
+                                                                          dict_not_hash))
+        self.batcher = MicroBatcher(threshold, batch_size, batch_wait)
+
+    def close(self):
+        """ Stores the n-grams added to the vocabulary, if any. """
+
+        self.bundles.close()
+
+    def score(self, request):
+        """
+            Answers a request of the protocol described in the module's docstring.
+
+            -------
+            Returns:
+            - dict
+                The response.
+        """
+
+        response = {'id': request.get('id'), 'status': None, 'label': None, 'proba': None}
+        if 'source' not in request and 'path' not in request:
+            response['error'] = 'Please, indicate a source or a path'
+            return response
+
+        with self.bundles.use() as bundle:  # The same bundle from the parsing to the label
+            if 'source' in request:
+                status, codes = tokens.parse_source_units(request['source'], bundle.tolerance,
+                                                          codes=True)
+            else:
+                status, codes = tokens.parse_units(request['path'], bundle.tolerance,
+                                                   codes=True)
+            if status < 0:
+                response['error'] = 'The input could not be parsed'
+                return response
+            response['status'] = is_js.OUTPUT_TEXTS[status]
+
+            res = bundle.features(tokens.codes_to_numbers(codes))
+            if res is not None:
+                response['label'], response['proba'] = \
+                    self.batcher.submit(bundle, res[0], res[1]).result()
+        return response
+
+
+class ScoringHandler(socketserver.StreamRequestHandler):
+    """ Answers the requests of one client connection, in order. """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.scorer.score(json.loads(line.decode('utf-8')))
+            except Exception as err:  # e.g. malformed JSON
+                logging.exception('Invalid request')
+                response = {'error': str(err)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class ScoringServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Unix socket server handling each client connection in its own thread. """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, scorer):
+        if os.path.exists(socket_path):  # Left by a previous instance
+            os.remove(socket_path)
+        self.scorer = scorer
+        socketserver.UnixStreamServer.__init__(self, socket_path, ScoringHandler)
+
+
+def score_inputs(requests, socket_path=DEFAULT_SOCKET):
+    """
+        Client side: sends requests to a scoring server and returns its responses.
+
+        -------
+        Parameters:
+        - requests: list of dict
+            Requests of the protocol described in the module's docstring.
+        - socket_path: str
+            Path of the server's socket.
+
+        -------
+        Returns:
+        - list of dict
+            The responses, in the order of requests.
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(b''.join((json.dumps(request) + '\n').encode('utf-8')
+                                for request in requests))
+        responses = []
+        with client.makefile('rb') as answers:
+            for _ in requests:
+                responses.append(json.loads(answers.readline().decode('utf-8')))
+        return responses
+
+
+def parsing_commands(args=None):
+    """
+        Creation of an ArgumentParser object, holding all the information necessary to parse
+        the command line into Python data types.
+
+        -------
+        Returns:
+        - ArgumentParser such as:
+          * model=arg_obj['m'],
+          * socket_path=arg_obj['socket'],
+          * threshold=arg_obj['th'],
+          * batch_size=arg_obj['batch_size'],
+          * batch_wait=arg_obj['batch_wait'],
+          * parser_workers=arg_obj['parser_workers'],
+          * watch=arg_obj['watch'],
+          * tolerance=arg_obj['t'][0],
+          * n=arg_obj['n'][0].
+          A more thorough description can be obtained:
+            >$ python3 <path-of-clustering/scoring_server.py> -help
+    """
+
+    parser = argparse.ArgumentParser(description='Resident service classifying the JS inputs\
+    sent over a Unix socket as benign or malicious.')
+
+    parser.add_argument('--m', metavar='MODEL', type=str, nargs=1, required=True,
+                        help='path of the model used to classify the JS inputs')
+    parser.add_argument('--socket', metavar='PATH', type=str, nargs=1, default=[DEFAULT_SOCKET],
+                        help='path of the Unix socket to listen on')
+    parser.add_argument('--th', metavar='THRESHOLD', type=float, nargs=1, default=[0.29],
+                        help='threshold over which all samples are considered malicious')
+    parser.add_argument('--batch_size', metavar='INTEGER', type=int, nargs=1, default=[64],
+                        help='maximum number of inputs classified at once')
+    parser.add_argument('--batch_wait', metavar='MS', type=float, nargs=1, default=[2],
+                        help='time waited for other inputs before classifying a batch, in ms')
+    parser.add_argument('--parser_workers', metavar='INTEGER', type=int, nargs=1, default=[4],
+                        help='number of Node.js processes parsing the JS inputs')
+    parser.add_argument('--watch', metavar='SECONDS', type=float, nargs=1, default=[None],
+                        help='interval at which the model is checked, to be reloaded when '
+                             + 'it is stored again (e.g. by updater.py)')
+    utility.parsing_commands(parser)
+
+    return vars(parser.parse_args(args))
+
+
+def main_server(model, socket_path=DEFAULT_SOCKET, threshold=0.29, n=4, tolerance='false',
+                dict_not_hash=True, batch_size=64, batch_wait=2, parser_workers=4, timeout=60,
+                max_size=None, max_memory=None, watch=None):
+    """
+        Runs the scoring service until interrupted.
+
+        -------
+        Parameters:
+        - model: str
+            Path of the model used to classify the JS inputs.
+        - socket_path: str
+            Path of the Unix socket to listen on.
+        - threshold: float
+            Threshold over which all samples are considered malicious.
+        - n, tolerance, dict_not_hash
+            See static_analysis.main_analysis.
+        - batch_size: int
+            Maximum number of inputs classified at once.
+        - batch_wait: float
+            Time waited for other inputs before classifying a batch, in ms.
+        - parser_workers: int
+            Number of Node.js processes parsing the JS inputs.
+        - timeout, max_size, max_memory
+            Limits of the parsing of an input, see static_analysis.main_analysis.
+        - watch: float
+            Interval in seconds at which the model is checked, to be reloaded when it is stored
+            again. Default: None, i.e. the model is only reloaded on SIGHUP.
+    """
+
+    parser_pool.start_pool(parser_workers, timeout,
+                           None if max_size is None else int(max_size * 1024 * 1024),
+                           max_memory)
+    scorer = Scorer(model, n, tolerance, dict_not_hash, threshold, batch_size, batch_wait / 1000)
+    if watch is not None:
+        scorer.bundles.watch(watch)
+    signal.signal(signal.SIGHUP, lambda *_: scorer.bundles.reload_in_background())
+    server = ScoringServer(socket_path, scorer)
+    logging.info('Scoring service listening on ' + socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        scorer.close()
+        parser_pool.stop_pool()
+
+
+if __name__ == "__main__":  # Executed only if run as a script
+    arg_obj = parsing_commands()
+    utility.control_logger(arg_obj['v'][0])
+    main_server(arg_obj['m'][0], socket_path=arg_obj['socket'][0], threshold=arg_obj['th'][0],
+                n=arg_obj['n'][0], tolerance=arg_obj['t'][0],
+                dict_not_hash=arg_obj['dnh'][0] == 'True', batch_size=arg_obj['batch_size'][0],
+                batch_wait=arg_obj['batch_wait'][0], parser_workers=arg_obj['parser_workers'][0],
+                timeout=arg_obj['timeout'][0], max_size=arg_obj['max_size'][0],
+                max_memory=arg_obj['max_memory'][0], watch=arg_obj['watch'][0])
@@ -0,0 +1,162 @@
+"""
+    Random Forest stored as shards, so that it can be updated with new batches of JS inputs
+    without rewriting it (see updater.py).
+
+    A sharded model is a directory containing a manifest (shards.json) and one pickled forest
+    per shard, e.g. the trees trained on one batch. The forest used to classify is made of the
+    trees of every shard (see utility.load_model). Adding a shard only writes the new shard and
+    the manifest; once the forest exceeds its maximum number of trees, shards are evicted,
+    the oldest or the least accurate ones first.
+"""
+
+import os
+import json
+import time
+import fcntl
+import pickle
+import logging
+
+SHARDS_FILE = 'shards.json'
+FORMAT_VERSION = 1
+EVICTIONS = ['oldest', 'accuracy']
+
+
+def is_sharded(model_dir):
+    """ Indicates whether model_dir contains a sharded model. """
+
+    return os.path.isfile(os.path.join(model_dir, SHARDS_FILE))
+
+
+def load_manifest(model_dir):
+    """
+        Reads the manifest of a sharded model.
+
+        -------
+        Parameter:
+        - model_dir: str
+            Path of the sharded model.
+
+        -------
+        Returns:
+        - dict
+            * 'format': version of the format of the model;
+            * 'classes': classes of the forests;
+            * 'next_shard': number of the next shard added;
+            * 'shards': list of dict describing each shard, from the oldest: 'file', 'n_trees',
+            'n_samples' (number of files it was trained on), 'created' (timestamp) and
+            'accuracy' (on the last batch it was evaluated on, None if it never was).
+        - or None if model_dir contains no sharded model.
+    """
+
+    manifest_path = os.path.join(model_dir, SHARDS_FILE)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def load_shards(model_dir):
+    """
+        Loads the forest of each shard of a sharded model.
+
+        -------
+        Returns:
+        - list of tuples
+            (description of the shard in the manifest, forest), from the oldest shard.
+    """
+
+    manifest = load_manifest(model_dir)
+    shards = []
+    for shard in manifest['shards']:
+        with open(os.path.join(model_dir, shard['file']), 'rb') as shard_file:
+            shards.append((shard, pickle.load(shard_file)))
+    return shards
+
+
+def add_shard(model_dir, forest, n_samples=None, accuracies=None, max_trees=None,
+              eviction='oldest'):
+    """
+        Adds a forest to a sharded model, which is created if needed. Only the new shard and
+        the manifest are written.
+
+        -------
+        Parameters:
+        - model_dir: str
+            Path of the sharded model.
+        - forest: RandomForestClassifier
+            Trees of the new shard.
+        - n_samples: int
+            Number of files the forest was trained on. Default: None.
+        - accuracies: dict
+            File of a shard -> its accuracy on the last batch, to be stored in the manifest.
+            Default: None.
+        - max_trees: int
+            Maximum number of trees of the model. Default: None, i.e. no limit.
+        - eviction: str
+            Shards evicted first once the model has more than max_trees trees: 'oldest', or
+            'accuracy' for the least accurate ones (those never evaluated last, the oldest
+            first in case of a tie). The new shard is never evicted. Default: 'oldest'.
+
+        -------
+        Returns:
+        - list of str
+            Files of the shards evicted.
+    """
+
+    if eviction not in EVICTIONS:
+        raise ValueError('Unknown eviction policy: ' + str(eviction))
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+
+    with open(os.path.join(model_dir, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # Concurrent updates are applied one after the other
+
+        manifest = load_manifest(model_dir)
+        if manifest is None:
+            manifest = {'format': FORMAT_VERSION, 'classes': [str(c) for c in forest.classes_],
+                        'next_shard': 0, 'shards': []}
+        elif manifest['classes'] != [str(c) for c in forest.classes_]:
+            raise ValueError('The shards of ' + model_dir + ' classify into '
+                             + str(manifest['classes']) + ', the new one into '
+                             + str([str(c) for c in forest.classes_]))
+        for shard in manifest['shards']:
+            if accuracies is not None and shard['file'] in accuracies:
+                shard['accuracy'] = accuracies[shard['file']]
+
+        shard_file = 'shard-%06d.pkl' % manifest['next_shard']
+        shard_path = os.path.join(model_dir, shard_file)
+        with open(shard_path + '.tmp', 'wb') as model_file:
+            pickle.dump(forest, model_file)
+        os.replace(shard_path + '.tmp', shard_path)
+        manifest['next_shard'] += 1
+
+        evicted = []
+        if max_trees is not None:
+            nb_trees = sum(shard['n_trees'] for shard in manifest['shards']) + len(
+                forest.estimators_)
+            if eviction == 'oldest':
+                candidates = list(manifest['shards'])
+            else:
+                candidates = sorted(manifest['shards'], key=lambda shard: float('inf')
+                                    if shard['accuracy'] is None else shard['accuracy'])
+            for shard in candidates:
+                if nb_trees <= max_trees:
+                    break
+                manifest['shards'].remove(shard)
+                nb_trees -= shard['n_trees']
+                evicted.append(shard['file'])
+
+        manifest['shards'].append({'file': shard_file, 'n_trees': len(forest.estimators_),
+                                   'n_samples': n_samples, 'created': time.time(),
+                                   'accuracy': None})
+        tmp_path = os.path.join(model_dir, SHARDS_FILE + '.tmp')
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+        os.replace(tmp_path, os.path.join(model_dir, SHARDS_FILE))  # Atomic
+
+        for evicted_file in evicted:
+            os.remove(os.path.join(model_dir, evicted_file))
+
+    logging.debug('Shard of %d trees added to %s, %d shards evicted', len(forest.estimators_),
+                  model_dir, len(evicted))
+    return evicted
@@ -4,18 +4,20 @@
 """
 
 import os
-import pickle
 import argparse
 import logging
+import numpy as np
 
 import utility
 import static_analysis
+import sharded_model
 
 
 src_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
 
-def validate(labels_validation, attributes_validation, model, model_name, model_dir, add_trees=100):
+def validate(labels_validation, attributes_validation, model, model_name, model_dir, add_trees=100,
+             model_format='pickle', max_trees=None, eviction='oldest'):
     """
         Extension of a classification model with new attributes of the same format as the model's.
 
@@ -35,6 +37,11 @@ def validate(labels_validation, attributes_validation, model, model_name, model_
             Path to store the model that will be produced.
         - add_trees: int
             For RF, number of trees that will be added to the model. Default value: 100.
+        - model_format: str
+            Format of the model stored, see utility.save_model. Default value: 'pickle'.
+            With 'shards', the trees added are stored as a new shard (see validate_shards).
+        - max_trees, eviction
+            With model_format 'shards', see validate_shards.
 
         -------
         Returns:
@@ -42,8 +49,15 @@ def validate(labels_validation, attributes_validation, model, model_name, model_
             Beware: the model was implemented as a global variable in sklearn.
     """
 
-    if isinstance(model, str):
-        model = pickle.load(open(model, 'rb'))
+    if model_format == 'shards':
+        return validate_shards(labels_validation, attributes_validation, model,
+                               os.path.join(model_dir, model_name), add_trees, max_trees,
+                               eviction)
+
+    model = utility.load_model(model)
+    if not hasattr(model, 'fit'):
+        raise ValueError('A forest exported as arrays cannot be updated, please use the '
+                         + 'pickled model')
 
     # Directory to store the classification related files
     if not os.path.exists(model_dir):
@@ -55,12 +69,87 @@ def validate(labels_validation, attributes_validation, model, model_name, model_
     validated = model.fit(attributes_validation, labels_validation)  # RF
 
     model_path = os.path.join(model_dir, model_name)
-    pickle.dump(validated, open(model_path, 'wb'))
+    utility.save_model(validated, model_path, model_format)
     logging.info('The model has been successfully updated in ' + model_path)
 
     return validated
 
 
+def validate_shards(labels_validation, attributes_validation, model, model_path, add_trees=100,
+                    max_trees=None, eviction='oldest'):
+    """
+        Extension of a sharded model (see sharded_model): add_trees trees are trained on the
+        new attributes and stored as a new shard, the former shards being neither retrained
+        nor written again. Shards are evicted once the model has more than max_trees trees.
+
+        -------
+        Parameters:
+        - labels_validation, attributes_validation, add_trees
+            See validate.
+        - model: str or classifier
+            Model to be updated. Its trees (or shards) become the first shards of model_path
+            if model_path does not contain a sharded model yet; model must be model_path
+            otherwise.
+        - model_path: str
+            Directory of the sharded model updated.
+        - max_trees: int
+            Maximum number of trees of the model. Default: None, i.e. no limit.
+        - eviction: str
+            'oldest' or 'accuracy', see sharded_model.add_shard. With 'accuracy', every shard
+            is first evaluated on the new attributes. Default: 'oldest'.
+
+        -------
+        Returns:
+        - The model updated, see utility.load_model.
+    """
+
+    # The new shard classifies into the labels of the new files, which must be those of the
+    # model: checked before anything is written
+    new_classes = [str(c) for c in np.unique(labels_validation)]
+    if not sharded_model.is_sharded(model_path):
+        if isinstance(model, str) and sharded_model.is_sharded(model):
+            forests = [forest for _, forest in sharded_model.load_shards(model)]
+        else:
+            forests = [utility.load_model(model)]
+        if not hasattr(forests[0], 'fit'):
+            raise ValueError('A forest exported as arrays cannot be updated, please use the '
+                             + 'pickled model')
+        check_classes([str(c) for c in forests[0].classes_], new_classes)
+        for forest in forests:
+            sharded_model.add_shard(model_path, forest)
+    elif not isinstance(model, str) or not os.path.exists(model) \
+            or not os.path.samefile(model, model_path):
+        raise ValueError(model_path + ' already contains a sharded model, which is the only '
+                         + 'model it can be updated from')
+    else:
+        check_classes(sharded_model.load_manifest(model_path)['classes'], new_classes)
+
+    accuracies = None
+    if eviction == 'accuracy':  # On the newest files, e.g. to evict the trees of older trends
+        accuracies = {shard['file']: float(forest.score(attributes_validation,
+                                                        labels_validation))
+                      for shard, forest in sharded_model.load_shards(model_path)}
+
+    shard = utility.classifier_choice(estimators=add_trees)
+    shard.set_params(random_state=sharded_model.load_manifest(model_path)['next_shard'])
+    shard.fit(attributes_validation, labels_validation)
+    evicted = sharded_model.add_shard(model_path, shard, attributes_validation.shape[0],
+                                      accuracies, max_trees, eviction)
+    logging.info('The model has been successfully updated in %s (%d shards evicted)',
+                 model_path, len(evicted))
+
+    return utility.load_model(model_path)
+
+
+def check_classes(model_classes, new_classes):
+    """ Raises a ValueError if the new files are not labeled with the classes of the model. """
+
+    if model_classes != new_classes:
+        raise ValueError('The model classifies into ' + str(model_classes) + ' but the new '
+                         + 'files are labeled ' + str(new_classes) + ', a shard trained on '
+                         + 'them could not be combined with its trees')
+
+
 def parsing_commands():
     """
         Creation of an ArgumentParser object, holding all the information necessary to parse
@@ -77,6 +166,9 @@ def parsing_commands():
           * model_dir=arg_obj['md'][0],
           * model_name=arg_obj['mn'][0],
           * add_trees=arg_obj['at'][0],
+          * model_format=arg_obj['mf'][0],
+          * max_trees=arg_obj['mt'][0],
+          * eviction=arg_obj['ev'][0],
           * tolerance=arg_obj['t'][0],
           * n=arg_obj['n'][0].
           A more thorough description can be obtained:
@@ -107,6 +199,19 @@ def parsing_commands():
                         help='name of the model that will be produced')
     parser.add_argument('--at', metavar='NB_TREES', type=int, nargs=1,
                         default=[100], help='number of trees to be added into the forest')
+    parser.add_argument('--mf', metavar='MODEL-FORMAT', type=str, nargs=1, default=['pickle'],
+                        choices=['pickle', 'arrays', 'shards'],
+                        help='format of the model produced: pickle, arrays for a directory '
+                             + 'of memory-mappable arrays loading faster (but not updatable), '
+                             + 'or shards for a directory to which each update adds a shard '
+                             + 'of trees')
+    parser.add_argument('--mt', metavar='NB_TREES', type=int, nargs=1, default=[None],
+                        help='with --mf shards, maximum number of trees of the model')
+    parser.add_argument('--ev', metavar='EVICTION', type=str, nargs=1, default=['oldest'],
+                        choices=sharded_model.EVICTIONS,
+                        help='with --mf shards, shards evicted first once the model has too '
+                             + 'many trees: the oldest ones, or the least accurate ones on the '
+                             + 'new JS inputs')
     utility.parsing_commands(parser)
 
     return vars(parser.parse_args())
@@ -119,7 +224,12 @@ utility.control_logger(arg_obj['v'][0])
 def main_update(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=arg_obj['lf'],
                 labels_d=arg_obj['l'], old_model=arg_obj['m'], model_dir=arg_obj['md'],
                 model_name=arg_obj['mn'], n=arg_obj['n'][0], tolerance=arg_obj['t'][0],
-                add_trees=arg_obj['at'], dict_not_hash=arg_obj['dnh'][0]):
+                add_trees=arg_obj['at'], dict_not_hash=arg_obj['dnh'][0],
+                jobs=arg_obj['jobs'][0], cache=arg_obj['cache'][0],
+                cache_size=arg_obj['cache_size'][0],
+                timeout=arg_obj['timeout'][0], max_size=arg_obj['max_size'][0],
+                max_memory=arg_obj['max_memory'][0], model_format=arg_obj['mf'][0],
+                max_trees=arg_obj['mt'][0], eviction=arg_obj['ev'][0]):
     """
         Main function, performs a static analysis (syntactic) of JavaScript files given as input
         to extend an existing model to classify future JavaScript files.
@@ -153,6 +263,25 @@ def main_update(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=arg_obj['l
             Number of trees to be added into the forest.
         - dict_not_hash: Boolean
             True if a dictionary is used to map n-grams to int, False if hashes are used.
+        - jobs: int
+            Number of processes used to analyse the files.
+        - cache: str
+            Path of the SQLite file caching the syntactic units of the files analysed.
+        - cache_size: int
+            Maximum size of the previous cache, in MB.
+        - timeout: float
+            Number of seconds after which the parsing of a file is stopped.
+        - max_size: float
+            Size in MB over which a file is not parsed.
+        - max_memory: int
+            Memory in MB over which the parsing of a file is stopped.
+        - model_format: str
+            Format of the model produced: 'pickle', 'arrays' or 'shards' (see
+            utility.save_model).
+        - max_trees: int
+            With model_format 'shards', maximum number of trees of the model.
+        - eviction: str
+            With model_format 'shards', shards evicted first: 'oldest' or 'accuracy'.
         Default values are the ones given in the command lines or in the
         ArgumentParser object (function parsingCommands()).
 
@@ -186,7 +315,9 @@ def main_update(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=arg_obj['l
     else:
         names, attributes, labels = static_analysis.main_analysis\
             (js_dirs=js_dirs, labels_dirs=labels_d, js_files=js_files, labels_files=labels_f,
-             tolerance=tolerance, n=n, dict_not_hash=dict_not_hash)
+             tolerance=tolerance, n=n, dict_not_hash=dict_not_hash, jobs=jobs,
+             cache_path=cache, cache_size=cache_size, timeout=timeout, max_size=max_size,
+             max_memory=max_memory)
 
         if names:
             # Uncomment to save the analysis results in pickle objects.
@@ -197,7 +328,8 @@ def main_update(js_dirs=arg_obj['d'], js_files=arg_obj['f'], labels_f=arg_obj['l
             """
 
             validate(labels, attributes, model=old_model[0], add_trees=add_trees[0],
-                     model_name=model_name[0], model_dir=model_dir[0])
+                     model_name=model_name[0], model_dir=model_dir[0], model_format=model_format,
+                     max_trees=max_trees, eviction=eviction)
 
         else:
             logging.warning('No file found for the analysis.\n'
@@ -4,15 +4,31 @@
 """
 
 import os
-import logging
+import sys
+import csv
+import copy
+import json
 import pickle
+import logging
+from contextlib import contextmanager
 # import graphviz
 
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+from joblib import Parallel, delayed
 # from sklearn import tree
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import confusion_matrix
+from sklearn.utils import check_array
 
 import __init__
+import feature_store
+import forest_arrays
+import sharded_model
+
+TREES_BLOCK = 16384  # Number of samples whose per-tree probabilities are stacked at once
+RESULTS_BLOCK = 65536  # Number of lines of results formatted and written at once
+RESULTS_BUFFER = 1024 * 1024  # Size of the buffer of the files of results, in bytes
 
 
 def classifier_choice(estimators=500):
@@ -28,6 +44,86 @@ def classifier_choice(estimators=500):
     return RandomForestClassifier(n_estimators=estimators, max_depth=50, random_state=0, n_jobs=-1)
 
 
+def load_model(model):
+    """
+        Loads a model, be it a forest exported by forest_arrays.export_forest, a sharded model
+        (see sharded_model) or a pickled model.
+
+        -------
+        Parameter:
+        - model: str
+            Path of the model. Models already loaded are returned as they are.
+
+        -------
+        Returns:
+        - Model to be used to classify new observations.
+    """
+
+    if not isinstance(model, str):
+        return model
+    if forest_arrays.is_forest(model):
+        return forest_arrays.load_forest(model)
+    if sharded_model.is_sharded(model):
+        return merge_forests([forest for _, forest in sharded_model.load_shards(model)])
+    return pickle.load(open(model, 'rb'))
+
+
+def save_model(model, model_path, model_format='pickle'):
+    """
+        Stores a model.
+
+        -------
+        Parameters:
+        - model
+            Model to be stored.
+        - model_path: str
+            Path of the model (a directory for the formats 'arrays' and 'shards').
+        - model_format: str
+            'pickle' to pickle the model, 'arrays' to export the forest as memory-mappable
+            arrays (see forest_arrays), which loads faster but cannot be updated, 'shards' for
+            a sharded model (see sharded_model) whose only shard is the model, updated by
+            adding shards. Default: 'pickle'.
+    """
+
+    if model_format == 'arrays':
+        forest_arrays.export_forest(model, model_path)
+    elif model_format == 'shards':  # The shards of a former model are evicted
+        sharded_model.add_shard(model_path, model, max_trees=len(model.estimators_))
+    else:
+        # Replaced at once, for the processes reloading it (see model_bundle) not to read it
+        # while it is being written
+        with open(model_path + '.tmp', 'wb') as model_file:
+            pickle.dump(model, model_file)
+        os.replace(model_path + '.tmp', model_path)
+
+
+def merge_forests(forests):
+    """
+        Gathers the trees of several forests into one, e.g. forests trained on different
+        samples which do not fit in memory together.
+
+        -------
+        Parameter:
+        - forests: list of RandomForestClassifier
+            Forests trained on the same features and classes.
+
+        -------
+        Returns:
+        - RandomForestClassifier
+            Copy of the first forest, with the trees of every forest in their order.
+    """
+
+    for forest in forests[1:]:
+        if list(forest.classes_) != list(forests[0].classes_) \
+                or forest.n_features_in_ != forests[0].n_features_in_:
+            raise ValueError('Only forests trained on the same features and classes can be '
+                             + 'merged')
+    merged = copy.copy(forests[0])
+    merged.estimators_ = [tree for forest in forests for tree in forest.estimators_]
+    merged.n_estimators = len(merged.estimators_)
+    return merged
+
+
 def predict_labels_using_threshold(names_length, labels_predicted_proba, threshold):
     """
         Perform classification on the files 'names' using a threshold (probability of the sample
@@ -50,17 +146,15 @@ def predict_labels_using_threshold(names_length, labels_predicted_proba, thresho
             Contains the predicted labels of the files being analysed.
     """
 
-    labels_predicted_test = ['benign' for _ in range(names_length)]
-    for i, _ in enumerate(labels_predicted_test):
-        if labels_predicted_proba[i, 1] >= threshold:  # If the proba of the sample being malicious
-            # is over the threshold...
-            labels_predicted_test[i] = 'malicious'  # ... we classify the sample as malicious.
-
-    return labels_predicted_test
+    # If the proba of the sample being malicious is over the threshold, we classify the sample
+    # as malicious.
+    malicious = np.asarray(labels_predicted_proba)[:names_length, 1] >= threshold
+    return np.where(malicious, 'malicious', 'benign').tolist()
 
 
 def get_classification_results_verbose(names, labels, labels_predicted, labels_predicted_proba,
-                                       model, attributes, threshold):
+                                       model, attributes, threshold, output_format='text',
+                                       output=None, header=True):
     """
         Print in stdout the classification results of the files 'names' after our analysis.
         Format: 'Name: labelPredicted (trueLabel) Probability[benign, malicious] majorityVoteTrees'
@@ -83,19 +177,19 @@ def get_classification_results_verbose(names, labels, labels_predicted, labels_p
         - threshold: float
             Probability of a sample being malicious over which the sample will be classified
             as malicious.
+        - output_format, output, header
+            See write_classification_results.
     """
 
     counts_of_same_predictions = get_nb_trees_specific_label(model, attributes,
                                                              labels, labels_predicted, threshold)
-    nb_trees = len(model.estimators_)
-    for i, _ in enumerate(names):
-        print(str(names[i]) + ': ' + str(labels_predicted[i]) + ' ('
-              + str(labels[i]) + ') ' + 'Proba: ' + str(labels_predicted_proba[i])
-              + ' Majority: ' + str(counts_of_same_predictions[i]) + '/' + str(nb_trees))
-    print('> Name: labelPredicted (trueLabel) Probability[benign, malicious] majorityVoteTrees')
+    write_classification_results(names, labels_predicted, labels, labels_predicted_proba,
+                                 counts_of_same_predictions, len(model.estimators_),
+                                 output_format, output, header)
 
 
-def get_classification_results(names, labels_predicted):
+def get_classification_results(names, labels_predicted, output_format='text', output=None,
+                               header=True):
     """
         Print in stdout the classification results of the files 'names' after our analysis.
         Format: 'Name: labelPredicted (trueLabel)'
@@ -106,11 +200,103 @@ def get_classification_results(names, labels_predicted):
             Contains the path of the files being analysed.
         - labels_predicted: list
             Contains the predicted labels of the files being analysed.
+        - output_format, output, header
+            See write_classification_results.
     """
 
-    for i, _ in enumerate(names):
-        print(str(names[i]) + ': ' + str(labels_predicted[i]))
-    print('> Name: labelPredicted')
+    write_classification_results(names, labels_predicted, output_format=output_format,
+                                 output=output, header=header)
+
+
+def write_classification_results(names, labels_predicted, labels=None,
+                                 labels_predicted_proba=None, counts_of_same_predictions=None,
+                                 nb_trees=None, output_format='text', output=None, header=True):
+    """
+        Writes the classification results of the files 'names', RESULTS_BLOCK lines at a time.
+        With labels (verbose results), their true label, their probability of being benign and
+        malicious and the number of trees agreeing with the forest are written too.
+
+        -------
+        Parameters:
+        - names, labels_predicted, labels, labels_predicted_proba
+            See get_classification_results_verbose.
+        - counts_of_same_predictions: list
+            See get_nb_trees_specific_label.
+        - nb_trees: int
+            Number of trees of the forest.
+        - output_format: str
+            'text' (format of get_classification_results(_verbose)), 'csv' or 'jsonl'.
+            Default: 'text'.
+        - output: file object
+            Where to write the results. Default: None, i.e. stdout.
+        - header: bool
+            Whether to write the CSV header, e.g. False for the following chunks of a same
+            classification. Default: True.
+    """
+
+    output = output or sys.stdout
+    verbose = labels is not None
+    if verbose:
+        proba = np.asarray(labels_predicted_proba)
+        proba_list = proba.tolist()
+    if output_format == 'csv':
+        writer = csv.writer(output)
+        if header:
+            writer.writerow(['name', 'label_predicted'] + (['label', 'proba_benign',
+                                                            'proba_malicious', 'majority',
+                                                            'nb_trees'] if verbose else []))
+
+    for start in range(0, len(names), RESULTS_BLOCK):
+        stop = min(start + RESULTS_BLOCK, len(names))
+        if output_format == 'csv':
+            if verbose:
+                writer.writerows([names[i], labels_predicted[i], labels[i], proba_list[i][0],
+                                  proba_list[i][1], counts_of_same_predictions[i], nb_trees]
+                                 for i in range(start, stop))
+            else:
+                writer.writerows(zip(names[start:stop], labels_predicted[start:stop]))
+            continue
+
+        if output_format == 'jsonl':
+            if verbose:
+                lines = [json.dumps({'name': names[i], 'label_predicted': labels_predicted[i],
+                                     'label': labels[i], 'proba': proba_list[i],
+                                     'majority': counts_of_same_predictions[i],
+                                     'nb_trees': nb_trees}) for i in range(start, stop)]
+            else:
+                lines = [json.dumps({'name': names[i], 'label_predicted': labels_predicted[i]})
+                         for i in range(start, stop)]
+        elif verbose:
+            lines = [str(names[i]) + ': ' + str(labels_predicted[i]) + ' (' + str(labels[i])
+                     + ') ' + 'Proba: ' + str(proba[i]) + ' Majority: '
+                     + str(counts_of_same_predictions[i]) + '/' + str(nb_trees)
+                     for i in range(start, stop)]
+        else:
+            lines = [str(names[i]) + ': ' + str(labels_predicted[i])
+                     for i in range(start, stop)]
+        output.write('\n'.join(lines) + '\n')
+
+    if output_format == 'text':
+        if verbose:
+            output.write('> Name: labelPredicted (trueLabel) Probability[benign, malicious] '
+                         + 'majorityVoteTrees\n')
+        else:
+            output.write('> Name: labelPredicted\n')
+    output.flush()
+
+
+@contextmanager
+def results_output(path=None):
+    """
+        Context manager opening the file in which to write the classification results, with a
+        large buffer. Yields sys.stdout if path is None.
+    """
+
+    if path is None:
+        yield sys.stdout
+    else:
+        with open(path, 'w', newline='', buffering=RESULTS_BUFFER) as output:
+            yield output
 
 
 def get_score(labels, labels_predicted):
@@ -143,7 +329,8 @@ def get_score(labels, labels_predicted):
             logging.exception(error_message)
 
 
-def get_nb_trees_specific_label(model, attributes, labels, labels_predicted, threshold):
+def get_nb_trees_specific_label(model, attributes, labels, labels_predicted, threshold,
+                                jobs=None):
     """
         Get the number of trees which gave the same prediction as the one of the whole forest.
 
@@ -160,32 +347,78 @@ def get_nb_trees_specific_label(model, attributes, labels, labels_predicted, thr
         - threshold: float
             Probability of a sample being malicious over which the sample will be classified
             as malicious.
+        - jobs: int
+            Number of threads evaluating the trees. Default: None, i.e. model.n_jobs.
+
+        -------
+        Returns:
+        - list
+            Number of trees which gave the same prediction as the forest, for each sample.
+    """
+
+    attributes = trees_input(attributes)
+    forest_malicious = np.asarray(labels_predicted) == 'malicious'
+    counts_of_same_predictions = np.zeros(len(labels), dtype=np.int64)
+    for start in range(0, attributes.shape[0], TREES_BLOCK):
+        stop = min(start + TREES_BLOCK, attributes.shape[0])
+        trees_malicious = trees_malicious_proba(model, attributes[start:stop], jobs) >= threshold
+        # Trees predicting the same class as the forest
+        counts_of_same_predictions[start:stop] = (trees_malicious
+                                                  == forest_malicious[start:stop]).sum(axis=0)
 
+    return counts_of_same_predictions.tolist()
+
+
+def trees_input(attributes):
+    """
+        Converts attributes into the input expected by the trees of a forest when they do not
+        check it (float32, and CSR matrix with int32 indices if sparse).
+    """
+
+    attributes = check_array(attributes, accept_sparse='csr', dtype=np.float32)
+    if issparse(attributes) and (attributes.indices.dtype != np.intc
+                                 or attributes.indptr.dtype != np.intc):
+        attributes = csr_matrix((attributes.data, attributes.indices.astype(np.intc),
+                                 attributes.indptr.astype(np.intc)), shape=attributes.shape)
+    return attributes
+
+
+def trees_malicious_proba(model, attributes, jobs=None):
+    """
+        Probability of the samples being malicious according to each tree of a forest. The
+        trees are evaluated in parallel threads, as their prediction releases the GIL, or with
+        a single traversal for a forest exported as arrays (see forest_arrays).
+
+        -------
+        Parameters:
+        - model
+            Forest (with estimators_) to be used to classify new observations.
+        - attributes: csr_matrix
+            Features of the data considered, converted by trees_input.
+        - jobs: int
+            Number of threads. Default: None, i.e. model.n_jobs.
+
+        -------
+        Returns:
+        - np.array
+            Of shape (number of trees, number of samples).
     """
 
-    # Initialize a vector to hold counts of trees that gave the same class as in labels_predicted
-    counts_of_same_predictions = [0 for _, _ in enumerate(labels)]
-    # i = 0
-    for each_tree in model.estimators_:
-        single_tree_predictions_proba = each_tree.predict_proba(attributes)
-        single_tree_predictions = predict_labels_using_threshold(len(labels),
-                                                                 single_tree_predictions_proba,
-                                                                 threshold)
-        # Check if predictions are the same with the global (forest's) predictions
-        for j, _ in enumerate(single_tree_predictions):
-            if single_tree_predictions[j] == labels_predicted[j]:
-                counts_of_same_predictions[j] += 1
+    trees_proba = np.empty((len(model.estimators_), attributes.shape[0]))
+    if isinstance(model, forest_arrays.ArrayForest):  # All the trees traversed at once
+        for leaves, start, stop in model.apply(attributes):
+            trees_proba[:, start:stop] = model.value[leaves, 1].T
+        return trees_proba
 
-        """
-        dot_data = tree.export_graphviz(each_tree, out_file=None, special_characters=True,
-                                        class_names=['benign', 'malicious'], filled=True,
-                                        rounded=True, proportion=True)
-        graph = graphviz.Source(dot_data)
-        graph.render("SingleTree-" + str(i))
-        i += 1
-        """
+    if jobs is None:
+        jobs = getattr(model, 'n_jobs', None)
 
-    return counts_of_same_predictions
+    def predict_proba(i, each_tree):
+        trees_proba[i] = each_tree.predict_proba(attributes, check_input=False)[:, 1]
+
+    Parallel(n_jobs=jobs, require='sharedmem')(
+        delayed(predict_proba)(i, each_tree) for i, each_tree in enumerate(model.estimators_))
+    return trees_proba
 
 
 def parsing_commands(parser):
@@ -214,6 +447,18 @@ def parsing_commands(parser):
     parser.add_argument('--v', metavar='VERBOSITY', type=int, nargs=1, choices=[0, 1, 2, 3, 4, 5],
                         default=[2], help='controls the verbosity of the output, from 0 (verbose) '
                                           + 'to 5 (less verbose)')
+    parser.add_argument('--jobs', metavar='INTEGER', type=int, nargs=1, default=[1],
+                        help='number of processes used to analyze the files')
+    parser.add_argument('--cache', metavar='FILE', type=str, nargs=1, default=[None],
+                        help='SQLite file caching the syntactic units of the files analyzed')
+    parser.add_argument('--cache_size', metavar='MB', type=int, nargs=1, default=[1024],
+                        help='maximum size of the cache of syntactic units, in MB')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, nargs=1, default=[60],
+                        help='time after which the parsing of a file is stopped')
+    parser.add_argument('--max_size', metavar='MB', type=float, nargs=1, default=[None],
+                        help='size over which a file is not parsed')
+    parser.add_argument('--max_memory', metavar='MB', type=int, nargs=1, default=[None],
+                        help='memory over which the parsing of a file is stopped')
 
     return parser
 
@@ -232,9 +477,10 @@ def control_logger(logging_level):
                         level=logging.getLevelName(logging_level * 10))
 
 
-def save_analysis_results(save_dir, names, attributes, labels):
+def save_analysis_results(save_dir, names, attributes, labels, append=False):
     """
-        Save the results of a previous analysis, i.e. files name, attributes and label.
+        Save the results of a previous analysis, i.e. files name, attributes and label, in a
+        chunked store (see feature_store) which can be loaded without copy.
 
         -------
         Parameters:
@@ -246,14 +492,13 @@ def save_analysis_results(save_dir, names, attributes, labels):
             Labels (i.e. 'benign', 'malicious',or '?') of the data considered.
         - attributes: csr_matrix
             Features of the data considered.
+        - append: bool
+            Whether to add the results to the ones already stored in save_dir, as a new chunk,
+            instead of replacing them. Default: False.
     """
 
-    # Directory to store the classification related files
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
-
-    pickle.dump(names, open(os.path.join(save_dir, 'Names'), 'wb'))
-    pickle.dump(attributes, open(os.path.join(save_dir, 'Attributes'), 'wb'))
-    pickle.dump(labels, open(os.path.join(save_dir, 'Labels'), 'wb'))
+    if not append:
+        feature_store.remove_store(save_dir)
+    feature_store.append_chunk(save_dir, names, attributes, labels)
 
     logging.info('The results of the analysis have been successfully stored in ' + save_dir)
@@ -0,0 +1,319 @@
+#!/usr/bin/python
+
+"""
+    asyncio version of the static analysis of static_analysis.py, to be used from an event loop
+    (e.g. a crawler) without threads: K Node.js workers (features/parsing/parser_worker.js,
+    started with asyncio.create_subprocess_exec) parse the inputs while the event loop computes
+    the features of the inputs already parsed.
+"""
+
+import os
+import struct
+import asyncio
+import logging
+from collections import deque, Counter
+from itertools import count, repeat
+
+import numpy as np
+
+import ngrams_handling
+import tokens
+import parser_pool
+import static_analysis
+import is_js
+
+
+class AsyncParserWorker:
+    """
+        One Node.js process running parser_worker.js (see parser_pool.ParserWorker), answering
+        one request at a time.
+    """
+
+    def __init__(self, timeout=60, max_memory=None):
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.process = None
+        self.interrupted = False  # Whether a request was cancelled while being answered
+
+    async def start(self):
+        """ Launches the Node.js process. """
+
+        command = is_js.node_command(parser_pool.WORKER_PATH, self.max_memory)
+        self.process = await asyncio.create_subprocess_exec(
+            *command, parser_pool.UNITS_CODES, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        self.interrupted = False
+
+    async def stop(self):
+        """ Kills the Node.js process. """
+
+        if self.process is not None:
+            if self.process.returncode is None:
+                self.process.kill()
+            await self.process.wait()
+            self.process = None
+
+    async def exchange(self, message):
+        """ Sends a request and reads the worker's answer. """
+
+        self.process.stdin.write(message)
+        await self.process.stdin.drain()
+        header = await self.process.stdout.readexactly(4)
+        return await self.process.stdout.readexactly(struct.unpack('>I', header)[0])
+
+    async def request(self, kind, data, tolerance):
+        """
+            Sends a file path or a JS source to the worker and waits for the codes of its
+            syntactic units, see parser_pool.ParserWorker.request (mode b'c').
+        """
+
+        if self.interrupted:  # Its answer to the cancelled request may still come
+            await self.stop()
+            await self.start()
+
+        flag = b'1' if tolerance == 'true' else b'0'
+        message = struct.pack('>I', len(data) + 3) + kind + flag + b'c' + data
+        try:
+            body = await asyncio.wait_for(self.exchange(message), self.timeout)
+            return body[0], body[1:]
+        except asyncio.CancelledError:
+            self.interrupted = True
+            raise
+        except asyncio.TimeoutError:
+            returncode = None
+        except (asyncio.IncompleteReadError, ConnectionError):  # The worker died
+            returncode = await self.process.wait()
+
+        status = parser_pool.failure_status(returncode)
+        await self.stop()
+        await self.start()
+        return status, None
+
+
+class AsyncParserPool:
+    """
+        Pool of AsyncParserWorker objects, shared by the tasks of an event loop.
+        To be used as: async with AsyncParserPool(...) as pool.
+    """
+
+    def __init__(self, nb_workers=4, timeout=60, max_size=None, max_memory=None):
+        """
+            -------
+            Parameters:
+            - nb_workers, timeout, max_size, max_memory
+                See parser_pool.ParserPool.
+        """
+
+        self.nb_workers = max(1, nb_workers)
+        self.timeout = timeout
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self.idle_workers = None
+
+    async def start(self):
+        """ Launches the Node.js processes. """
+
+        self.idle_workers = asyncio.Queue()
+        for _ in range(self.nb_workers):
+            worker = AsyncParserWorker(self.timeout, self.max_memory)
+            await worker.start()
+            self.idle_workers.put_nowait(worker)
+
+    async def close(self):
+        """ Stops every worker of the pool, once they are idle. """
+
+        for _ in range(self.nb_workers):
+            await (await self.idle_workers.get()).stop()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def parse(self, given_file=None, source=None, tolerance='false'):
+        """
+            Parses either a file or JS source with a worker of the pool, see
+            parser_pool.ParserPool.parse.
+
+            -------
+            Returns:
+            - tuple (int, np.array)
+                Error code as returned by is_js.is_js_file (-1 on a system error) and the codes
+                of the syntactic units found (uint8) if the input is valid, None otherwise.
+        """
+
+        if given_file is not None:
+            kind, data = b'f', os.fsencode(given_file)
+            try:
+                size = os.path.getsize(given_file)
+            except OSError:
+                size = 0  # The worker reports the file as not JS
+        else:
+            kind, data = b's', source.encode('utf-8') if isinstance(source, str) else source
+            size = len(data)
+        if self.max_size is not None and size > self.max_size:
+            return is_js.TOO_LARGE, None
+
+        worker = await self.idle_workers.get()
+        try:
+            status, payload = await worker.request(kind, data, tolerance)
+        finally:
+            self.idle_workers.put_nowait(worker)
+
+        if status == 0:
+            return 0, np.frombuffer(payload, dtype=np.uint8)
+        if status not in (1, 2) and given_file is not None:
+            logging.error('The file <' + given_file + '> could not be parsed: '
+                          + is_js.status_text(status))
+        return status, None
+
+
+async def iter_inputs_analysis_async(inputs, n, tolerance, dict_not_hash, parser_workers=4,
+                                     chunk_size=10000, timeout=60, max_size=None,
+                                     max_memory=None):
+    """
+        asyncio version of static_analysis.iter_inputs_analysis. At most twice as many inputs
+        as there are workers are being parsed at a time, so that the inputs are consumed as
+        fast as the results are used. Each analysis has its own vocabulary and parsing
+        statistics, so that several analyses can run concurrently in the same event loop.
+
+        -------
+        Parameters:
+        - inputs: iterable or asynchronous iterable of tuples
+            (name, kind, input, label) for each input, kind being 'file' if input is the path
+            of a JS file and 'source' if it is JS source (bytes or str).
+        - n, tolerance, dict_not_hash, timeout, max_size, max_memory
+            See static_analysis.main_analysis.
+        - parser_workers: int
+            Number of Node.js processes parsing the inputs concurrently. Default: 4.
+        - chunk_size: int
+            See static_analysis.iter_analysis.
+
+        -------
+        Returns:
+        - asynchronous generator
+            Yields lists [names, attributes, labels] as returned by
+            static_analysis.main_analysis, the inputs being in their original order.
+    """
+
+    vocabulary = ngrams_handling.open_vocabulary(n) if dict_not_hash else None
+    n_features = ngrams_handling.nb_features(n)
+    stats = Counter()  # Error code -> number of inputs
+    max_size_bytes = None if max_size is None else int(max_size * 1024 * 1024)
+
+    inputs = inputs.__aiter__() if hasattr(inputs, '__aiter__') else _aiter(inputs)
+
+    try:
+        async with AsyncParserPool(parser_workers, timeout, max_size_bytes,
+                                   max_memory) as pool:
+            in_flight = deque()  # Inputs being parsed, in order: (name, label, task)
+            window = 2 * pool.nb_workers
+            exhausted = False
+            try:
+                tab_res = [[], ngrams_handling.CsrBuilder(n_features), []]
+                while True:
+                    while not exhausted and len(in_flight) < window:
+                        try:
+                            name, kind, js_input, label = await inputs.__anext__()
+                        except StopAsyncIteration:
+                            exhausted = True
+                            break
+                        if kind == 'file':
+                            parsing = pool.parse(given_file=js_input, tolerance=tolerance)
+                        else:
+                            parsing = pool.parse(source=js_input, tolerance=tolerance)
+                        in_flight.append((name, label, asyncio.ensure_future(parsing)))
+                    if not in_flight:
+                        break
+
+                    # The features of an input are computed while the next ones are parsed
+                    name, label, task = in_flight.popleft()
+                    status, codes = await task
+                    stats[status] += 1
+                    res = static_analysis.numbers_features(tokens.codes_to_numbers(codes), n,
+                                                           dict_not_hash, n_features)
+                    if dict_not_hash:
+                        res = ngrams_handling.dict_proba_of_codes(
+                            res[0], res[1], res[2], n, vocabulary)
+                    if res is not None:
+                        tab_res[0].append(name)
+                        tab_res[1].add_row(res[0], res[1])
+                        tab_res[2].append(label)
+                        if chunk_size is not None and len(tab_res[0]) >= chunk_size:
+                            yield [tab_res[0], tab_res[1].to_csr(), tab_res[2]]
+                            tab_res = [[], ngrams_handling.CsrBuilder(n_features), []]
+                if tab_res[0]:
+                    yield [tab_res[0], tab_res[1].to_csr(), tab_res[2]]
+
+            finally:  # If the consumer stopped early, the workers finish their input first
+                await asyncio.gather(*(task for _, _, task in in_flight),
+                                     return_exceptions=True)
+
+    finally:
+        static_analysis.log_parsing_stats(stats)
+        if vocabulary is not None:
+            vocabulary.close()
+
+
+async def _aiter(iterable):
+    """ Asynchronous iterator over a (synchronous) iterable. """
+
+    for element in iterable:
+        yield element
+
+
+async def _collect(chunks):
+    """ Result of a whole analysis, given its asynchronous generator with chunk_size None. """
+
+    chunks = [chunk async for chunk in chunks]
+    if chunks:
+        return chunks[0]
+    return [[], None, []]
+
+
+async def main_analysis_async(js_dirs, js_files, labels_files, labels_dirs, n, tolerance,
+                              dict_not_hash, parser_workers=4, timeout=60, max_size=None,
+                              max_memory=None):
+    """
+        asyncio version of static_analysis.main_analysis, with the same parameters and results.
+        parser_workers Node.js processes parse the files concurrently. Default: 4.
+    """
+
+    if js_dirs is None and js_files is None:
+        logging.error('Please, indicate a directory or a JS file to be studied')
+        return None
+
+    inputs = ((cfile, 'file', cfile, label) for cfile, label in
+              static_analysis.files_to_analyse(js_dirs, js_files, labels_files, labels_dirs))
+    return await _collect(iter_inputs_analysis_async(inputs, n, tolerance, dict_not_hash,
+                                                     parser_workers, None, timeout, max_size,
+                                                     max_memory))
+
+
+async def analyze_sources_async(sources, n, tolerance, dict_not_hash, names=None, labels=None,
+                                parser_workers=4, timeout=60, max_size=None, max_memory=None):
+    """
+        asyncio version of static_analysis.analyze_sources, with the same parameters and
+        results. sources may also be an asynchronous iterable, e.g. the scripts of a crawler,
+        which are then consumed as they are produced.
+    """
+
+    if names is None:
+        names = count()
+    if labels is None:
+        labels = repeat('?')
+    names, labels = iter(names), iter(labels)
+
+    async def inputs():
+        if hasattr(sources, '__aiter__'):
+            async for source in sources:
+                yield next(names), 'source', source, next(labels)
+        else:
+            for source in sources:
+                yield next(names), 'source', source, next(labels)
+
+    return await _collect(iter_inputs_analysis_async(inputs(), n, tolerance, dict_not_hash,
+                                                     parser_workers, None, timeout, max_size,
+                                                     max_memory))
@@ -0,0 +1,343 @@
+"""
+    Chunked on-disk storage of the results of a static analysis (files name, attributes and
+    labels, see static_analysis.main_analysis).
+
+    A store is a directory containing a manifest (manifest.json) and one subdirectory per chunk
+    of results, in which:
+    - the CSR matrix of the attributes is stored as data.npy, indices.npy and indptr.npy;
+    - the files name are stored in utf-8 in names.bin, names_offsets.npy indicating where each
+    name starts and ends;
+    - the labels are stored in labels.npy, as indices of the manifest's list of labels (uint8,
+    or wider if the store has more than 256 labels when the chunk is added).
+    The .npy files can be memory-mapped, and adding a chunk does not rewrite the previous ones.
+"""
+
+import os
+import json
+import fcntl
+import shutil
+import logging
+import numpy as np
+from scipy.sparse import csr_matrix, issparse, vstack
+
+MANIFEST = 'manifest.json'
+FORMAT_VERSION = 1
+
+
+def load_manifest(store_dir):
+    """
+        Reads the manifest of a store.
+
+        -------
+        Parameter:
+        - store_dir: str
+            Path of the store.
+
+        -------
+        Returns:
+        - dict
+            * 'format': version of the format of the store;
+            * 'n_features': number of columns of the attributes;
+            * 'labels': list of the labels, labels.npy containing indices of this list;
+            * 'nb_rows': total number of files stored;
+            * 'chunks': list of dict describing each chunk ('dir', 'nb_rows', 'nnz').
+        - or None if store_dir contains no store.
+    """
+
+    manifest_path = os.path.join(store_dir, MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def is_store(store_dir):
+    """ Indicates whether store_dir contains a store. """
+
+    return os.path.isfile(os.path.join(store_dir, MANIFEST))
+
+
+def append_chunk(store_dir, names, attributes, labels):
+    """
+        Adds the results of an analysis to a store, which is created if needed.
+        Only the new chunk and the manifest are written.
+
+        -------
+        Parameters:
+        - store_dir: str
+            Path of the store.
+        - names: list
+            Name of the data files considered.
+        - attributes: csr_matrix
+            Features of the data considered.
+        - labels: list
+            Labels (i.e. 'benign', 'malicious',or '?') of the data considered.
+
+        -------
+        Returns:
+        - int
+            Index of the new chunk.
+    """
+
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    if not issparse(attributes):
+        attributes = csr_matrix(np.asarray(attributes))
+    attributes = csr_matrix(attributes)
+    attributes.sort_indices()
+
+    with open(os.path.join(store_dir, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # Concurrent writers append one after the other
+
+        manifest = load_manifest(store_dir)
+        if manifest is None:
+            manifest = {'format': FORMAT_VERSION, 'n_features': attributes.shape[1],
+                        'labels': [], 'nb_rows': 0, 'chunks': []}
+        elif manifest['n_features'] != attributes.shape[1]:
+            raise ValueError('The store ' + store_dir + ' contains attributes with '
+                             + str(manifest['n_features']) + ' columns, not '
+                             + str(attributes.shape[1]))
+
+        for label in labels:
+            if label not in manifest['labels']:
+                manifest['labels'].append(label)
+        label_codes = {label: i for i, label in enumerate(manifest['labels'])}
+
+        chunk_nb = len(manifest['chunks'])
+        chunk_name = 'chunk-%06d' % chunk_nb
+        chunk_dir = os.path.join(store_dir, chunk_name)
+        if not os.path.exists(chunk_dir):
+            os.makedirs(chunk_dir)
+
+        np.save(os.path.join(chunk_dir, 'data.npy'), attributes.data)
+        np.save(os.path.join(chunk_dir, 'indices.npy'), attributes.indices)
+        np.save(os.path.join(chunk_dir, 'indptr.npy'), attributes.indptr)
+
+        encoded_names = [str(name).encode('utf-8') for name in names]
+        offsets = np.zeros(len(encoded_names) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(name) for name in encoded_names])
+        with open(os.path.join(chunk_dir, 'names.bin'), 'wb') as names_file:
+            names_file.write(b''.join(encoded_names))
+        np.save(os.path.join(chunk_dir, 'names_offsets.npy'), offsets)
+        # Each chunk has its own type, the chunks written before new labels keeping theirs
+        np.save(os.path.join(chunk_dir, 'labels.npy'),
+                np.array([label_codes[label] for label in labels],
+                         dtype=labels_dtype(len(manifest['labels']))))
+
+        manifest['chunks'].append({'dir': chunk_name, 'nb_rows': attributes.shape[0],
+                                   'nnz': int(attributes.nnz)})
+        manifest['nb_rows'] += attributes.shape[0]
+        tmp_path = os.path.join(store_dir, MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+        os.replace(tmp_path, os.path.join(store_dir, MANIFEST))  # Atomic
+
+    logging.debug('Chunk %d of %d files added to %s', chunk_nb, attributes.shape[0], store_dir)
+    return chunk_nb
+
+
+def labels_dtype(nb_labels):
+    """ Smallest integer type of the indices of nb_labels labels. """
+
+    if nb_labels <= 1 << 8:
+        return np.uint8
+    if nb_labels <= 1 << 16:
+        return np.uint16
+    return np.int32
+
+
+def load_chunk(store_dir, chunk_nb, mmap=True, manifest=None):
+    """
+        Loads a chunk of a store.
+
+        -------
+        Parameters:
+        - store_dir: str
+            Path of the store.
+        - chunk_nb: int
+            Index of the chunk.
+        - mmap: bool
+            Whether the arrays of the CSR matrix are memory-mapped (read-only) instead of
+            being read. Default: True.
+        - manifest: dict
+            Manifest of the store, read if not given.
+
+        -------
+        Returns:
+        - list
+            [names, attributes, labels], as returned by static_analysis.main_analysis.
+    """
+
+    if manifest is None:
+        manifest = load_manifest(store_dir)
+    chunk = manifest['chunks'][chunk_nb]
+    chunk_dir = os.path.join(store_dir, chunk['dir'])
+    mmap_mode = 'r' if mmap else None
+
+    data = np.load(os.path.join(chunk_dir, 'data.npy'), mmap_mode=mmap_mode)
+    indices = np.load(os.path.join(chunk_dir, 'indices.npy'), mmap_mode=mmap_mode)
+    indptr = np.load(os.path.join(chunk_dir, 'indptr.npy'), mmap_mode=mmap_mode)
+    attributes = csr_matrix((data, indices, indptr), copy=False,
+                            shape=(chunk['nb_rows'], manifest['n_features']))
+
+    offsets = np.load(os.path.join(chunk_dir, 'names_offsets.npy')).tolist()
+    with open(os.path.join(chunk_dir, 'names.bin'), 'rb') as names_file:
+        names_blob = names_file.read()
+    names = [names_blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+             for i in range(chunk['nb_rows'])]
+    labels = [manifest['labels'][code]
+              for code in np.load(os.path.join(chunk_dir, 'labels.npy')).tolist()]
+
+    return [names, attributes, labels]
+
+
+def iter_chunks(store_dir, mmap=True):
+    """
+        Loads the chunks of a store one after the other, see load_chunk.
+
+        -------
+        Returns:
+        - generator
+            Yields lists [names, attributes, labels].
+    """
+
+    manifest = load_manifest(store_dir)
+    for chunk_nb, _ in enumerate(manifest['chunks']):
+        yield load_chunk(store_dir, chunk_nb, mmap, manifest)
+
+
+def load_rows(store_dir, start=0, stop=None, mmap=True):
+    """
+        Loads the files start (included) to stop (excluded) of a store, whichever their chunk.
+        Only the chunks containing these files are opened. If they are exactly the files of
+        one chunk, its attributes are not copied (see load_chunk).
+
+        -------
+        Parameters:
+        - store_dir: str
+            Path of the store.
+        - start: int
+            Index of the first file. Default: 0.
+        - stop: int
+            Index of the file after the last one. Default: None, i.e. until the last file.
+        - mmap: bool
+            See load_chunk. Default: True.
+
+        -------
+        Returns:
+        - list
+            [names, attributes, labels], as returned by static_analysis.main_analysis.
+    """
+
+    manifest = load_manifest(store_dir)
+    if stop is None or stop > manifest['nb_rows']:
+        stop = manifest['nb_rows']
+
+    names, attributes, labels = [], [], []
+    chunk_start = 0
+    for chunk_nb, chunk in enumerate(manifest['chunks']):
+        chunk_stop = chunk_start + chunk['nb_rows']
+        if chunk_start < stop and start < chunk_stop:
+            chunk_names, chunk_attributes, chunk_labels = load_chunk(store_dir, chunk_nb, mmap,
+                                                                     manifest)
+            begin, end = max(start, chunk_start) - chunk_start, min(stop, chunk_stop) - chunk_start
+            names.extend(chunk_names[begin:end])
+            if begin == 0 and end == chunk['nb_rows']:
+                attributes.append(chunk_attributes)  # Slicing would copy it
+            else:
+                attributes.append(chunk_attributes[begin:end])
+            labels.extend(chunk_labels[begin:end])
+        chunk_start = chunk_stop
+
+    if len(attributes) == 1:
+        return [names, attributes[0], labels]
+    if not attributes:
+        return [names, csr_matrix((0, manifest['n_features'])), labels]
+    return [names, vstack(attributes, format='csr'), labels]
+
+
+def load_labels(store_dir):
+    """
+        Labels of every file of a store, without loading the attributes.
+
+        -------
+        Returns:
+        - np.array
+            Label of each file, in the order of the store.
+    """
+
+    manifest = load_manifest(store_dir)
+    codes = [np.load(os.path.join(store_dir, chunk['dir'], 'labels.npy'))
+             for chunk in manifest['chunks']]
+    if not codes:
+        return np.array([], dtype=str)
+    return np.array(manifest['labels'])[np.concatenate(codes)]
+
+
+def load_selected_rows(store_dir, rows, mmap=True):
+    """
+        Loads some files of a store, whichever their chunk. Only the chunks containing these
+        files are opened and, with mmap, only their rows are read.
+
+        -------
+        Parameters:
+        - store_dir: str
+            Path of the store.
+        - rows: list of int
+            Sorted indices of the files.
+        - mmap: bool
+            See load_chunk. Default: True.
+
+        -------
+        Returns:
+        - list
+            [names, attributes, labels], as returned by static_analysis.main_analysis.
+    """
+
+    manifest = load_manifest(store_dir)
+    rows = np.asarray(rows, dtype=np.int64)
+
+    names, attributes, labels = [], [], []
+    chunk_start = 0
+    for chunk_nb, chunk in enumerate(manifest['chunks']):
+        chunk_stop = chunk_start + chunk['nb_rows']
+        begin, end = np.searchsorted(rows, [chunk_start, chunk_stop])
+        if begin < end:
+            chunk_names, chunk_attributes, chunk_labels = load_chunk(store_dir, chunk_nb, mmap,
+                                                                     manifest)
+            local = rows[begin:end] - chunk_start
+            names.extend(chunk_names[i] for i in local.tolist())
+            attributes.append(chunk_attributes[local])
+            labels.extend(chunk_labels[i] for i in local.tolist())
+        chunk_start = chunk_stop
+
+    if len(attributes) == 1:
+        return [names, attributes[0], labels]
+    if not attributes:
+        return [names, csr_matrix((0, manifest['n_features'])), labels]
+    return [names, vstack(attributes, format='csr'), labels]
+
+
+def load_store(store_dir, mmap=True):
+    """
+        Loads every file of a store. A store containing only one chunk is not copied
+        (see load_chunk).
+
+        -------
+        Returns:
+        - list
+            [names, attributes, labels], as returned by static_analysis.main_analysis.
+    """
+
+    return load_rows(store_dir, mmap=mmap)
+
+
+def remove_store(store_dir):
+    """ Deletes the manifest and the chunks of a store, if any. """
+
+    manifest = load_manifest(store_dir)
+    if manifest is None:
+        return
+    os.remove(os.path.join(store_dir, MANIFEST))  # First, so that no partial store is read
+    for chunk in manifest['chunks']:
+        shutil.rmtree(os.path.join(store_dir, chunk['dir']), ignore_errors=True)
@@ -0,0 +1,279 @@
+"""
+    Append-only on-disk mapping of n-grams to integers (dico mapping, see ngrams_handling),
+    shared by concurrent analyses.
+
+    The n-grams are encoded as base-NB_UNITS integers (see ngrams_handling.n_grams_codes).
+    A vocabulary is a directory containing:
+    - vocab.npy: array of 3 rows, memory-mapped on load: the code of each n-gram in the order of
+    their integer, the codes sorted and the integers of the sorted codes (for lookups);
+    - journal: n-grams added since vocab.npy was written, as (code, integer) int64 pairs;
+    - vocab.lock: file locked by the processes adding n-grams.
+"""
+
+import os
+import ast
+import fcntl
+import pickle
+import logging
+import threading
+import numpy as np
+
+VOCAB_FILE = 'vocab.npy'
+JOURNAL_FILE = 'journal'
+LOCK_FILE = 'vocab.lock'
+LEGACY_FILE = 'ast_esprima_simpl'  # Former pickled dictionary, key: str(n-gram), value: int
+
+RECORD = np.dtype('<i8')
+RECORD_SIZE = 2 * RECORD.itemsize
+
+
+class NgramVocabulary:
+    """
+        Mapping of n-gram codes to integers. New n-grams are added to the journal under a file
+        lock, after reading the n-grams that other processes may have added in the meantime.
+        The journal is merged into vocab.npy by compact.
+
+        lookup takes no lock: what load() replaces is kept in the single tuple attribute
+        state, (codes, sorted codes, integers of the sorted codes, journal's n-grams as
+        code -> integer, journal's codes in the order of their integer), which lookup reads
+        once. Only the journal's n-grams of the current state are added to, under the lock.
+    """
+
+    def __init__(self, vocab_dir, nb_units=None, n=None):
+        """
+            -------
+            Parameters:
+            - vocab_dir: str
+                Directory of the vocabulary, created if needed.
+            - nb_units, n: int
+                Base of the codes and length of the n-grams, only needed to migrate the former
+                pickled dictionary of vocab_dir (see migrate_legacy).
+        """
+
+        self.vocab_dir = vocab_dir
+        self.vocab_path = os.path.join(vocab_dir, VOCAB_FILE)
+        self.journal_path = os.path.join(vocab_dir, JOURNAL_FILE)
+        if not os.path.exists(vocab_dir):
+            os.makedirs(vocab_dir)
+        self.thread_lock = threading.Lock()
+        self.lock_file = open(os.path.join(vocab_dir, LOCK_FILE), 'a')
+
+        with self.locked():
+            if not os.path.isfile(self.vocab_path):
+                migrate_legacy(vocab_dir, nb_units, n)
+            self.load()
+            self.refresh()
+
+    def locked(self):
+        """ Context manager holding the thread and file locks. """
+
+        return _Locked(self)
+
+    def load(self):
+        """ Memory-maps vocab.npy and forgets the journal read so far. """
+
+        self.vocab_stat = None
+        if os.path.isfile(self.vocab_path):
+            vocab = np.load(self.vocab_path, mmap_mode='r')
+            self.vocab_stat = _stat(self.vocab_path)
+        else:
+            vocab = np.zeros((3, 0), dtype=np.int64)
+        self.state = (vocab[0], vocab[1], vocab[2], {}, [])  # Replaced at once, see the class
+        self.journal_offset = 0
+
+    def refresh(self):
+        """
+            Reads the n-grams added by other processes since the last call. vocab.npy is loaded
+            again if it has been compacted.
+        """
+
+        if _stat(self.vocab_path) != self.vocab_stat:
+            self.load()
+        if not os.path.isfile(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as journal:
+            journal.seek(self.journal_offset)
+            data = journal.read()
+        data = data[:len(data) - len(data) % RECORD_SIZE]  # A record may be being written
+        self.journal_offset += len(data)
+        records = np.frombuffer(data, dtype=RECORD).reshape(-1, 2).tolist()
+        recent, recent_codes = self.state[3], self.state[4]
+        for code, i in records:
+            if i == len(self):  # Records already in vocab.npy are skipped
+                recent[code] = i
+                recent_codes.append(code)
+
+    def __len__(self):
+        codes, _, _, _, recent_codes = self.state
+        return len(codes) + len(recent_codes)
+
+    def lookup(self, codes):
+        """
+            Integers of n-grams, without adding the unknown ones.
+
+            -------
+            Parameter:
+            - codes: np.array
+                Codes of the n-grams (see ngrams_handling.n_grams_codes).
+
+            -------
+            Returns:
+            - np.array (int64)
+                Integer of each n-gram, -1 if it is not in the vocabulary.
+        """
+
+        _, sorted_codes, sorted_ids, recent, _ = self.state  # Consistent even if load() runs
+        codes = np.asarray(codes, dtype=np.int64)
+        ids = np.full(len(codes), -1, dtype=np.int64)
+        if len(sorted_codes):
+            positions = np.searchsorted(sorted_codes, codes)
+            positions[positions == len(sorted_codes)] = 0
+            found = sorted_codes[positions] == codes
+            ids[found] = sorted_ids[positions[found]]
+        if recent:
+            for j in np.flatnonzero(ids < 0).tolist():
+                ids[j] = recent.get(int(codes[j]), -1)
+        return ids
+
+    def ids(self, codes):
+        """
+            Integers of n-grams, the unknown ones being added in the order of codes.
+
+            -------
+            Parameter:
+            - codes: np.array
+                Codes of the n-grams (see ngrams_handling.n_grams_codes).
+
+            -------
+            Returns:
+            - np.array (int64)
+                Integer of each n-gram.
+        """
+
+        codes = np.asarray(codes, dtype=np.int64)
+        ids = self.lookup(codes)
+        if (ids >= 0).all():
+            return ids
+
+        with self.locked():
+            self.refresh()  # Other processes may have added some of the n-grams
+            missing = np.flatnonzero(ids < 0)
+            ids[missing] = self.lookup(codes[missing])
+            recent, recent_codes = self.state[3], self.state[4]
+            records = []
+            for j in missing.tolist():
+                if ids[j] < 0:
+                    code = int(codes[j])
+                    if code not in recent:  # Same n-gram several times in codes
+                        recent[code] = len(self)
+                        recent_codes.append(code)
+                        records.append((code, recent[code]))
+                    ids[j] = recent[code]
+            if records:
+                with open(self.journal_path, 'ab') as journal:
+                    journal.write(np.array(records, dtype=RECORD).tobytes())
+                self.journal_offset += len(records) * RECORD_SIZE
+        return ids
+
+    def code(self, i):
+        """
+            Code of the n-gram mapped to the integer i.
+
+            -------
+            Returns:
+            - int
+            - or None if i is not in the vocabulary.
+        """
+
+        codes, _, _, _, recent_codes = self.state
+        if 0 <= i < len(codes):
+            return int(codes[i])
+        if len(codes) <= i < len(codes) + len(recent_codes):
+            return recent_codes[i - len(codes)]
+        return None
+
+    def compact(self):
+        """ Merges the journal into vocab.npy, which is replaced atomically. """
+
+        with self.locked():
+            self.refresh()
+            codes, _, _, _, recent_codes = self.state
+            if not recent_codes:
+                return
+            codes = np.concatenate([codes, np.array(recent_codes, dtype=np.int64)])
+            save_vocab(self.vocab_dir, codes)
+            open(self.journal_path, 'wb').close()  # Its records are now in vocab.npy
+            self.load()
+        logging.debug('Vocabulary %s compacted: %d n-grams', self.vocab_dir, len(self))
+
+    def close(self, min_journal=1000):
+        """
+            Compacts the vocabulary if the journal contains at least min_journal n-grams or
+            10% of the vocabulary, then releases the lock file.
+        """
+
+        codes, _, _, _, recent_codes = self.state
+        if len(recent_codes) >= max(min_journal, len(codes) // 10):
+            self.compact()
+        self.lock_file.close()
+
+
+class _Locked:
+    """ See NgramVocabulary.locked. """
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+
+    def __enter__(self):
+        self.vocabulary.thread_lock.acquire()
+        fcntl.flock(self.vocabulary.lock_file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.vocabulary.lock_file, fcntl.LOCK_UN)
+        self.vocabulary.thread_lock.release()
+
+
+def _stat(path):
+    """ Identifies a version of a file, as vocab.npy is replaced and not modified. """
+
+    try:
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+    except FileNotFoundError:
+        return None
+
+
+def save_vocab(vocab_dir, codes):
+    """
+        Atomically writes vocab.npy, given the code of each n-gram in the order of their integer.
+    """
+
+    codes = np.asarray(codes, dtype=np.int64)
+    order = np.argsort(codes, kind='stable')
+    tmp_path = os.path.join(vocab_dir, VOCAB_FILE + '.tmp')
+    with open(tmp_path, 'wb') as tmp_file:
+        np.save(tmp_file, np.stack([codes, codes[order], order]))
+    os.replace(tmp_path, os.path.join(vocab_dir, VOCAB_FILE))
+
+
+def migrate_legacy(vocab_dir, nb_units, n):
+    """
+        Converts the former pickled dictionary of vocab_dir (key: str(n-gram), value: int),
+        if any, into vocab.npy. The integers of the n-grams are kept.
+    """
+
+    legacy_path = os.path.join(vocab_dir, LEGACY_FILE)
+    if not os.path.isfile(legacy_path) or nb_units is None:
+        return
+    dico_ngram_int = pickle.load(open(legacy_path, 'rb'))
+    codes = np.zeros(len(dico_ngram_int), dtype=np.int64)
+    for key, i in dico_ngram_int.items():
+        n_gram = ast.literal_eval(key)
+        if len(n_gram) != n or not 0 <= i < len(codes):
+            raise ValueError('Unexpected entry ' + key + ': ' + str(i) + ' in ' + legacy_path)
+        code = 0
+        for unit in n_gram:
+            code = code * nb_units + unit
+        codes[i] = code
+    save_vocab(vocab_dir, codes)
+    logging.info('The n-grams of %s have been converted into %s', legacy_path, VOCAB_FILE)
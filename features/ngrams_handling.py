@@ -1,24 +1,33 @@
 
 """
-    Mapping a JS file to either:
-    - np.array containing the frequency of the n-grams that the file contains (dico mapping);
-    - or a CSR matrix containing the frequency of the n-grams that the file contains (hash mapping).
+    Mapping a JS file to a CSR matrix containing the frequency of the n-grams that the file
+    contains, the n-grams being mapped to integers using either a dictionary (dico mapping)
+    or hashes (hash mapping).
 """
 
 
 import os
-import pickle
 import logging
 import numpy as np
 from scipy.sparse import csr_matrix
 from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.utils import murmurhash3_32
 
 import tokens
+import ngram_vocabulary
 
 
 CURRENT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__)))
 DICO_PATH = os.path.join(CURRENT_PATH, 'ngrams2int')
 
+# The units are integers in [0, NB_UNITS[, so that an n-gram can be encoded as a base-NB_UNITS int
+NB_UNITS = max(tokens.DICO_TOKENS_INT.values()) + 1
+MAX_N_NUMPY = int(np.log(np.iinfo(np.int64).max) / np.log(NB_UNITS))  # No int64 overflow
+
+hashes_n_grams = {}  # Memoization of hash_n_grams: (n-gram code, n, n_features) -> dimension
+hashing_vectorizers = {}  # (n, n_features) -> HashingVectorizer
+global_vocabulary = None  # Mapping of n-grams to int, see import_modules
+
 
 ############################################################
 #                        DICO MAPPING
@@ -94,6 +103,45 @@ def count_sets_of_n_grams(input_file, tolerance, n):
     """
 
     numbers_list = tokens.tokens_to_numbers(input_file, tolerance)
+    return count_n_grams(numbers_list, n)
+
+
+def count_n_grams(numbers_list, n, engine='numpy'):
+    """
+        Given the integers representing the syntactic units of a JavaScript file, count
+        and store (once) the number of occurrences of each set of n-gram in a dictionary.
+        The n-grams are stored in the order of their first occurrence, whichever the engine.
+
+        -------
+        Parameters:
+        - numbers_list: list
+            Contains integers which represent the syntactic units extracted
+            from a JS file (see tokens.py).
+        - n: int
+            Stands for the size of the sliding-window which goes through the units contained
+            in the files to be analysed.
+        - engine: str
+            'numpy' to count the n-grams with count_n_grams_codes, 'python' to count the
+            tuples produced by n_grams_list. Default: 'numpy'.
+
+        -------
+        Returns:
+        - list
+            * 1st element: Dictionary, key: tuple representing an n-gram, value: number of
+            occurrences of a given tuple of n-gram;
+            * 2nd element: total number of n-grams.
+        - or [None, None] if matrix_all_n_grams is empty.
+    """
+
+    if engine == 'numpy' and n <= MAX_N_NUMPY:
+        codes, counts, nb_n_grams = count_n_grams_codes(numbers_list, n)
+        if codes is None:
+            return [None, None]
+        n_grams = map(tuple, codes_to_n_grams(codes, n).tolist())
+        return [dict(zip(n_grams, counts.tolist())), nb_n_grams]
+
+    if numbers_list is not None:
+        numbers_list = list(map(int, numbers_list))  # Units may be given as an np.array
     matrix_all_n_grams = n_grams_list(numbers_list, n)
     # Each row: tuple representing an n-gram.
 
@@ -110,26 +158,141 @@ def count_sets_of_n_grams(input_file, tolerance, n):
     return [None, None]
 
 
+def n_grams_codes(numbers_list, n):
+    """
+        Given a list of numbers, encode every possible n-gram as a base-NB_UNITS integer,
+        using a sliding window over a NumPy array.
+
+        -------
+        Parameters:
+        - numbers_list: list or np.array
+            Contains integers which represent the syntactic units extracted
+            from a JS file (see tokens.py).
+        - n: Integer
+            Stands for the size of the sliding-window which goes through the units contained
+            in the files to be analysed. At most MAX_N_NUMPY.
+
+        -------
+        Returns:
+        - np.array
+            The code of the n-gram starting at each position of numbers_list.
+        - or None if numbers_list is empty or shorter than n.
+    """
+
+    if numbers_list is not None:
+        units = np.asarray(numbers_list, dtype=np.int64)
+        nb_n_grams = len(units) - (n - 1)
+        if n < 1 or nb_n_grams < 1:
+            logging.warning('The file has less tokens than the length n of an n-gram')
+        else:
+            codes = np.zeros(nb_n_grams, dtype=np.int64)
+            for i in range(n):
+                codes *= NB_UNITS
+                codes += units[i:i + nb_n_grams]
+            return codes
+    return None
+
+
+def codes_to_n_grams(codes, n):
+    """
+        Decode base-NB_UNITS integers into n-grams (inverse of n_grams_codes).
+
+        -------
+        Returns:
+        - np.array
+            One row per code, one column per unit of the n-gram.
+    """
+
+    n_grams = np.empty((len(codes), n), dtype=np.int64)
+    codes = np.array(codes, dtype=np.int64)
+    for i in range(n - 1, -1, -1):
+        codes, n_grams[:, i] = np.divmod(codes, NB_UNITS)
+    return n_grams
+
+
+def count_n_grams_codes(numbers_list, n):
+    """
+        Count the number of occurrences of each n-gram, encoded as in n_grams_codes.
+
+        -------
+        Parameters:
+        - numbers_list: list or np.array
+            Contains integers which represent the syntactic units extracted
+            from a JS file (see tokens.py).
+        - n: Integer
+            Stands for the size of the sliding-window which goes through the units contained
+            in the files to be analysed.
+
+        -------
+        Returns:
+        - tuple
+            * np.array containing the code of each different n-gram, in the order of their
+            first occurrence;
+            * np.array containing their number of occurrences;
+            * total number of n-grams.
+        - or (None, None, None) if there is no n-gram.
+    """
+
+    codes = n_grams_codes(numbers_list, n)
+    if codes is None:
+        return None, None, None
+    uniques, first_occurrences, counts = np.unique(codes, return_index=True, return_counts=True)
+    order = np.argsort(first_occurrences, kind='stable')
+    return uniques[order], counts[order], len(codes)
+
+
 # Simplifying the n-grams list and mapping the resulting n-grams to integers.
 def import_modules(n):
     """
-        Import the dictionary mapping n-grams and int.
+        Import the vocabulary mapping n-grams and int (see ngram_vocabulary).
 
         -------
         Parameter:
         - n: Integer
             Stands for the size of the sliding-window which goes through the units contained
-            in the files to be analysed.
+            in the files to be analysed. At most MAX_N_NUMPY.
 
         -------
         Returns:
         - Nothing
-            But creates a global variable containing the dictionary mapping n-grams to int.
+            But creates a global variable containing the vocabulary mapping n-grams to int.
+    """
+
+    global global_vocabulary
+    close_modules()
+    global_vocabulary = open_vocabulary(n)
+
+
+def open_vocabulary(n):
+    """
+        Opens the vocabulary mapping n-grams and int, for a caller keeping its own reference
+        to it (e.g. model_bundle.ModelBundle) instead of the global one of import_modules.
+
+        -------
+        Parameter:
+        - n: Integer
+            See import_modules.
+
+        -------
+        Returns:
+        - NgramVocabulary
+            To be closed by the caller.
     """
 
-    global global_ngram_dict
-    global_ngram_dict = pickle.load(open(os.path.join(DICO_PATH, str(n) + '-gram',
-                                                      'ast_esprima_simpl'), 'rb'))
+    if n > MAX_N_NUMPY:
+        raise ValueError('The dico mapping handles n-grams of at most ' + str(MAX_N_NUMPY)
+                         + ' units')
+    return ngram_vocabulary.NgramVocabulary(os.path.join(DICO_PATH, str(n) + '-gram'),
+                                            NB_UNITS, n)
+
+
+def close_modules():
+    """ Closes the vocabulary imported with import_modules, if any. """
+
+    global global_vocabulary
+    if global_vocabulary is not None:
+        global_vocabulary.close()
+        global_vocabulary = None
 
 
 def nb_features(n):
@@ -156,7 +319,7 @@ def nb_features(n):
     return n_features
 
 
-def vect_proba_of_n_grams(input_file, tolerance, n, dico_ngram_int):
+def vect_proba_of_n_grams(input_file, tolerance, n, vocabulary):
     """
         Vector representing the probability of each n-grams for input_file.
 
@@ -171,41 +334,108 @@ def vect_proba_of_n_grams(input_file, tolerance, n, dico_ngram_int):
         - n: int
             Stands for the size of the sliding-window which goes through the units contained
             in the files to be analysed.
-        - dico_ngram_int: Dictionary
-            Key: N-gram;
-            Value: Unique integer.
+        - vocabulary: NgramVocabulary
+            Mapping of n-grams to unique integers (see import_modules).
 
         -------
         Returns:
-        - np.array
+        - csr_matrix
+            Non-compacted dimension: 1 x nb_features(n);
             Dimension: integer representing an n-gram;
             Value: probability of occurrences of a given tuple of n-gram.
         - or None if matrix_all_n_grams is empty.
     """
 
-    dico_of_n_grams, nb_n_grams = count_sets_of_n_grams(input_file, tolerance, n)
-    if dico_of_n_grams is not None:
+    numbers_list = tokens.tokens_to_numbers(input_file, tolerance)
+    return vect_proba_of_numbers(numbers_list, n, vocabulary)
+
+
+def vect_proba_of_numbers(numbers_list, n, vocabulary):
+    """
+        Vector representing the probability of each n-grams for the syntactic units of a file.
+
+        -------
+        Parameter:
+        - numbers_list: list
+            Contains integers which represent the syntactic units extracted
+            from a JS file (see tokens.py).
+        - n: int
+            Stands for the size of the sliding-window which goes through the units contained
+            in the files to be analysed.
+        - vocabulary: NgramVocabulary
+            Mapping of n-grams to unique integers (see import_modules).
+
+        -------
+        Returns:
+        - csr_matrix
+            Non-compacted dimension: 1 x nb_features(n);
+            Dimension: integer representing an n-gram;
+            Value: probability of occurrences of a given tuple of n-gram.
+        - or None if matrix_all_n_grams is empty.
+    """
+
+    codes, counts, nb_n_grams = count_n_grams_codes(numbers_list, n)
+    row = dict_proba_of_codes(codes, counts, nb_n_grams, n, vocabulary)
+    if row is not None:
+        return csr_matrix((row[1], row[0], [0, len(row[0])]), shape=(1, nb_features(n)))
+    return None
+
+
+def dict_proba_of_codes(codes, counts, nb_n_grams, n, vocabulary):
+    """
+        Non-zero elements of the vector representing the probability of each n-grams, given
+        their number of occurrences (see CsrBuilder).
+        As new n-grams are added to the vocabulary, files should be handled in the same order
+        for the mapping to stay deterministic.
+
+        -------
+        Parameter:
+        - codes: np.array
+            Code of each different n-gram, in the order of their first occurrence
+            (see count_n_grams_codes).
+        - counts: np.array
+            Number of occurrences of the corresponding n-grams.
+        - nb_n_grams: int
+            Total number of n-grams.
+        - n: int
+            Stands for the size of the sliding-window which goes through the units contained
+            in the files to be analysed.
+        - vocabulary: NgramVocabulary
+            Mapping of n-grams to unique integers (see import_modules).
+
+        -------
+        Returns:
+        - tuple
+            * np.array (int32) containing the integers representing the n-grams, sorted;
+            * np.array (float64) containing the probability of occurrences of the
+            corresponding n-grams.
+        - or None if codes is None.
+    """
+
+    if codes is not None:
         n_features = nb_features(n)
-        vect_n_grams_proba = np.zeros(n_features)
-        # Bigger vector on purpose, to have space for new n-grams
-        for key, proba in dico_of_n_grams.items():
-            map_ngram_int = n_gram_to_int(dico_ngram_int, key, n_features)
-            if map_ngram_int is not None:
-                vect_n_grams_proba[map_ngram_int] = proba / nb_n_grams
-
-        return vect_n_grams_proba
+        # Dimensions up to nb_features(n), to have space for new n-grams
+        dimensions = vocabulary.ids(codes)
+        in_space = dimensions < n_features
+        if not in_space.all():
+            logging.warning('The vector space size of ' + str(n_features) + ' is too small.'
+                            + ' Tried to access element ' + str(dimensions.max())
+                            + '. This can be changed in ngrams_handling.nb_features(n)')
+        dimensions = dimensions[in_space].astype(np.int32)
+        order = np.argsort(dimensions)
+        return dimensions[order], np.asarray(counts, dtype=np.float64)[in_space][order] \
+            / nb_n_grams
     return None
 
 
-def n_gram_to_int(dico_ngram_int, n_gram, n_features):
+def n_gram_to_int(vocabulary, n_gram, n_features):
     """
         Convert an n-gram into an int.
 
         -------
         Parameters:
-        - dico_ngram_int: Dictionary
-            Key: N-gram;
-            Value: Unique integer.
+        - vocabulary: NgramVocabulary
+            Mapping of n-grams to unique integers (see import_modules).
         - n_gram: Tuple
             Represents the n-gram to be converted into an int.
         - n_features: int
@@ -218,11 +448,8 @@ def n_gram_to_int(dico_ngram_int, n_gram, n_features):
         - or None if the vector space's size is exceeded.
     """
 
-    try:
-        i = dico_ngram_int[str(n_gram)]
-    except KeyError:  # Key not in dico, we add it. Beware dico referenced as global variable.
-        dico_ngram_int[str(n_gram)] = len(dico_ngram_int)
-        i = dico_ngram_int[str(n_gram)]
+    # Key not in the vocabulary: we add it
+    i = int(vocabulary.ids(n_grams_codes(n_gram, len(n_gram)))[0])
     if i < n_features:
         return i
     else:
@@ -232,31 +459,32 @@ def n_gram_to_int(dico_ngram_int, n_gram, n_features):
         return None
 
 
-def int_to_n_gram(dico_ngram_int, i):
+def int_to_n_gram(vocabulary, i, n):
     """
         Convert an int into an n-gram.
 
         -------
         Parameters:
-        - dico_ngram_int: Dictionary
-            Key: int;
-            Value: Unique n-gram.
+        - vocabulary: NgramVocabulary
+            Mapping of n-grams to unique integers (see import_modules).
         - i: Integer
             Represents the int to be converted into an n-gram.
+        - n: int
+            Length of the n-gram.
 
         -------
         Returns:
         - Tuple
             Corresponds to an n-gram.
             Note that the operation that transforms an int to an n-gram is a bijection.
-        - or None if i is not in dico.
+        - or None if i is not in the vocabulary.
     """
 
-    try:
-        ngram = dico_ngram_int[str(i)]
-        return ngram
-    except KeyError as err:
-        logging.warning('The key ' + str(err) + ' is not in the n-gram - int mapping dictionary')
+    code = vocabulary.code(i)
+    if code is None:
+        logging.warning('The key ' + str(i) + ' is not in the n-gram - int mapping vocabulary')
+        return None
+    return tuple(codes_to_n_grams([code], n)[0].tolist())
 
 
 ############################################################
@@ -296,16 +524,116 @@ def csr_proba_of_n_grams_hash_storage(input_file, tolerance, n, n_features):
     """
 
     tokens_int = tokens.tokens_to_numbers(input_file, tolerance)
-    if tokens_int is not None:
-        corpus = [str(tokens_int)]
-        vectorizer = HashingVectorizer(token_pattern=r"(?u)\b\w+\b", ngram_range=(n, n), norm='l1',
-                                       alternate_sign=False, n_features=n_features)
-        res = vectorizer.fit_transform(corpus)
+    return csr_proba_of_numbers(tokens_int, n, n_features)
+
+
+def csr_proba_of_numbers(tokens_int, n, n_features, engine='numpy'):
+    """
+        Maps the syntactic units of a file to a CSR matrix containing the frequency of its n-grams
+        (see csr_proba_of_n_grams_hash_storage).
+
+        -------
+        Parameters:
+        - tokens_int: list
+            Contains integers which represent the syntactic units extracted
+            from a JS file (see tokens.py).
+        - n: int
+            Stands for the size of the sliding-window which goes through the units contained
+            in the files to be analysed.
+        - n_features: int
+            Size of the resulting vector space. This can be changed in nb_features(n).
+        - engine: str
+            'numpy' to count the n-grams with count_n_grams_codes and hash them with
+            hash_n_grams, 'python' to use sklearn's HashingVectorizer. Both give the same
+            matrix. Default: 'numpy'.
 
-        return res
+        -------
+        Returns:
+        - csr_matrix
+            Non-compacted dimension: 1 x n_features;
+            Value: probability of occurrences of an n-gram.
+        - or None if the file could not be parsed.
+    """
+
+    row = hash_proba_of_numbers(tokens_int, n, n_features, engine)
+    if row is not None:
+        return csr_matrix((row[1], row[0], [0, len(row[0])]), shape=(1, n_features))
     return None
 
 
+def hash_proba_of_numbers(tokens_int, n, n_features, engine='numpy'):
+    """
+        Non-zero elements of the row computed by csr_proba_of_numbers, without building a
+        csr_matrix (see CsrBuilder).
+
+        -------
+        Parameters:
+        - tokens_int, n, n_features, engine
+            See csr_proba_of_numbers.
+
+        -------
+        Returns:
+        - tuple
+            * np.array (int32) containing the dimensions of the non-zero elements, sorted;
+            * np.array (float64) containing the probability of occurrences of the
+            corresponding n-grams.
+        - or None if the file could not be parsed.
+    """
+
+    if tokens_int is None:
+        return None
+
+    if engine == 'numpy' and n <= MAX_N_NUMPY:
+        if len(tokens_int) < n:  # No n-gram, as with HashingVectorizer
+            return np.empty(0, dtype=np.int32), np.empty(0)
+        codes, counts, nb_n_grams = count_n_grams_codes(tokens_int, n)
+        dimensions, inverse = np.unique(hash_n_grams(codes, n, n_features), return_inverse=True)
+        proba = np.bincount(inverse.ravel(), weights=counts) / nb_n_grams
+        return dimensions.astype(np.int32), proba
+
+    key = (n, n_features)
+    if key not in hashing_vectorizers:  # HashingVectorizer is stateless, one is enough
+        hashing_vectorizers[key] = HashingVectorizer(token_pattern=r"(?u)\b\w+\b",
+                                                     ngram_range=(n, n), norm='l1',
+                                                     alternate_sign=False, n_features=n_features)
+    res = hashing_vectorizers[key].transform([str(list(map(int, tokens_int)))])
+    return res.indices, res.data
+
+
+def hash_n_grams(codes, n, n_features):
+    """
+        Dimension of the vector space of each n-gram, computed as sklearn's HashingVectorizer
+        does for the n-gram '<unit1> <unit2> ... <unitn>' (signed 32-bit murmurhash3).
+
+        -------
+        Parameters:
+        - codes: np.array
+            N-grams encoded as in n_grams_codes.
+        - n: int
+            Size of the n-grams.
+        - n_features: int
+            Size of the vector space.
+
+        -------
+        Returns:
+        - np.array
+            Dimension of each n-gram.
+    """
+
+    dimensions = np.empty(len(codes), dtype=np.int64)
+    for i, code in enumerate(codes.tolist()):
+        key = (code, n, n_features)
+        if key not in hashes_n_grams:
+            n_gram = codes_to_n_grams([code], n)[0]
+            h = murmurhash3_32(' '.join(str(unit) for unit in n_gram), seed=0)
+            if h == -2147483648:  # abs(-2**31) overflows, same convention as sklearn
+                hashes_n_grams[key] = (2147483647 - (n_features - 1)) % n_features
+            else:
+                hashes_n_grams[key] = abs(h) % n_features
+        dimensions[i] = hashes_n_grams[key]
+    return dimensions
+
+
 def concatenate_csr_matrices(matrix1, matrix2, nb_col):
     """
         Horizontal concatenation of 2 CSR matrices.
@@ -336,3 +664,65 @@ def concatenate_csr_matrices(matrix1, matrix2, nb_col):
     new_ind_ptr = new_ind_ptr[1:]
     res.indptr = np.concatenate((matrix1.indptr, new_ind_ptr))
     return res
+
+
+class CsrBuilder:
+    """
+        Builds a CSR matrix row by row, storing the non-zero elements in growable arrays so
+        that the matrix is only created once, instead of being copied for each new row
+        (see concatenate_csr_matrices).
+    """
+
+    def __init__(self, n_features, capacity=1024):
+        """
+            -------
+            Parameters:
+            - n_features: int
+                Number of columns of the matrix.
+            - capacity: int
+                Initial number of non-zero elements that can be stored. Default: 1024.
+        """
+
+        self.n_features = n_features
+        self.nnz = 0
+        self.indices = np.empty(capacity, dtype=np.int32)
+        self.data = np.empty(capacity)
+        self.indptr = [0]
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def add_row(self, indices, data):
+        """
+            Appends a row to the matrix.
+
+            -------
+            Parameters:
+            - indices: np.array
+                Columns of the non-zero elements of the row.
+            - data: np.array
+                Values of the non-zero elements of the row.
+        """
+
+        end = self.nnz + len(indices)
+        if end > len(self.data):  # Amortized O(1) per element
+            capacity = max(end, 2 * len(self.data))
+            self.indices = np.resize(self.indices, capacity)
+            self.data = np.resize(self.data, capacity)
+        self.indices[self.nnz:end] = indices
+        self.data[self.nnz:end] = data
+        self.nnz = end
+        self.indptr.append(end)
+
+    def to_csr(self):
+        """
+            -------
+            Returns:
+            - csr_matrix
+                Nb of lines: number of rows added;
+                Nb of columns (non-compacted): n_features.
+        """
+
+        return csr_matrix((self.data[:self.nnz].copy(), self.indices[:self.nnz].copy(),
+                           np.array(self.indptr, dtype=np.int32)),
+                          shape=(len(self), self.n_features))
@@ -1,14 +1,114 @@
 // Syntactic analysis of a file whose path is given as command line argument. Esprima is used for
 // the parsing process and prints in stdout the list of syntactic units present in the file.
+// If the codes of the units are given as third argument ('Name:code,Name:code...'), one byte per
+// unit, its code, is written instead of the units' name (unknown units get the code 255).
+//
+// Batch mode, to parse many files with one Node.js process:
+//     parser.js --batch <tolerance> <codes, '' or '-'> [file...]
+// The files are given as arguments or, if there are none, read from stdin (one path per line).
+// For each file, in order, a frame is written: uint32 (big-endian) length, then a 1-byte status
+// (0: valid JS, 1: not JS, 2: malformed JS) followed by the syntactic units found (one byte per
+// unit with codes, their names separated by '\n' with '', none with '-'), as in parser_worker.js.
 
-function parse(js, tolerance) {
+function parse(js, tolerance, codes) {
     var fs = require("fs");
     var text = fs.readFileSync(js).toString('utf-8');
     var esprima = require('esprima');
-    esprima.parse(text, {comment: true, tolerant: tolerance}, function (node) {
-        console.log(node.type)
+    if (codes === undefined) {
+        esprima.parse(text, {comment: true, tolerant: tolerance}, function (node) {
+            console.log(node.type)
+        });
+        return;
+    }
+    var units = [];
+    try {
+        esprima.parse(text, {comment: true, tolerant: tolerance}, function (node) {
+            var code = codes[node.type];
+            units.push(code === undefined ? 255 : code);
+        });
+    } finally {
+        // Written even on a syntax error, as the units found distinguish malformed JS from no JS
+        process.stdout.write(Buffer.from(units));
+    }
+}
+
+function parseFrame(js, tolerance, codes) {
+    var fs = require("fs");
+    var esprima = require('esprima');
+    var units = [];
+    var status = 0;
+    try {
+        var text = fs.readFileSync(js).toString('utf-8');
+        esprima.parse(text, {comment: true, tolerant: tolerance}, function (node) {
+            if (codes === null) {
+                units.push(0);  // Only counted
+            } else if (codes === undefined) {
+                units.push(node.type);
+            } else {
+                var code = codes[node.type];
+                units.push(code === undefined ? 255 : code);
+            }
+        });
+    } catch (err) {
+        status = (units.length == 0) ? 1 : 2;  // Nothing parsed: no JS, otherwise malformed JS
+    }
+    var body;
+    if (status != 0 || codes === null) {
+        body = Buffer.alloc(0);
+    } else if (codes === undefined) {
+        body = Buffer.from(units.length ? units.join('\n') + '\n' : '', 'utf-8');
+    } else {
+        body = Buffer.from(units);
+    }
+    var header = Buffer.alloc(5);
+    header.writeUInt32BE(body.length + 1, 0);
+    header.writeUInt8(status, 4);
+    return Buffer.concat([header, body]);
+}
+
+function batch(tolerance, codes, files) {
+    var fs = require("fs");
+    if (files.length == 0) {
+        files = fs.readFileSync(0).toString('utf-8').split('\n').filter(function (js) {
+            return js.length > 0;
+        });
+    }
+    files.forEach(function (js) {
+        writeAll(fs, parseFrame(js, tolerance, codes));
     });
 }
 
-var tolerance = (process.argv[3] == 'true')
-parse(process.argv[2], tolerance)
+function writeAll(fs, buffer) {
+    // Synchronous, so that the frames are written entirely and in the order of the files
+    var written = 0;
+    while (written < buffer.length) {
+        try {
+            written += fs.writeSync(1, buffer, written);
+        } catch (err) {
+            if (err.code != 'EAGAIN') {
+                throw err;
+            }
+        }
+    }
+}
+
+function readCodes(arg) {
+    var codes = {};
+    arg.split(',').forEach(function (unit) {
+        var pair = unit.split(':');
+        if (pair.length == 2) {
+            codes[pair[0]] = parseInt(pair[1], 10);
+        }
+    });
+    return codes;
+}
+
+if (process.argv[2] == '--batch') {
+    var codes = (process.argv[4] == '-') ? null : (process.argv[4] ? readCodes(process.argv[4])
+                                                                    : undefined);
+    batch(process.argv[3] == 'true', codes, process.argv.slice(5));
+} else {
+    var tolerance = (process.argv[3] == 'true')
+    parse(process.argv[2], tolerance, (process.argv[4] === undefined) ? undefined
+                                                                      : readCodes(process.argv[4]))
+}
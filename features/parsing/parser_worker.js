@@ -0,0 +1,79 @@
+// Long-lived syntactic analysis worker. Esprima is loaded once, then requests are read from stdin
+// and answered on stdout, using a length-prefixed protocol (see js/parser_pool.py):
+// - request: uint32 (big-endian) length, then a payload made of a 1-byte kind ('f' for a file
+// path, 's' for JS source), a 1-byte tolerance flag ('1' for esprima's tolerant mode, '0'
+// otherwise), a 1-byte mode ('c' for codes, 't' for text) and the file path (utf-8) or the
+// source itself;
+// - response: uint32 (big-endian) length, then a payload made of a 1-byte status (0: valid JS,
+// 1: not JS, 2: malformed JS) followed by the syntactic units found: one byte per unit, its
+// code, in 'c' mode; their names separated by '\n' in 't' mode.
+// The codes of the units are given as command line argument, as 'Name:code,Name:code...'
+// (unknown units get the code 255).
+
+var fs = require("fs");
+var esprima = require('esprima');
+
+var codes = {};
+(process.argv[2] || '').split(',').forEach(function (unit) {
+    var pair = unit.split(':');
+    if (pair.length == 2) {
+        codes[pair[0]] = parseInt(pair[1], 10);
+    }
+});
+
+function parse(kind, tolerance, mode, data) {
+    var units = [];
+    var status = 0;
+    try {
+        var text = (kind == 's') ? data.toString('utf-8')
+                                 : fs.readFileSync(data.toString('utf-8')).toString('utf-8');
+        esprima.parse(text, {comment: true, tolerant: tolerance}, function (node) {
+            if (mode == 'c') {
+                var code = codes[node.type];
+                units.push(code === undefined ? 255 : code);
+            } else {
+                units.push(node.type);
+            }
+        });
+    } catch (err) {
+        // Same convention as parser.js: nothing parsed means no JS, otherwise malformed JS
+        status = (units.length == 0) ? 1 : 2;
+    }
+    return [status, units];
+}
+
+function answer(status, mode, units) {
+    var body;
+    if (mode == 'c') {
+        body = Buffer.from(status == 0 ? units : []);
+    } else {
+        body = Buffer.from(units.length ? units.join('\n') + '\n' : '', 'utf-8');
+    }
+    var header = Buffer.alloc(5);
+    header.writeUInt32BE(body.length + 1, 0);
+    header.writeUInt8(status, 4);
+    process.stdout.write(Buffer.concat([header, body]));
+}
+
+var pending = Buffer.alloc(0);
+
+process.stdin.on('data', function (chunk) {
+    pending = Buffer.concat([pending, chunk]);
+    while (pending.length >= 4) {
+        var length = pending.readUInt32BE(0);
+        if (pending.length < 4 + length) {
+            break;
+        }
+        var payload = pending.slice(4, 4 + length);
+        pending = pending.slice(4 + length);
+        var kind = String.fromCharCode(payload[0]);
+        var tolerance = (payload[1] == '1'.charCodeAt(0));
+        var mode = String.fromCharCode(payload[2]);
+        var res = parse(kind, tolerance, mode, payload.slice(3));
+        answer(res[0], mode, res[1]);
+    }
+});
+
+process.stdin.on('end', function () {
+    process.exit(0);
+});
@@ -6,18 +6,419 @@
 """
 
 import os
-import sys
-import pickle
 import logging
+from itertools import islice, count, repeat
+from collections import deque, Counter
+from multiprocessing.util import Finalize
+from concurrent.futures import ProcessPoolExecutor
 
 import ngrams_handling
+import tokens
+import parser_pool
+import units_cache
+import feature_store
+import is_js
 
 
 CURRENT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__)))
 DICO_PATH = os.path.join(CURRENT_PATH, 'ngrams2int')
 
+parsing_stats = Counter()  # Error code -> number of files of the last analysis, see is_js_file
 
-def main_analysis(js_dirs, js_files, labels_files, labels_dirs, n, tolerance, dict_not_hash):
+
+def numbers_features(numbers_list, n, dict_not_hash, n_features):
+    """
+        Part of the analysis of a file which does not depend on the other files.
+
+        -------
+        Parameters:
+        - numbers_list: list
+            Contains integers which represent the syntactic units extracted
+            from a JS file (see tokens.py).
+        - n: int
+            Stands for the size of the sliding-window which goes through the units contained
+            in the files to be analysed.
+        - dict_not_hash: boolean
+            True if a dictionary is used to map n-grams to int, False if hashes are used.
+        - n_features: int
+            Size of the resulting vector space (see ngrams_handling.nb_features).
+
+        -------
+        Returns:
+        - tuple
+            Codes of the n-grams, their number of occurrences and the total number of n-grams
+            (dico mapping, see ngrams_handling.count_n_grams_codes), as the mapping to int has
+            to be done in the files' order;
+        - or tuple
+            Dimensions and frequency of the n-grams (hash mapping,
+            see ngrams_handling.hash_proba_of_numbers);
+        - or None if the file could not be analysed.
+    """
+
+    if dict_not_hash:
+        return ngrams_handling.count_n_grams_codes(numbers_list, n)
+    return ngrams_handling.hash_proba_of_numbers(numbers_list, n, n_features)
+
+
+def log_parsing_stats(stats=None):
+    """
+        Logs the number of files of an analysis per error code: those of stats (Counter), or
+        by default those of the last analysis (see parsing_stats).
+    """
+
+    if stats is None:
+        stats = parsing_stats
+    if stats:
+        logging.info('Parsing results: ' + ', '.join(
+            str(stats[status]) + ' ' + is_js.status_text(status) for status in sorted(stats)))
+
+
+def init_process(cache_path=None, cache_size=None, timeout=60, max_size=None, max_memory=None):
+    """
+        Initializer of the processes of files_features: starts their Node.js worker and opens
+        the cache of syntactic units, if any.
+    """
+
+    parser_pool.start_pool(1, timeout, max_size, max_memory)
+    if cache_path is not None:
+        units_cache.open_cache(cache_path, cache_size)
+        # Closing the cache stores the process' hits and misses
+        Finalize(None, units_cache.close_cache, exitpriority=10)
+
+
+def open_executor(jobs, cache_path=None, cache_size=None, timeout=60, max_size=None,
+                  max_memory=None):
+    """
+        Pool of jobs processes analysing files for files_features, each with its Node.js
+        worker (see init_process). It can be kept open across several calls to files_features.
+    """
+
+    return ProcessPoolExecutor(max_workers=jobs, initializer=init_process,
+                               initargs=(cache_path, cache_size, timeout, max_size, max_memory))
+
+
+def files_chunk_features(files_chunk, tolerance, n, dict_not_hash, n_features,
+                         to_numbers=tokens.file_status_and_numbers):
+    """
+        Parses files (or sources, depending on to_numbers) and returns their error code and
+        numbers_features. Called in the processes of files_features.
+    """
+
+    return [status_features(to_numbers(input_file, tolerance), n, dict_not_hash, n_features)
+            for input_file in files_chunk]
+
+
+def status_features(status_numbers, n, dict_not_hash, n_features):
+    """ numbers_features, given the error code and units of a file. """
+
+    status, numbers_list = status_numbers
+    return status, numbers_features(numbers_list, n, dict_not_hash, n_features)
+
+
+def files_features(files2do, tolerance, n, dict_not_hash, parser_workers=1, jobs=1,
+                   cache_path=None, cache_size=None, chunk_size=16,
+                   to_numbers=tokens.file_status_and_numbers, timeout=60, max_size=None,
+                   max_memory=None, executor=None):
+    """
+        Computes numbers_features for each file, in the order of files2do.
+        Files are consumed lazily, with a bounded number of files being analysed at a time.
+
+        -------
+        Parameters:
+        - files2do: iterable of strings
+            Files to be analysed.
+        - tolerance, n, dict_not_hash, parser_workers
+            See main_analysis.
+        - jobs: int
+            Number of processes used to analyse the files. Each process uses its own Node.js
+            worker. Default: 1, i.e. the files are analysed in this process, the parsing being
+            done by parser_workers Node.js workers.
+        - cache_path, cache_size:
+            Cache of syntactic units opened by each process, see main_analysis.
+        - chunk_size: int
+            Number of files sent at once to a process, if jobs > 1. Default: 16.
+        - to_numbers: callable
+            Function mapping an element of files2do to its error code and the integers
+            representing its syntactic units. Default: tokens.file_status_and_numbers;
+            tokens.source_status_and_numbers if files2do contains JS sources.
+        - timeout, max_memory
+            Limits of the Node.js workers, see parser_pool.ParserPool.
+        - max_size: int
+            Size in bytes over which a file is not parsed. Default: None.
+        - executor: ProcessPoolExecutor
+            Processes used if jobs > 1, given by open_executor and left open. Default: None,
+            i.e. the processes are started for this call only.
+
+        -------
+        Returns:
+        - generator
+            Yields tuples: error code of the file (see is_js.is_js_file) and result of
+            numbers_features.
+    """
+
+    n_features = ngrams_handling.nb_features(n)
+
+    if jobs > 1:
+        own_executor = executor is None
+        if own_executor:
+            executor = open_executor(jobs, cache_path, cache_size, timeout, max_size,
+                                     max_memory)
+        files2do = iter(files2do)
+        try:
+            in_flight = deque()
+            while True:
+                files_chunk = list(islice(files2do, chunk_size))
+                if files_chunk:
+                    in_flight.append(executor.submit(files_chunk_features, files_chunk,
+                                                     tolerance, n, dict_not_hash, n_features,
+                                                     to_numbers))
+                if in_flight and (len(in_flight) >= 2 * jobs or not files_chunk):
+                    for res in in_flight.popleft().result():
+                        yield res
+                elif not files_chunk:
+                    break
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+    else:
+        own_pool = parser_pool.current_pool is None
+        pool = parser_pool.start_pool(parser_workers, timeout, max_size, max_memory) \
+            if own_pool else parser_pool.current_pool
+        try:
+            for status_numbers in pool.imap(files2do, tolerance, to_numbers):
+                yield status_features(status_numbers, n, dict_not_hash, n_features)
+        finally:
+            if own_pool:
+                parser_pool.stop_pool()
+
+
+def walk_files(cdir):
+    """
+        Recursively lists the files of a directory, using os.scandir. Like os.walk, symbolic
+        links to directories are not followed.
+
+        -------
+        Parameter:
+        - cdir: str
+            Directory containing the JS files to be analysed, possibly in subdirectories.
+
+        -------
+        Returns:
+        - generator
+            Yields the path of each file.
+    """
+
+    with os.scandir(cdir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_files(entry.path)
+            elif not entry.is_dir():  # Links to directories are skipped, as by os.walk
+                yield entry.path
+
+
+def files_to_analyse(js_dirs, js_files, labels_files, labels_dirs):
+    """
+        Lists the files given as input of main_analysis, with their label.
+        The files of js_dirs are listed lazily and recursively.
+
+        -------
+        Parameters:
+        - js_dirs, js_files, labels_files, labels_dirs
+            See main_analysis. Missing labels are replaced by '?'.
+
+        -------
+        Returns:
+        - generator
+            Yields tuples (file path, label).
+    """
+
+    if js_files is not None:
+        if labels_files is None:
+            labels_files = ['?' for _, _ in enumerate(js_files)]
+        for cfile, label in zip(js_files, labels_files):
+            yield cfile, label
+    if js_dirs is not None:
+        if labels_dirs is None:
+            labels_dirs = ['?' for _, _ in enumerate(js_dirs)]
+        for cdir, label in zip(js_dirs, labels_dirs):
+            for cfile in walk_files(cdir):
+                yield cfile, label
+
+
+def iter_analysis(js_dirs, js_files, labels_files, labels_dirs, n, tolerance, dict_not_hash,
+                  parser_workers=1, jobs=1, cache_path=None, cache_size=1024,
+                  chunk_size=10000, timeout=60, max_size=None, max_memory=None):
+    """
+        Performs the static analysis of main_analysis, yielding the results every chunk_size
+        valid files. Files are listed and analysed lazily, so that the memory used does not
+        depend on the number of files.
+
+        -------
+        Parameters:
+        - js_dirs, js_files, labels_files, labels_dirs, n, tolerance, dict_not_hash,
+        parser_workers, jobs, cache_path, cache_size, timeout, max_size, max_memory
+            See main_analysis.
+        - chunk_size: int
+            Maximum number of valid files per chunk. None to get all files in one chunk.
+            Default: 10000.
+
+        -------
+        Returns:
+        - generator
+            Yields lists [names, attributes, labels] as returned by main_analysis.
+    """
+
+    inputs = ((cfile, cfile, label)
+              for cfile, label in files_to_analyse(js_dirs, js_files, labels_files, labels_dirs))
+    return iter_inputs_analysis(inputs, n, tolerance, dict_not_hash,
+                                tokens.file_status_and_numbers, parser_workers, jobs,
+                                cache_path, cache_size, chunk_size, timeout, max_size,
+                                max_memory)
+
+
+def iter_inputs_analysis(inputs, n, tolerance, dict_not_hash, to_numbers, parser_workers=1,
+                         jobs=1, cache_path=None, cache_size=1024, chunk_size=10000,
+                         timeout=60, max_size=None, max_memory=None, vocabulary=None,
+                         executor=None, stats=None):
+    """
+        Core of iter_analysis and analyze_sources: analyses JS inputs, be they files or sources.
+
+        -------
+        Parameters:
+        - inputs: iterable of tuples
+            (name, input, label) for each input, the input being given to to_numbers.
+        - n, tolerance, dict_not_hash, parser_workers, jobs, cache_path, cache_size, timeout,
+        max_size, max_memory
+            See main_analysis.
+        - to_numbers: callable
+            See files_features.
+        - chunk_size: int
+            See iter_analysis.
+        - vocabulary: NgramVocabulary
+            Vocabulary used if dict_not_hash, left open (see ngrams_handling.open_vocabulary),
+            e.g. to be shared by several analyses. Default: None, i.e. the global vocabulary,
+            opened and closed by the analysis.
+        - executor: ProcessPoolExecutor
+            See files_features.
+        - stats: Counter
+            Counter to which the error code of each input is added, the caller logging it.
+            Default: None, i.e. parsing_stats, logged at the end of the analysis.
+
+        -------
+        Returns:
+        - generator
+            Yields lists [names, attributes, labels] as returned by main_analysis.
+    """
+
+    own_vocabulary = dict_not_hash and vocabulary is None
+    if own_vocabulary:
+        ngrams_handling.import_modules(n)
+        vocabulary = ngrams_handling.global_vocabulary
+
+    if cache_path is not None:
+        cache = units_cache.open_cache(cache_path, cache_size * 1024 * 1024)
+        hits, misses = cache.counters()
+
+    n_features = ngrams_handling.nb_features(n)
+    pending = deque()  # Inputs being analysed: their name and label
+    own_stats = stats is None
+    if own_stats:
+        stats = parsing_stats
+        stats.clear()
+    max_size_bytes = None if max_size is None else int(max_size * 1024 * 1024)
+
+    def inputs2do():
+        for name, js_input, label in inputs:
+            pending.append((name, label))
+            yield js_input
+
+    try:
+        tab_res = [[], ngrams_handling.CsrBuilder(n_features), []]
+        for status, res in files_features(inputs2do(), tolerance, n, dict_not_hash,
+                                          parser_workers, jobs, cache_path,
+                                          cache_size * 1024 * 1024, to_numbers=to_numbers,
+                                          timeout=timeout, max_size=max_size_bytes,
+                                          max_memory=max_memory, executor=executor):
+            name, label = pending.popleft()
+            stats[status] += 1
+            if dict_not_hash:
+                # Sequential mapping of the n-grams to int, for it to be deterministic
+                res = ngrams_handling.dict_proba_of_codes(res[0], res[1], res[2], n,
+                                                          vocabulary)
+            if res is not None:
+                tab_res[0].append(name)
+                tab_res[1].add_row(res[0], res[1])
+                tab_res[2].append(label)
+                if chunk_size is not None and len(tab_res[0]) >= chunk_size:
+                    yield [tab_res[0], tab_res[1].to_csr(), tab_res[2]]
+                    tab_res = [[], ngrams_handling.CsrBuilder(n_features), []]
+        if tab_res[0]:
+            yield [tab_res[0], tab_res[1].to_csr(), tab_res[2]]
+
+    finally:
+        if own_stats:
+            log_parsing_stats()
+
+        if cache_path is not None:
+            new_hits, new_misses = cache.counters()
+            logging.info('Cache of syntactic units: %d hits, %d misses', new_hits - hits,
+                         new_misses - misses)
+            units_cache.close_cache()
+
+        if own_vocabulary:
+            ngrams_handling.close_modules()
+
+
+def analyze_sources(sources, n, tolerance, dict_not_hash, names=None, labels=None,
+                    parser_workers=1, jobs=1, cache_path=None, cache_size=1024, timeout=60,
+                    max_size=None, max_memory=None):
+    """
+        Performs the static analysis of main_analysis on JS sources held in memory (e.g. scripts
+        extracted from HTML pages or from network traffic). The sources are sent to the Node.js
+        workers through their pipe, no file being written.
+
+        -------
+        Parameters:
+        - sources: iterable of bytes (or str)
+            JS sources to be analysed, consumed lazily.
+        - n, tolerance, dict_not_hash, parser_workers, jobs, cache_path, cache_size, timeout,
+        max_size, max_memory
+            See main_analysis. With a cache, a source is only parsed once, whether it was seen
+            as a source or as a file.
+        - names: iterable
+            Name of each source. Default: None, i.e. their index in sources.
+        - labels: iterable of strings
+            True label of each source: benign, malicious or '?'. Default: None, i.e. '?'.
+
+        -------
+        Returns:
+        -list:
+            Contains the results of the static analysis of the sources given as input.
+            * 1st element: list containing the valid sources' name (i.e. sources that could be
+            parsed);
+            * 2nd element: csr_matrix representing the analysis results (n-grams frequency)
+            with one line per valid JS source;
+            * 3rd element: list containing the true labels of the valid JS sources.
+    """
+
+    if names is None:
+        names = count()
+    if labels is None:
+        labels = repeat('?')
+    inputs = zip(names, sources, labels)
+    chunks = list(iter_inputs_analysis(inputs, n, tolerance, dict_not_hash,
+                                       tokens.source_status_and_numbers, parser_workers, jobs,
+                                       cache_path, cache_size, None, timeout, max_size,
+                                       max_memory))
+    if chunks:
+        return chunks[0]
+    return [[], None, []]
+
+
+def main_analysis(js_dirs, js_files, labels_files, labels_dirs, n, tolerance, dict_not_hash,
+                  parser_workers=1, jobs=1, cache_path=None, cache_size=1024, timeout=60,
+                  max_size=None, max_memory=None):
     """
         Main function, performs a static analysis (syntactic using the AST)
         of JavaScript files given in input.
@@ -25,7 +426,7 @@ def main_analysis(js_dirs, js_files, labels_files, labels_dirs, n, tolerance, di
         -------
         Parameters:
         - js_dirs: list of strings
-            Directories containing the JS files to be analysed.
+            Directories containing the JS files to be analysed, also in their subdirectories.
         - js_files: list of strings
             Files to be analysed.
         - labels_files: list of strings
@@ -43,13 +444,34 @@ def main_analysis(js_dirs, js_files, labels_files, labels_dirs, n, tolerance, di
             The values 'true' and 'false' shall be used to enable this tolerant mode.
         - dict_not_hash: boolean
             True if a dictionary is used to map n-grams to int, False if hashes are used.
+        - parser_workers: int
+            Number of long-lived Node.js processes parsing the files (see js/parser_pool.py).
+            Default: 1.
+        - jobs: int
+            Number of processes used to analyse the files. Default: 1.
+            The results do not depend on it.
+        - cache_path: str
+            Path of a SQLite file caching the syntactic units of the files analysed, so that
+            files with the same content are only parsed once (see features/units_cache.py).
+            Default: None, i.e. no cache.
+        - cache_size: int
+            Maximum size of the cache in MB. Default: 1024.
+        - timeout: float
+            Number of seconds after which the parsing of a file is stopped. Default: 60.
+        - max_size: float
+            Size in MB over which a file is not parsed. Default: None, i.e. no limit.
+        - max_memory: int
+            Heap size in MB over which the parsing of a file is stopped. Default: None, i.e.
+            Node.js' default.
+        Files reaching a limit are left out, their number being logged with the number of
+        valid, malformed and no JS files (see parsing_stats).
 
         -------
         Returns:
         -list:
             Contains the results of the static analysis of the files given as input.
             * 1st element: list containing valid files' name (i.e. files that could be parsed);
-            * 2nd element: list / csr_matrix representing the analysis results (n-grams frequency)
+            * 2nd element: csr_matrix representing the analysis results (n-grams frequency)
             with one line per valid JS file;
             * 3rd element: list containing the true labels of the valid JS files.
 
@@ -59,54 +481,51 @@ def main_analysis(js_dirs, js_files, labels_files, labels_dirs, n, tolerance, di
         logging.error('Please, indicate a directory or a JS file to be studied')
 
     else:
-        if dict_not_hash:
-            ngrams_handling.import_modules(n)
-
-        if js_files is not None:
-            files2do = js_files
-            if labels_files is None:
-                labels_files = ['?' for _, _ in enumerate(js_files)]
-            labels = labels_files
-        else:
-            files2do, labels = [], []
-        if js_dirs is not None:
-            i = 0
-            if labels_dirs is None:
-                labels_dirs = ['?' for _, _ in enumerate(js_dirs)]
-            for cdir in js_dirs:
-                for cfile in os.listdir(cdir):
-                    files2do.append(os.path.join(cdir, cfile))
-                    if labels_dirs is not None:
-                        labels.append(labels_dirs[i])
-                i += 1
-
-        tab_res = [[], [], []]
-
-        if not dict_not_hash:
-            csr_res = None
-            n_features = ngrams_handling.nb_features(n)
-
-        for j, _ in enumerate(files2do):
-            if dict_not_hash:
-                res = ngrams_handling.vect_proba_of_n_grams(files2do[j], tolerance, n,
-                                                            ngrams_handling.global_ngram_dict)
-            else:  # hashes
-                res = ngrams_handling.csr_proba_of_n_grams_hash_storage(files2do[j], tolerance,
-                                                                        n, n_features)
-            if res is not None:
-                tab_res[0].append(files2do[j])
-                if dict_not_hash:
-                    tab_res[1].append(res)
-                else:  # hashes
-                    csr_res = ngrams_handling.concatenate_csr_matrices(csr_res, res, n_features)
-                if labels and labels != []:
-                    tab_res[2].append(labels[j])
-        if dict_not_hash:
-            sys.path.insert(0, os.path.join(DICO_PATH, str(n) + '-gram'))
-            pickle.dump(ngrams_handling.global_ngram_dict,
-                        open(os.path.join(DICO_PATH, str(n) + '-gram', 'ast_esprima_simpl'), 'wb'))
-        else:
-            tab_res[1].append(csr_res)
-            tab_res[1] = tab_res[1][0]
-
-        return tab_res
+        chunks = list(iter_analysis(js_dirs, js_files, labels_files, labels_dirs, n, tolerance,
+                                    dict_not_hash, parser_workers, jobs, cache_path, cache_size,
+                                    None, timeout, max_size, max_memory))
+        if chunks:
+            return chunks[0]
+        return [[], None, []]
+
+
+def stream_analysis(save_dir, js_dirs, js_files, labels_files, labels_dirs, n, tolerance,
+                    dict_not_hash, parser_workers=1, jobs=1, cache_path=None, cache_size=1024,
+                    chunk_size=10000, timeout=60, max_size=None, max_memory=None):
+    """
+        Performs the static analysis of main_analysis and stores the results on disk every
+        chunk_size valid files, so that the memory used does not depend on the number of files.
+        Each chunk is appended to the store save_dir (see feature_store), which is created if
+        needed.
+
+        -------
+        Parameters:
+        - save_dir: str
+            Path of the directory to store the results in.
+        - js_dirs, js_files, labels_files, labels_dirs, n, tolerance, dict_not_hash,
+        parser_workers, jobs, cache_path, cache_size, timeout, max_size, max_memory
+            See main_analysis.
+        - chunk_size: int
+            Maximum number of valid files per chunk. Default: 10000.
+
+        -------
+        Returns:
+        - int
+            Number of valid files analysed.
+    """
+
+    if js_dirs is None and js_files is None:
+        logging.error('Please, indicate a directory or a JS file to be studied')
+        return 0
+
+    nb_files = 0
+    for names, attributes, labels in iter_analysis(js_dirs, js_files, labels_files, labels_dirs,
+                                                   n, tolerance, dict_not_hash, parser_workers,
+                                                   jobs, cache_path, cache_size, chunk_size,
+                                                   timeout, max_size, max_memory):
+        feature_store.append_chunk(save_dir, names, attributes, labels)
+        nb_files += len(names)
+
+    logging.info('The results of the analysis of %d files have been stored in %s', nb_files,
+                 save_dir)
+    return nb_files
@@ -10,10 +10,15 @@ SRC_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, os.path.join(SRC_PATH, 'features', 'tokens2int'))
 sys.path.insert(0, os.path.join(SRC_PATH, 'js'))
 
+import numpy as np
+
 import parser_esprima_simpl
 import is_js
+import parser_pool
+import units_cache
 
 DICO_TOKENS_INT = parser_esprima_simpl.ast_units_dico
+MAX_CODE = max(DICO_TOKENS_INT.values())  # The parser codes unknown units as 255
 
 
 def ast_used_esprima(input_file, tolerance):
@@ -22,6 +27,8 @@ def ast_used_esprima(input_file, tolerance):
         units present in the file.
         The order of the units stored in the previous list resembles a tree traversal using
         the depth-first algorithm post-order.
+        The file is sent to the long-lived Node.js workers of parser_pool.current_pool if a pool
+        was started (see parser_pool.start_pool), otherwise a Node.js process is launched.
 
         -------
         Parameters:
@@ -41,17 +48,47 @@ def ast_used_esprima(input_file, tolerance):
         - or None if the file either is no JS or malformed.
     """
 
-    units = is_js.is_js_file(input_file, syntactical_units=True, tolerance=tolerance)
+    units = parse_units(input_file, tolerance)[1]
     if isinstance(units, list):  # otherwise an error code could be returned
         # instead of a list of syntactic units
         return units
     return None
 
 
+def parse_units(input_file, tolerance, codes=False):
+    """
+        Parses an input JavaScript file, see ast_used_esprima.
+
+        -------
+        Parameter:
+        - codes: bool
+            Whether the parser should map the syntactic units to their integer (see
+            DICO_TOKENS_INT) and send one byte per unit, instead of sending their names.
+            Default: False.
+
+        -------
+        Returns:
+        - tuple (int, list)
+            Error code as returned by is_js.is_js_file (-1 on a system error) and the esprima
+            syntactic units present in the input file (np.array of uint8 if codes, None if the
+            file is no valid JS).
+    """
+
+    if parser_pool.current_pool is not None:  # Long-lived Node.js workers
+        return parser_pool.current_pool.parse(input_file, tolerance=tolerance, codes=codes)
+    units = is_js.is_js_file(input_file, syntactical_units=True, tolerance=tolerance,
+                             units_codes=DICO_TOKENS_INT if codes else None)
+    if isinstance(units, (list, np.ndarray)):
+        return 0, units
+    return (-1 if units is None else units), None
+
+
 def tokens_to_numbers(input_file, tolerance):
     """
         Convert a list of syntactic units in their corresponding numbers
         (as indicated in the corresponding units dictionary).
+        If a cache was opened (see units_cache.open_cache), files with the same content are
+        only parsed once.
 
         -------
         Parameters:
@@ -63,14 +100,162 @@ def tokens_to_numbers(input_file, tolerance):
             The values 'true' and 'false' shall be used to enable this tolerant mode.
         -------
         Returns:
+        - np.array (uint8)
+            Contains the Integers which correspond to the units of the file.
+        - or None if the file considered either is no JS, malformed or empty.
+    """
+
+    return file_status_and_numbers(input_file, tolerance)[1]
+
+
+def file_status_and_numbers(input_file, tolerance):
+    """
+        Same as tokens_to_numbers, also returning the error code of the file.
+
+        -------
+        Returns:
+        - tuple (int, np.array)
+            Error code as returned by is_js.is_js_file (-1 on a system error) and the result
+            of tokens_to_numbers.
+    """
+
+    pool = parser_pool.current_pool
+    if pool is not None and pool.max_size is not None:  # Not even read to compute its key
+        try:
+            if os.path.getsize(input_file) > pool.max_size:
+                return is_js.TOO_LARGE, None
+        except OSError:
+            pass
+
+    cache = units_cache.current_cache
+    if cache is not None:  # Files already parsed are not parsed again
+        try:
+            with open(input_file, 'rb') as js_file:
+                key = cache.key(js_file.read(), tolerance)
+        except OSError:
+            key = None
+        if key is not None:
+            status, numbers_list = cache.get(key)
+            if status is not None:
+                return status, numbers_list
+
+    status, codes = parse_units(input_file, tolerance, codes=True)
+    numbers_list = codes_to_numbers(codes)
+    if cache is not None and key is not None:
+        cache.put(key, status, numbers_list)
+    return status, numbers_list
+
+
+def parse_source_units(source, tolerance, codes=False):
+    """
+        Parses JS source held in memory, see parse_units. The source is sent to the long-lived
+        Node.js workers of parser_pool.current_pool, or to a worker started for it if no pool
+        was started.
+
+        -------
+        Returns:
+        - tuple (int, list)
+            Error code as returned by is_js.is_js_file (-1 on a system error) and the esprima
+            syntactic units present in the source (np.array of uint8 if codes, None if the
+            source is no valid JS).
+    """
+
+    if parser_pool.current_pool is not None:
+        return parser_pool.current_pool.parse(source=source, tolerance=tolerance, codes=codes)
+    with parser_pool.ParserPool() as pool:
+        return pool.parse(source=source, tolerance=tolerance, codes=codes)
+
+
+def source_to_numbers(source, tolerance):
+    """
+        Same as tokens_to_numbers, for JS source held in memory instead of a file, so that no
+        file has to be written to analyse it.
+
+        -------
+        Parameters:
+        - source: bytes or str
+            JS source to be analysed.
+        - tolerance: str
+            Indicates whether esprima should tolerate a few cases of syntax errors
+            (corresponds to esprima's tolerant option).
+            The values 'true' and 'false' shall be used to enable this tolerant mode.
+        -------
+        Returns:
+        - np.array (uint8)
+            Contains the Integers which correspond to the units of the source.
+        - or None if the source either is no JS, malformed or empty.
+    """
+
+    return source_status_and_numbers(source, tolerance)[1]
+
+
+def source_status_and_numbers(source, tolerance):
+    """
+        Same as source_to_numbers, also returning the error code of the source.
+
+        -------
+        Returns:
+        - tuple (int, np.array)
+            Error code as returned by is_js.is_js_file (-1 on a system error) and the result
+            of source_to_numbers.
+    """
+
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+
+    cache = units_cache.current_cache
+    if cache is not None:  # Same key as a file with the same content
+        key = cache.key(source, tolerance)
+        status, numbers_list = cache.get(key)
+        if status is not None:
+            return status, numbers_list
+
+    status, codes = parse_source_units(source, tolerance, codes=True)
+    numbers_list = codes_to_numbers(codes)
+    if cache is not None:
+        cache.put(key, status, numbers_list)
+    return status, numbers_list
+
+
+def codes_to_numbers(codes):
+    """
+        Checks the codes of syntactic units sent by the parser (see parse_units).
+
+        -------
+        Parameter:
+        - codes: np.array
+            One uint8 per syntactic unit.
+
+        -------
+        Returns:
+        - np.array
+            Contains the Integers which correspond to the units, as codes.
+        - or None if codes is None or empty.
+    """
+
+    if codes is not None and len(codes) > 0:
+        if codes.max() > MAX_CODE:
+            raise KeyError('Syntactic unit missing from DICO_TOKENS_INT')
+        return codes
+    return None
+
+
+def units_to_numbers(tokens_list):
+    """
+        Convert a list of esprima syntactic units in their corresponding numbers.
+
+        -------
+        Parameter:
+        - tokens_list: list
+            Contains the esprima syntactic units of a JS file (see ast_used_esprima).
+
+        -------
+        Returns:
         - List
             Contains the Integers which correspond to the units given in tokens_list.
-        - or None if tokens_list is empty (cases where the JS file considered either is no JS,
-        malformed or empty).
+        - or None if tokens_list is None or empty.
     """
 
-    tokens_list = ast_used_esprima(input_file, tolerance)  # List of syntactic units
-
     if tokens_list is not None and tokens_list != []:
         return list(map(lambda x: DICO_TOKENS_INT[x], tokens_list))
     return None
@@ -0,0 +1,236 @@
+"""
+    Content-addressed on-disk cache of the syntactic units of JavaScript files, so that files
+    seen before (e.g. third-party libraries) do not have to be parsed again.
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+import numpy as np
+
+CURRENT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__)))
+ESPRIMA_PACKAGE = os.path.join(CURRENT_PATH, 'node_modules', 'esprima', 'package.json')
+
+ACCESS_BATCH = 256  # Number of hits whose access time is stored at once
+current_cache = None  # Cache used by tokens.tokens_to_numbers, see open_cache
+
+
+def esprima_version():
+    """
+        Version of the esprima module used to parse the files, as the syntactic units found
+        could change with it.
+    """
+
+    try:
+        with open(ESPRIMA_PACKAGE) as package:
+            return json.load(package)['version']
+    except (OSError, ValueError, KeyError):
+        return 'unknown'
+
+
+class UnitsCache:
+    """
+        SQLite store mapping the hash of a file's content (plus esprima's tolerant option and
+        version) to the integers representing its syntactic units, stored as one byte each.
+        The least recently used entries are evicted once the store exceeds max_size bytes.
+        The access time of the entries hit is stored every ACCESS_BATCH hits, and when the
+        cache is closed, instead of being committed at each hit.
+    """
+
+    def __init__(self, path, max_size=1024 * 1024 * 1024):
+        """
+            -------
+            Parameters:
+            - path: str
+                Path of the SQLite file storing the cache.
+            - max_size: int
+                Maximum size in bytes of the units stored. Default: 1 GB.
+        """
+
+        self.path = path
+        self.max_size = max_size
+        self.version = esprima_version()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.accesses = {}  # Key of an entry hit -> access time not stored yet
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # Readers do not wait for writers, and commits are not synced to disk one by one
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS units (key TEXT PRIMARY KEY, '
+                        'status INTEGER, data BLOB, size INTEGER, last_access INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS units_last_access ON units (last_access)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS counters (hits INTEGER, misses INTEGER)')
+        if self.db.execute('SELECT COUNT(*) FROM counters').fetchone()[0] == 0:
+            self.db.execute('INSERT INTO counters VALUES (0, 0)')
+        self.db.commit()
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM units').fetchone()[0]
+        self.clock = self.db.execute('SELECT COALESCE(MAX(last_access), 0) '
+                                     'FROM units').fetchone()[0]
+
+    def close(self):
+        """
+            Adds the hits and misses of this instance to the stored counters and closes the
+            SQLite connection.
+        """
+
+        with self.lock:
+            self.store_accesses()
+            self.db.execute('UPDATE counters SET hits = hits + ?, misses = misses + ?',
+                            (self.hits, self.misses))
+            self.db.commit()
+            self.db.close()
+
+    def store_accesses(self):
+        """ Stores the access time of the entries hit since the last call, without commit. """
+
+        if self.accesses:
+            self.db.executemany('UPDATE units SET last_access = ? WHERE key = ?',
+                                [(clock, key) for key, clock in self.accesses.items()])
+            self.accesses = {}
+
+    def counters(self):
+        """
+            Number of hits and misses of this instance and of every instance closed so far,
+            e.g. in other processes.
+
+            -------
+            Returns:
+            - tuple (int, int)
+        """
+
+        with self.lock:
+            hits, misses = self.db.execute('SELECT hits, misses FROM counters').fetchone()
+        return hits + self.hits, misses + self.misses
+
+    def key(self, content, tolerance):
+        """
+            Key of a file in the cache.
+
+            -------
+            Parameters:
+            - content: bytes
+                Content of the file.
+            - tolerance: str
+                'true' if esprima's tolerant mode is used, 'false' otherwise.
+        """
+
+        key = hashlib.sha256(content)
+        key.update(('\0' + tolerance + '\0' + self.version).encode('utf-8'))
+        return key.hexdigest()
+
+    def get(self, key):
+        """
+            Looks up a file in the cache.
+
+            -------
+            Returns:
+            - tuple (int, np.array)
+                Error code of the file as returned by is_js.is_js_file (None if the file was
+                not found) and the integers representing its syntactic units, as uint8 (None if
+                the file is no JS or malformed).
+        """
+
+        with self.lock:
+            row = self.db.execute('SELECT status, data FROM units WHERE key = ?',
+                                  (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, None
+            self.hits += 1
+            self.clock += 1
+            self.accesses[key] = self.clock
+            if len(self.accesses) >= ACCESS_BATCH:
+                self.store_accesses()
+                self.db.commit()
+        if row[0] == 0 and row[1]:
+            return 0, np.frombuffer(row[1], dtype=np.uint8)
+        return row[0], None
+
+    def put(self, key, status, numbers_list):
+        """
+            Stores the result of the parsing of a file.
+
+            -------
+            Parameters:
+            - key: str
+                See UnitsCache.key.
+            - status: int
+                Error code as returned by is_js.is_js_file. System errors are not stored.
+            - numbers_list: np.array
+                Integers representing the syntactic units of the file, or None.
+        """
+
+        if status not in (0, 1, 2):
+            return
+        data = None
+        if numbers_list is not None and len(numbers_list) > 0:
+            data = np.asarray(numbers_list, dtype=np.uint8).tobytes()
+        size = len(data) if data else 0
+        with self.lock:
+            self.clock += 1
+            self.accesses.pop(key, None)
+            self.store_accesses()  # Committed with the new entry
+            self.db.execute('INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?)',
+                            (key, status, data, size, self.clock))
+            self.size += size
+            if self.size > self.max_size:
+                self.evict()
+            self.db.commit()
+
+    def evict(self):
+        """ Deletes the least recently used entries, until the cache uses 90% of max_size. """
+
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM units').fetchone()[0]
+        target = int(0.9 * self.max_size)
+        if self.size <= target:
+            return
+        nb_evicted = 0
+        while self.size > target:
+            oldest = self.db.execute('SELECT key, size FROM units ORDER BY last_access '
+                                     'LIMIT 1000').fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                self.db.execute('DELETE FROM units WHERE key = ?', (key,))
+                self.size -= size
+                nb_evicted += 1
+                if self.size <= target:
+                    break
+        logging.info('%d entries evicted from the cache %s', nb_evicted, self.path)
+
+
+def open_cache(path, max_size=1024 * 1024 * 1024):
+    """
+        Opens the cache used by tokens.tokens_to_numbers.
+
+        -------
+        Parameters:
+        - path: str
+            Path of the SQLite file storing the cache.
+        - max_size: int
+            Maximum size in bytes of the units stored. Default: 1 GB.
+
+        -------
+        Returns:
+        - UnitsCache
+            Also stored in the global variable current_cache.
+    """
+
+    global current_cache
+    close_cache()
+    current_cache = UnitsCache(path, max_size)
+    return current_cache
+
+
+def close_cache():
+    """ Closes the cache opened with open_cache, if any. """
+
+    global current_cache
+    if current_cache is not None:
+        current_cache.close()
+        current_cache = None
@@ -7,17 +7,78 @@
 
 import subprocess  # to call Shell commands
 import os  # for OS dependant functionality
+import sys
+import csv
+import json
+import time
+import select
+import struct
 import argparse  # to deal with command line arguments
 import logging
+from itertools import islice, chain
+from collections import deque, Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
-OUTPUT_TEXTS = ['valid JavaScript', 'not JavaScript', 'malformed JavaScript']
+OUTPUT_TEXTS = ['valid JavaScript', 'not JavaScript', 'malformed JavaScript',
+                'parsing timed out', 'file too large', 'parsing out of memory']
+TIMEOUT, TOO_LARGE, OUT_OF_MEMORY = 3, 4, 5  # Limits reached, see is_js_file
 SRC_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+PARSER_PATH = os.path.join(SRC_PATH, 'features', 'parsing', 'parser.js')
+LOG_PATH = os.path.join(SRC_PATH, 'is_js.log')  # stderr of the parser, appended to
+worker_log_path = None  # Log of the process, see init_worker
 
 
-def is_js_file(given_file, syntactical_units=False, tolerance='false'):
+def status_text(status):
+    """ Text describing an error code of is_js_file, -1 being a system error. """
+
+    if status is None or status < 0:
+        return 'system error'
+    return OUTPUT_TEXTS[status]
+
+
+def format_codes(units_codes):
+    """
+        Formats the codes of the syntactic units as expected by parser.js and parser_worker.js.
+
+        -------
+        Parameter:
+        - units_codes: dict
+            Key: esprima syntactic unit;
+            Value: integer in [0, 255[ (see tokens2int/parser_esprima_simpl.py).
+
+        -------
+        Returns:
+        - str
+            'Name:code,Name:code...'
+    """
+
+    return ','.join(unit + ':' + str(code) for unit, code in sorted(units_codes.items()))
+
+
+def is_aborted(returncode):
+    """ Indicates whether Node.js aborted, which it does when it runs out of memory. """
+
+    return returncode in (134, -6)  # SIGABRT
+
+
+def node_command(script, max_memory=None):
+    """
+        Command line launching a Node.js script, with at most max_memory MB of heap if given.
+    """
+
+    command = ['nodejs']
+    if max_memory is not None:
+        command.append('--max-old-space-size=' + str(int(max_memory)))
+    return command + [script]
+
+
+def is_js_file(given_file, syntactical_units=False, tolerance='false', units_codes=None,
+               timeout=None, max_size=None, max_memory=None, log_path=None):
     """
         Given a file path, indicate whether the file is either valid JavaScript,
         malformed JavaScript or no JavaScript. On a system error -1 is returned.
+        Hostile files may be stopped by the limits timeout, max_size and max_memory.
 
         -------
         Parameter:
@@ -30,23 +91,47 @@ def is_js_file(given_file, syntactical_units=False, tolerance='false'):
             Indicates whether esprima should tolerate a few cases of syntax errors
             (corresponds to esprima's tolerant option). Default value is 'false'.
             The value 'true' shall be used to enable this tolerant mode.
+        - units_codes: dict
+            Codes of the syntactic units (see format_codes). If given, parser.js writes one byte
+            per unit instead of the units' name. Default value is None.
+        - timeout: float
+            Number of seconds after which the parsing is stopped. Default value is None.
+        - max_size: int
+            Size in bytes over which the file is not parsed. Default value is None.
+        - max_memory: int
+            Heap size in MB over which the parsing is stopped. Default value is None.
+        - log_path: str
+            File to which the parser's stderr is appended. Default value is None, i.e.
+            LOG_PATH.
 
         -------
         Returns:
         - int
             Indicates whether the file is either valid JavaScript (0), malformed
-            JavaScript (2) or no JavaScript (1).
+            JavaScript (2) or no JavaScript (1), or whether its parsing was stopped
+            because of timeout (3), max_size (4) or max_memory (5).
         - or List of syntactical units
             If given_file is valid and syntactical_units true.
+        - or np.array (uint8) of the codes of the syntactical units
+            If given_file is valid, syntactical_units true and units_codes given.
     """
 
-    with open(os.path.join(SRC_PATH, 'is_js.log'), 'w') as my_log:
+    if max_size is not None:
         try:
-            result = subprocess.check_output('nodejs '
-                                             + os.path.join(SRC_PATH, 'features',
-                                                            'parsing', 'parser.js')
-                                             + ' ' + given_file
-                                             + ' ' + tolerance, stderr=my_log, shell=True)
+            if os.path.getsize(given_file) > max_size:
+                return TOO_LARGE
+        except OSError:  # System-related error
+            logging.exception("System-related error")
+            return -1
+
+    with open(log_path or LOG_PATH, 'a') as my_log:
+        try:
+            command = node_command(PARSER_PATH, max_memory) + [given_file, tolerance]
+            if units_codes is not None:
+                command.append(format_codes(units_codes))
+            result = subprocess.check_output(command, stderr=my_log, timeout=timeout)
+            if syntactical_units and units_codes is not None:
+                return np.frombuffer(result, dtype=np.uint8)  # One byte per unit
             # result is a string containing the syntactical units (as found by esprima) of
             # the given JS script, separated by '\n'.
             # Structure of a token: "b'Literal\n'"
@@ -62,16 +147,288 @@ def is_js_file(given_file, syntactical_units=False, tolerance='false'):
                 if str(err.output) == "b''":  # The file could not be parsed: not a JS sample
                     return 1
                 return 2  # The file could partially be parsed: malformed JS
+            elif is_aborted(err.returncode):
+                logging.warning("The parsing of the file <" + given_file + "> ran out of memory")
+                return OUT_OF_MEMORY
             elif err.returncode != 0:
                 # Something else went wrong, we do not handle this here
                 logging.exception("Something went wrong with the file <" + given_file + ">: "
                                   + str(err))
 
+        except subprocess.TimeoutExpired:
+            logging.warning("The parsing of the file <" + given_file + "> timed out")
+            return TIMEOUT
+
         except OSError:  # System-related error
             logging.exception("System-related error")
             return -1
 
 
+def read_exactly(fd, size, deadline=None):
+    """
+        Reads size bytes from a file descriptor (e.g. the stdout of a Node.js process), waiting
+        until deadline (time.monotonic) at most.
+
+        -------
+        Returns:
+        - bytes
+        - or None if the deadline was exceeded or if the end of the file was reached.
+    """
+
+    res = b''
+    while len(res) < size:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            return None
+        readable, _, _ = select.select([fd], [], [], remaining)
+        if not readable:
+            return None
+        chunk = os.read(fd, size - len(res))
+        if not chunk:  # EOF: the process died
+            return None
+        res += chunk
+    return res
+
+
+def is_js_files(files, syntactical_units=False, tolerance='false', units_codes=None,
+                timeout=None, max_size=None, max_memory=None, batch_size=1000, log_path=None):
+    """
+        Same as is_js_file for several files, parser.js parsing up to batch_size files per
+        Node.js process (batch mode) instead of one.
+        Should the parsing of a file reach a limit, the process is stopped and a new one
+        parses the next files.
+
+        -------
+        Parameters:
+        - files: iterable of str
+            Paths of the files to be analysed, consumed lazily.
+        - syntactical_units, tolerance, units_codes, timeout, max_size, max_memory, log_path
+            See is_js_file. timeout applies to each file.
+        - batch_size: int
+            Maximum number of files parsed by one Node.js process. Default value is 1000.
+
+        -------
+        Returns:
+        - generator
+            Yields the result of is_js_file for each file, in the order of files (-1 on a
+            system error).
+    """
+
+    files = iter(files)
+    while True:
+        batch = list(islice(files, batch_size))
+        if not batch:
+            break
+        yield from parse_batch(batch, syntactical_units, tolerance, units_codes, timeout,
+                               max_size, max_memory, log_path)
+
+
+def parse_batch(batch, syntactical_units=False, tolerance='false', units_codes=None,
+                timeout=None, max_size=None, max_memory=None, log_path=None):
+    """
+        Parses a batch of files with parser.js' batch mode, see is_js_files.
+
+        -------
+        Returns:
+        - list
+            The result of is_js_file for each file of batch.
+    """
+
+    results = [None] * len(batch)
+    todo = []  # Indices of the files to be sent to Node.js
+    for i, given_file in enumerate(batch):
+        try:
+            if max_size is not None and os.path.getsize(given_file) > max_size:
+                results[i] = TOO_LARGE
+                continue
+        except OSError:  # Reported by parser.js as not JS, as by is_js_file
+            pass
+        todo.append(i)
+
+    if not syntactical_units:
+        codes_arg = '-'  # Only the status is sent
+    elif units_codes is None:
+        codes_arg = ''
+    else:
+        codes_arg = format_codes(units_codes)
+    position = 0  # Index in todo of the next file to be parsed
+    with open(log_path or LOG_PATH, 'a') as my_log:
+        while position < len(todo):
+            try:
+                process = subprocess.Popen(node_command(PARSER_PATH, max_memory)
+                                           + ['--batch', tolerance, codes_arg]
+                                           + [batch[i] for i in todo[position:]],
+                                           stdout=subprocess.PIPE, stderr=my_log)
+            except OSError:  # System-related error
+                logging.exception("System-related error")
+                for i in todo[position:]:
+                    results[i] = -1
+                break
+
+            try:
+                fd = process.stdout.fileno()
+                while position < len(todo):
+                    deadline = None if timeout is None else time.monotonic() + timeout
+                    header = read_exactly(fd, 4, deadline)
+                    body = None if header is None \
+                        else read_exactly(fd, struct.unpack('>I', header)[0], deadline)
+                    if body is None:
+                        break
+                    results[todo[position]] = frame_result(body, syntactical_units,
+                                                           units_codes)
+                    position += 1
+
+                if position < len(todo):  # The parsing of batch[todo[position]] failed
+                    given_file = batch[todo[position]]
+                    if deadline is not None and time.monotonic() >= deadline:
+                        logging.warning("The parsing of the file <" + given_file
+                                        + "> timed out")
+                        results[todo[position]] = TIMEOUT
+                    elif is_aborted(process.wait()):
+                        logging.warning("The parsing of the file <" + given_file
+                                        + "> ran out of memory")
+                        results[todo[position]] = OUT_OF_MEMORY
+                    else:
+                        logging.error("Something went wrong with the file <" + given_file
+                                      + ">: return code " + str(process.returncode))
+                        results[todo[position]] = -1
+                    position += 1  # A new process parses the next files
+            finally:
+                process.kill()
+                process.wait()
+                process.stdout.close()
+
+    return results
+
+
+def frame_result(body, syntactical_units=False, units_codes=None):
+    """ Result of is_js_file, given the frame written by parser.js for a file (batch mode). """
+
+    status = body[0]
+    if status != 0:
+        return status
+    if syntactical_units and units_codes is not None:
+        return np.frombuffer(body[1:], dtype=np.uint8)
+    if syntactical_units:
+        units = body[1:].decode('utf-8').split('\n')
+        del units[len(units) - 1]  # As last one = ''
+        return units
+    return 0
+
+
+def init_worker(log_dir):
+    """
+        Initializer of the processes of check_files: each process appends the parser's stderr
+        to its own log file, is_js-<pid>.log in log_dir.
+    """
+
+    global worker_log_path
+    worker_log_path = os.path.join(log_dir, 'is_js-' + str(os.getpid()) + '.log')
+
+
+def check_batch(batch, timeout=None, max_size=None, max_memory=None):
+    """ Error code of each file of batch, see parse_batch. Called by check_files. """
+
+    return parse_batch(batch, timeout=timeout, max_size=max_size, max_memory=max_memory,
+                       log_path=worker_log_path)
+
+
+def check_files(files, jobs=1, batch_size=1000, timeout=None, max_size=None, max_memory=None,
+                log_dir=None):
+    """
+        Indicates whether files are either valid, malformed or no JavaScript, batches of files
+        being checked by several processes in parallel.
+
+        -------
+        Parameters:
+        - files: iterable of str
+            Paths of the files to be analysed, consumed lazily.
+        - jobs: int
+            Number of processes, each of them running parser.js in batch mode. Default: 1.
+        - batch_size: int
+            Number of files per batch, see is_js_files. Default: 1000.
+        - timeout, max_size, max_memory
+            See is_js_file.
+        - log_dir: str
+            Directory of the logs of the parser's stderr: is_js-<pid>.log per process if
+            jobs > 1. Default: None, i.e. LOG_PATH is used (jobs = 1) or its directory.
+
+        -------
+        Returns:
+        - generator
+            Yields tuples (file path, error code of is_js_file), in the order of files.
+    """
+
+    files = iter(files)
+    if jobs <= 1:
+        log_path = None if log_dir is None else os.path.join(log_dir, 'is_js.log')
+        while True:
+            batch = list(islice(files, batch_size))
+            if not batch:
+                break
+            yield from zip(batch, parse_batch(batch, timeout=timeout, max_size=max_size,
+                                              max_memory=max_memory, log_path=log_path))
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(log_dir or os.path.dirname(LOG_PATH),)) as executor:
+        in_flight = deque()  # At most 2 batches per process, for files to be read lazily
+        while True:
+            batch = list(islice(files, batch_size))
+            if batch:
+                in_flight.append((batch, executor.submit(check_batch, batch, timeout,
+                                                         max_size, max_memory)))
+            if in_flight and (len(in_flight) >= 2 * jobs or not batch):
+                done_batch, future = in_flight.popleft()
+                yield from zip(done_batch, future.result())
+            elif not batch:
+                break
+
+
+def list_dir(cdir):
+    """ Yields the path of the files of the directory cdir (not recursive). """
+
+    for cfile in os.listdir(cdir):
+        yield os.path.join(cdir, cfile)
+
+
+def write_results(results, output_format='text', output=None):
+    """
+        Writes the results of check_files.
+
+        -------
+        Parameters:
+        - results: iterable of tuples
+            (file path, error code), see check_files.
+        - output_format: str
+            'text' for '<fileName>: <result>' lines, 'jsonl' for one JSON object per line
+            ({"file", "status", "result"}) or 'csv' (file,status,result). Default: 'text'.
+        - output: file object
+            Where to write the results. Default: None, i.e. stdout.
+
+        -------
+        Returns:
+        - Counter
+            Number of files per error code.
+    """
+
+    output = output or sys.stdout
+    counts = Counter()
+    if output_format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(['file', 'status', 'result'])
+    for cfile, res in results:
+        counts[res] += 1
+        if output_format == 'jsonl':
+            output.write(json.dumps({'file': cfile, 'status': res,
+                                     'result': status_text(res)}) + '\n')
+        elif output_format == 'csv':
+            writer.writerow([cfile, res, status_text(res)])
+        else:
+            output.write("%s: %s\n" % (cfile, status_text(res)))
+    return counts
+
+
 def main():
     """
         A list of files, or of repositories, can be given as command line arguments, for this
@@ -79,10 +436,11 @@ def main():
 
         -------
         Returns:
-        - Message (stdout) whose format is:
+        - Message (stdout, or the file given with --o) whose format is:
             * For valid JS files: <fileName>: valid JavaScript
             * For malformed JS files: <fileName>: malformed JavaScript
             * For no JS files: <fileName>: not JavaScript
+          or one JSON object, or CSV row, per file (see write_results).
     """
 
     parser = argparse.ArgumentParser(description='Given a list of directory, or of file paths,\
@@ -98,22 +456,47 @@ def main():
     parser.add_argument('--v', metavar='VERBOSITY', type=int, nargs=1, choices=[0, 1, 2, 3, 4, 5],
                         default=[2], help='controls the verbosity of the output, from 0 (verbose) '
                                           + 'to 5 (less verbose)')
+    parser.add_argument('--jobs', metavar='INTEGER', type=int, nargs=1, default=[1],
+                        help='number of processes checking the files in parallel')
+    parser.add_argument('--batch_size', metavar='INTEGER', type=int, nargs=1, default=[1000],
+                        help='number of files parsed by one Node.js process')
+    parser.add_argument('--format', metavar='FORMAT', type=str, nargs=1, default=['text'],
+                        choices=['text', 'jsonl', 'csv'], help='format of the results: text, '
+                                                               + 'jsonl or csv')
+    parser.add_argument('--o', metavar='OUTPUT', type=str, nargs=1,
+                        help='file to store the results in (default: stdout)')
+    parser.add_argument('--log_dir', metavar='DIR', type=str, nargs=1, default=[None],
+                        help='directory of the logs of the parser\'s stderr, one per process')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, nargs=1, default=[60],
+                        help='time after which the parsing of a file is stopped')
+    parser.add_argument('--max_size', metavar='MB', type=float, nargs=1, default=[None],
+                        help='size over which a file is not parsed')
+    parser.add_argument('--max_memory', metavar='MB', type=int, nargs=1, default=[None],
+                        help='heap size over which the parsing of a file is stopped')
 
     args = vars(parser.parse_args())
     logging.basicConfig(format='%(levelname)s:%(message)s',
                         level=logging.getLevelName(args['v'][0] * 10))
 
+    files2do = []
     if args['f'] is not None:
-        files2do = args['f']
-    else:
-        files2do = []
+        files2do = [args['f']]
     if args['d'] is not None:
-        for cdir in args['d']:
-            files2do.extend(os.path.join(cdir, cfile) for cfile in os.listdir(cdir))
-    results = [is_js_file(cfile) for cfile in files2do]
-    for cfile, res in zip(files2do, results):
-        print("%s: %s" % (cfile, OUTPUT_TEXTS[res]))
-    logging.info('\tNumber of correct files: %d', len([i for i in results if i == 0]))
+        files2do.extend(list_dir(cdir) for cdir in args['d'])
+    max_size = args['max_size'][0]
+    results = check_files(chain.from_iterable(files2do), args['jobs'][0], args['batch_size'][0],
+                          args['timeout'][0],
+                          None if max_size is None else int(max_size * 1024 * 1024),
+                          args['max_memory'][0], args['log_dir'][0])
+
+    if args['o'] is not None:
+        with open(args['o'][0], 'w', newline='') as output:
+            counts = write_results(results, args['format'][0], output)
+    else:
+        counts = write_results(results, args['format'][0])
+    logging.info('\tNumber of correct files: %d', counts[0])
+    for status in sorted(counts):
+        logging.info('\t%s: %d', status_text(status), counts[status])
 
 
 if __name__ == "__main__":  # Executed only if run as a script
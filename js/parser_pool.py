@@ -0,0 +1,303 @@
+#!/usr/bin/python
+
+"""
+    Pool of long-lived Node.js workers (features/parsing/parser_worker.js) parsing JavaScript
+    inputs with esprima, so that neither a Node.js process nor esprima have to be started
+    again for every file.
+"""
+
+import os
+import sys
+import time
+import queue
+import struct
+import logging
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+SRC_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(SRC_PATH, 'features', 'tokens2int'))
+
+import parser_esprima_simpl
+import is_js
+
+WORKER_PATH = os.path.join(SRC_PATH, 'features', 'parsing', 'parser_worker.js')
+UNITS_CODES = is_js.format_codes(parser_esprima_simpl.ast_units_dico)
+
+EXIT_WAIT = 5  # Seconds given to a worker which closed its stdout to exit
+current_pool = None  # Pool used by tokens.ast_used_esprima, see start_pool
+
+
+class ParserWorker:
+    """
+        One Node.js process running parser_worker.js, answering one request at a time.
+    """
+
+    def __init__(self, timeout, max_memory=None):
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.process = None
+        self.start()
+
+    def start(self):
+        """ Launches the Node.js process. """
+
+        self.process = subprocess.Popen(is_js.node_command(WORKER_PATH, self.max_memory)
+                                        + [UNITS_CODES],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+
+    def stop(self):
+        """ Kills the Node.js process. """
+
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def restart(self):
+        """ Kills the Node.js process and launches a new one. """
+
+        self.stop()
+        self.start()
+
+    def read_exactly(self, size, deadline):
+        """ Reads size bytes from the worker's stdout, see is_js.read_exactly. """
+
+        return is_js.read_exactly(self.process.stdout.fileno(), size, deadline)
+
+    def request(self, kind, data, tolerance, mode=b'c'):
+        """
+            Sends a file path or a JS source to the worker and waits for its answer.
+
+            -------
+            Parameters:
+            - kind: bytes
+                b'f' if data is a file path, b's' if data is JS source.
+            - data: bytes
+                File path or JS source.
+            - tolerance: str
+                'true' to enable esprima's tolerant mode, 'false' otherwise.
+            - mode: bytes
+                b'c' to get the codes of the syntactic units (one byte each), b't' to get their
+                names. Default: b'c'.
+
+            -------
+            Returns:
+            - tuple (status, payload)
+                Status as in is_js.is_js_file and the worker's payload, or (is_js.TIMEOUT, None)
+                if the worker hung, (is_js.OUT_OF_MEMORY, None) if it ran out of memory and
+                (-1, None) if it died otherwise, in which case it is restarted.
+        """
+
+        flag = b'1' if tolerance == 'true' else b'0'
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        try:
+            self.process.stdin.write(struct.pack('>I', len(data) + 3) + kind + flag + mode + data)
+            self.process.stdin.flush()
+            header = self.read_exactly(4, deadline)
+            if header is not None:
+                body = self.read_exactly(struct.unpack('>I', header)[0], deadline)
+                if body is not None:
+                    return body[0], body[1:]
+        except OSError:  # Broken pipe: the worker died
+            pass
+
+        if deadline is not None and time.monotonic() >= deadline:
+            returncode = None  # Still parsing: it hung
+        else:  # End of its stdout: it died, and is reaped to know why
+            try:
+                returncode = self.process.wait(EXIT_WAIT)
+            except subprocess.TimeoutExpired:
+                returncode = -1  # Closed its stdout without exiting
+        status = failure_status(returncode)
+        self.restart()
+        return status, None
+
+
+def failure_status(returncode):
+    """
+        Error code of an input whose parsing made a worker fail, which is logged.
+
+        -------
+        Parameter:
+        - returncode: int
+            Return code of the worker's process, None if it is still running.
+
+        -------
+        Returns:
+        - int
+            is_js.TIMEOUT if the worker hung, is_js.OUT_OF_MEMORY if it ran out of memory,
+            -1 otherwise.
+    """
+
+    if returncode is None:
+        logging.warning('A parser worker timed out, it is being restarted')
+        return is_js.TIMEOUT
+    if is_js.is_aborted(returncode):
+        logging.warning('A parser worker ran out of memory, it is being restarted')
+        return is_js.OUT_OF_MEMORY
+    logging.warning('A parser worker died, it is being restarted')
+    return -1
+
+
+class ParserPool:
+    """
+        Pool of ParserWorker objects, which can be shared between threads.
+    """
+
+    def __init__(self, nb_workers=1, timeout=60, max_size=None, max_memory=None):
+        """
+            -------
+            Parameters:
+            - nb_workers: int
+                Number of Node.js processes. Default: 1.
+            - timeout: float
+                Number of seconds after which a worker still parsing an input is killed and
+                restarted. None to disable it. Default: 60.
+            - max_size: int
+                Size in bytes over which an input is not parsed. Default: None.
+            - max_memory: int
+                Heap size in MB of each Node.js process, which is restarted if the parsing of
+                an input exceeds it. Default: None, i.e. Node.js' default.
+        """
+
+        self.nb_workers = max(1, nb_workers)
+        self.max_size = max_size
+        self.idle_workers = queue.Queue()
+        for _ in range(self.nb_workers):
+            self.idle_workers.put(ParserWorker(timeout, max_memory))
+
+    def close(self):
+        """ Stops every worker of the pool. """
+
+        for _ in range(self.nb_workers):
+            self.idle_workers.get().stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def parse(self, given_file=None, source=None, tolerance='false', codes=False):
+        """
+            Parses either a file or JS source with a worker of the pool.
+
+            -------
+            Parameters:
+            - given_file: str
+                Path of the file to be analysed.
+            - source: bytes or str
+                JS source to be analysed, if given_file is None.
+            - tolerance: str
+                Indicates whether esprima should tolerate a few cases of syntax errors
+                (corresponds to esprima's tolerant option). Default value is 'false'.
+            - codes: bool
+                Whether to get the codes of the syntactical units (see
+                tokens2int/parser_esprima_simpl.py) instead of their names. Default: False.
+
+            -------
+            Returns:
+            - tuple (int, list)
+                Error code as returned by is_js.is_js_file, i.e. valid JavaScript (0),
+                no JavaScript (1), malformed JavaScript (2), limit reached (3 to 5, see
+                is_js.OUTPUT_TEXTS) or system error (-1);
+                List of the syntactical units found (np.array of uint8 if codes) if the input
+                is valid, None otherwise.
+        """
+
+        if given_file is not None:
+            kind, data = b'f', os.fsencode(given_file)
+            try:
+                size = os.path.getsize(given_file)
+            except OSError:
+                size = 0  # The worker reports the file as not JS, as before
+        else:
+            kind, data = b's', source.encode('utf-8') if isinstance(source, str) else source
+            size = len(data)
+        if self.max_size is not None and size > self.max_size:
+            return is_js.TOO_LARGE, None
+
+        worker = self.idle_workers.get()
+        try:
+            status, payload = worker.request(kind, data, tolerance, b'c' if codes else b't')
+        finally:
+            self.idle_workers.put(worker)
+
+        if status == 0 and codes:
+            return 0, np.frombuffer(payload, dtype=np.uint8)
+        if status == 0:
+            units = payload.decode('utf-8').split('\n')
+            del units[len(units) - 1]  # As last one = ''
+            return 0, units
+        if status not in (1, 2) and given_file is not None:
+            logging.error('The file <' + given_file + '> could not be parsed: '
+                          + is_js.status_text(status))
+        return status, None
+
+    def imap(self, files, tolerance='false', function=None):
+        """
+            Parses files with all the workers of the pool, keeping at most twice as many files
+            in flight as there are workers.
+
+            -------
+            Parameters:
+            - files: iterable of str
+                Paths of the files to be analysed.
+            - tolerance: str
+                Indicates whether esprima should tolerate a few cases of syntax errors.
+            - function: callable
+                Called as function(given_file, tolerance) instead of ParserPool.parse, e.g.
+                tokens.tokens_to_numbers when this pool is parser_pool.current_pool.
+
+            -------
+            Returns:
+            - generator
+                Yields the results of ParserPool.parse (or of function), in the order of files.
+        """
+
+        if function is None:
+            function = lambda given_file, tolerance: self.parse(given_file, tolerance=tolerance)
+        window = 2 * self.nb_workers
+        with ThreadPoolExecutor(max_workers=self.nb_workers) as executor:
+            in_flight = deque()
+            for given_file in files:
+                in_flight.append(executor.submit(function, given_file, tolerance))
+                if len(in_flight) >= window:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+
+
+def start_pool(nb_workers=1, timeout=60, max_size=None, max_memory=None):
+    """
+        Starts the pool used by tokens.ast_used_esprima instead of one Node.js process per file.
+
+        -------
+        Parameters:
+        - nb_workers, timeout, max_size, max_memory:
+            See ParserPool.
+
+        -------
+        Returns:
+        - ParserPool
+            Also stored in the global variable current_pool.
+    """
+
+    global current_pool
+    stop_pool()
+    current_pool = ParserPool(nb_workers, timeout, max_size, max_memory)
+    return current_pool
+
+
+def stop_pool():
+    """ Stops the pool started with start_pool, if any. """
+
+    global current_pool
+    if current_pool is not None:
+        current_pool.close()
+        current_pool = None
+